@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+"""
+Local stand-in for the cluster scheduler to test the submit calls without a
+cluster. The script takes the full qsub or sbatch command, skips the resource
+options and runs the job on the local machine. For the array jobs (qsub -t,
+sbatch --array), every task is run as a separate process with the task index
+set in the environment ($SGE_TASK_ID or $SLURM_ARRAY_TASK_ID), as the real
+scheduler would do.
+
+Usage:
+
+    $python fake_scheduler.py [--workers N] qsub -cwd -b y -t 1-10 ./run_array_task.py tasks.txt
+
+In the submit scripts, set the FAKE_SCHEDULER flag to prepend this script to
+the cluster calls.
+"""
+import os, sys
+import time
+import subprocess as sp
+
+# qsub options, which take a value
+SGE_VALUE_OPTIONS = ['-b', '-l', '-o', '-e', '-N', '-q', '-t', '-tc', '-hold_jid', '-wd']
+
+def _parse_range(task_range):
+    """
+    Parse the array range in format 'first-last[:step]' or a single index.
+
+    Returns:
+
+     - task_ids(list): list of the task indices
+    """
+    step = 1
+    if ':' in task_range:
+        task_range, step = task_range.split(':')
+        step = int(step)
+    if '-' in task_range:
+        first, last = task_range.split('-')
+    else:
+        first = last = task_range
+    return range(int(first), int(last) + 1, step)
+
+def parse_submit_call(call):
+    """
+    Split the qsub/sbatch command into the job command and the array settings.
+
+    Args:
+
+     - call(list): full submit command, starting with 'qsub' or 'sbatch'
+
+    Returns:
+
+     - task_var(str): environment variable to set the task index in
+
+     - task_ids(list): task indices, or None for the non-array job
+
+     - max_running(int): maximal number of the concurrent tasks, or None
+
+     - command(list): the job command with its arguments
+    """
+    scheduler = os.path.basename(call[0])
+    task_ids, max_running = None, None
+    idx = 1
+    if scheduler == 'qsub':
+        task_var = 'SGE_TASK_ID'
+        # the first token, which is not an option, is the job command
+        while idx < len(call) and call[idx].startswith('-'):
+            option = call[idx]
+            if option == '-pe':
+                idx += 3
+                continue
+            if option in SGE_VALUE_OPTIONS:
+                if option == '-t':
+                    task_ids = _parse_range(call[idx + 1])
+                elif option == '-tc':
+                    max_running = int(call[idx + 1])
+                idx += 2
+            else:
+                idx += 1
+    elif scheduler == 'sbatch':
+        task_var = 'SLURM_ARRAY_TASK_ID'
+        while idx < len(call) and call[idx].startswith('-'):
+            option = call[idx]
+            if option.startswith('--array='):
+                task_range = option.split('=', 1)[1]
+                if '%' in task_range:
+                    task_range, max_running = task_range.split('%')
+                    max_running = int(max_running)
+                task_ids = _parse_range(task_range)
+            idx += 1
+    else:
+        raise ValueError("Unknown scheduler command: {}".format(call[0]))
+
+    return task_var, task_ids, max_running, call[idx:]
+
+def run_job(call, n_workers=1):
+    """
+    Run the job from the submit command on the local machine.
+
+    Args:
+
+     - call(list): full submit command, starting with 'qsub' or 'sbatch'
+
+     - n_workers(int): number of the tasks to run at the same time. Limited by
+     the array settings of the submit command, if given.
+
+    Returns:
+
+     - n_failed(int): number of the tasks finished with non-zero exit code
+    """
+    task_var, task_ids, max_running, command = parse_submit_call(call)
+    if task_ids is None:
+        return int(sp.call(command) != 0)
+
+    if max_running is not None:
+        n_workers = min(n_workers, max_running)
+
+    n_failed = 0
+    pending = list(task_ids)
+    running = []
+    while pending or running:
+        while pending and len(running) < n_workers:
+            env = dict(os.environ)
+            env[task_var] = str(pending.pop(0))
+            running.append(sp.Popen(command, env=env))
+        time.sleep(0.1)
+        for p in running[:]:
+            if p.poll() is not None:
+                n_failed += int(p.returncode != 0)
+                running.remove(p)
+    return n_failed
+
+if __name__ == '__main__':
+
+    args = sys.argv[1:]
+    n_workers = 1
+    if len(args) > 1 and args[0] == '--workers':
+        n_workers = int(args[1])
+        args = args[2:]
+
+    n_failed = run_job(args, n_workers)
+    if n_failed:
+        sys.stderr.write("{} tasks failed\n".format(n_failed))
+    sys.exit(int(n_failed > 0))
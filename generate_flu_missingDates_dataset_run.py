@@ -3,12 +3,22 @@ import datetime
 import utility_functions_flu as flu_utils
 import utility_functions_general as gen_utils
 import utility_functions_beast as beast_utils
+import utility_functions_cluster as cluster_utils
 
-from Bio import AlignIO
 import os,sys
 import numpy as np
 
-def _run_beast(aln_name, tree_name, known_dates_fraction, out_dir):
+RUN_BEAST = True
+RUN_TREETIME = True
+
+def active_stages():
+    """
+    Names of the stages enabled in this script (see utility_functions_cluster)
+    """
+    flags = [('treetime', RUN_TREETIME), ('beast', RUN_BEAST)]
+    return [k for k, run in flags if run]
+
+def _run_beast(aln_name, tree_name, known_dates_fraction, out_dir, beast_prefix, beast_res_file):
 
         def log_post_process(log_file):
 
@@ -24,23 +34,16 @@ def _run_beast(aln_name, tree_name, known_dates_fraction, out_dir):
             inferred_Mu = df['clock.rate'][-50:].mean()
             inferred_Mu_std = df['clock.rate'][-50:].std()
 
-            if not os.path.exists(beast_res_file):
-                try:
-                    with open(beast_res_file, 'w') as of:
-                        of.write("#Filename,KnownDatesFraction,LH,LH_std,Tmrca,Tmrca_std,Mu,Mu_std\n")
-                except:
-                    pass
-
-            with open(beast_res_file, 'a') as of:
-                of.write("{},{},{},{},{},{},{},{}\n".format(
-                    tree_name,
-                    known_dates_fraction,
-                    inferred_LH,
-                    inferred_LH_std,
-                    inferred_Tmrca,
-                    inferred_Tmrca_std,
-                    inferred_Mu,
-                    inferred_Mu_std))
+            gen_utils.write_results_line(beast_res_file,
+                ["Filename", "KnownDatesFraction", "LH", "LH_std", "Tmrca", "Tmrca_std", "Mu", "Mu_std"],
+                [tree_name,
+                 known_dates_fraction,
+                 inferred_LH,
+                 inferred_LH_std,
+                 inferred_Tmrca,
+                 inferred_Tmrca_std,
+                 inferred_Mu,
+                 inferred_Mu_std])
 
         dates = flu_utils.make_known_dates_dict(aln_name, known_dates_fraction)
         beast_out_dir = os.path.join(out_dir, 'beast_out')
@@ -50,25 +53,102 @@ def _run_beast(aln_name, tree_name, known_dates_fraction, out_dir):
             except:
                 pass
 
-        beast_prefix = os.path.join(beast_out_dir, subtree+filename_suffix)
+        beast_prefix = os.path.join(beast_out_dir, beast_prefix)
         flu_utils.run_beast(tree_name, aln_name, dates, beast_prefix,
             log_post_process=log_post_process,
             template_file="./resources/beast/template_bedford_et_al_2015.xml")
 
-if __name__ == "__main__":
+def _write_treetime_results(myTree, tree_name, known_dates_fraction, out_dir, all_dates, runtime):
+    """
+    Write the TreeTime results and the precision of the inferred leaf dates.
 
+    Args:
 
-    RUN_BEAST = True
-    RUN_TREETIME = True
+     - myTree(TreeTime): the TreeTime object after the run
 
-    print sys.argv[0]
+     - all_dates(dict): real dates of all sequences
+
+     - runtime(float): TreeTime run time (seconds)
+    """
+
+    treetime_res_file = os.path.join(out_dir, "treetime_res.csv")
+    gen_utils.write_results_line(treetime_res_file,
+        ["Filename", "KnownDatesFraction", "Tmrca", "Mu", "R^2(initial clock)", "R^2(internal nodes)", "RunTime(sec)"],
+        [tree_name,
+         str(known_dates_fraction),
+         str(myTree.tree.root.numdate),
+         str(myTree.date2dist.clock_rate),
+         str(myTree.date2dist.r_val),
+         str(gen_utils.internal_regress(myTree)),
+         str(runtime)])
+
+    ##
+    ##
+    ## precision of the date inference
+    ##
+    ##
+    dTs = [(leaf.name, leaf.numdate, all_dates[leaf.name], leaf.numdate - all_dates[leaf.name])
+            for leaf in myTree.tree.get_terminals() if leaf.numdate_given is None]
+
+
+    dates_res_file = os.path.join(out_dir, "treetime_dates_res.csv")
+    if not os.path.exists(dates_res_file):
+        try:
+            with open(dates_res_file, 'w') as of:
+                of.write("#LeafName,KnownDatesFraction,Tmrca,LeafDate,LeafDate_real,LeafDateErr(years)\n")
+        except:
+            pass
+
+    with open(dates_res_file, 'a') as of:
+        of.write(
+            "\n".join(["{},{},{},{},{},{}".format(
+            dT[0],
+            str(known_dates_fraction),
+            str(myTree.tree.root.numdate),
+            str(dT[1]),
+            str(dT[2]),
+            str(dT[3])) for dT in dTs]) + "\n")
+
+def _run_treetime(myTree):
+    """
+    Run the TreeTime inference
+
+    Returns:
 
-    out_dir = sys.argv[1]
-    subtree = sys.argv[2]
-    known_dates_fraction = float(sys.argv[3])
-    filename_suffix= sys.argv[4]
+     - runtime(float): run time (seconds)
+    """
+    start = datetime.datetime.now()
+    myTree.run(root='best', relaxed_clock=False, max_iter=3, resolve_polytomies=True, do_marginal=False)
+    end = datetime.datetime.now()
+    return (end-start).total_seconds()
 
+def main(argv):
+    """
+    Run the TreeTime and BEAST inference for a single subtree and a single
+    fraction of the known leaf dates.
 
+    Args:
+
+     - argv(list): the command line arguments (without the script name):
+     out_dir, subtree (path without extension), known_dates_fraction and
+     filename_suffix. To run the batch of the fractions (see run_batch),
+     give the fractions separated by commas instead of the single fraction,
+     and, optionally, the number of the points per fraction and the number of
+     the parallel processes.
+    """
+
+    out_dir = argv[0]
+    subtree = argv[1]
+    filename_suffix= argv[3]
+
+    if ',' in argv[2] or len(argv) > 4:
+        fractions = [float(k) for k in argv[2].split(',')]
+        n_points = int(argv[4]) if len(argv) > 4 else 1
+        n_jobs = int(argv[5]) if len(argv) > 5 else None
+        run_batch(out_dir, subtree, fractions, n_points, filename_suffix, n_jobs=n_jobs)
+        return
+
+    known_dates_fraction = float(argv[2])
     assert(known_dates_fraction > 0 and known_dates_fraction <= 1.0)
 
     aln_name = subtree + ".fasta"
@@ -76,62 +156,106 @@ if __name__ == "__main__":
 
     if RUN_TREETIME:
 
-        treetime_res_file = os.path.join(out_dir, "treetime_res.csv")
-
-        myTree = flu_utils.create_treetime_with_missing_dates(aln_name, tree_name, known_dates_fraction)
-        start = datetime.datetime.now()
-        myTree.run(root='best', relaxed_clock=False, max_iter=3, resolve_polytomies=True, do_marginal=False)
-        end = datetime.datetime.now()
-
-        if not os.path.exists(treetime_res_file):
-            try:
-                with open(treetime_res_file, 'w') as of:
-                    of.write("#Filename,KnownDatesFraction,Tmrca,Mu,R^2(initial clock),R^2(internal nodes),RunTime(sec)\n")
-            except:
-                pass
+        with cluster_utils.stage_usage('treetime'):
+            myTree = flu_utils.create_treetime_with_missing_dates(aln_name, tree_name, known_dates_fraction)
+            runtime = _run_treetime(myTree)
 
-        with open(treetime_res_file, 'a') as of:
-            of.write("{},{},{},{},{},{},{}\n".format(
-                tree_name,
-                str(known_dates_fraction),
-                str(myTree.tree.root.numdate),
-                str(myTree.date2dist.clock_rate),
-                str(myTree.date2dist.r_val),
-                str(gen_utils.internal_regress(myTree)),
-                str((end-start).total_seconds()) ))
-
-        ##
-        ##
-        ## precision of the date inference
-        ##
-        ##
+        from Bio import AlignIO
         aln = AlignIO.read(aln_name, 'fasta')
         dates = {k.name: flu_utils.date_from_seq_name(k.name) for k in aln}
-        dTs = [(leaf.name, leaf.numdate, dates[leaf.name], leaf.numdate - dates[leaf.name])
-                for leaf in myTree.tree.get_terminals() if leaf.numdate_given is None]
+        _write_treetime_results(myTree, tree_name, known_dates_fraction, out_dir, dates, runtime)
 
+    if RUN_BEAST:
+        beast_res_file = os.path.join(out_dir, "beast_res.csv")
+        with cluster_utils.stage_usage('beast'):
+            _run_beast(aln_name, tree_name, known_dates_fraction, out_dir,
+                       subtree + filename_suffix, beast_res_file)
 
-        dates_res_file = os.path.join(out_dir, "treetime_dates_res.csv")
-        if not os.path.exists(dates_res_file):
-            try:
-                with open(dates_res_file, 'w') as of:
-                    of.write("#LeafName,KnownDatesFraction,Tmrca,LeafDate,LeafDate_real,LeafDateErr(years)\n")
-            except:
-                pass
-
-        with open(dates_res_file, 'a') as of:
-            of.write(
-                "\n".join(["{},{},{},{},{},{}".format(
-                dT[0],
-                str(known_dates_fraction),
-                str(myTree.tree.root.numdate),
-                str(dT[1]),
-                str(dT[2]),
-                str(dT[3])) for dT in dTs]) + "\n")
+# optimized tree shared by the batch processes (set by run_batch before the
+# processes are forked)
+_BATCH_STATE = {}
 
+def _batch_point(args):
+    """
+    Single (fraction, point) of the batch, run from the optimized tree.
+    """
+    known_dates_fraction, point, seed = args
+    # the forked processes would otherwise share the random state
+    np.random.seed(seed)
+    state = _BATCH_STATE
+    if RUN_TREETIME:
+        with cluster_utils.stage_usage('treetime'):
+            myTree = flu_utils.treetime_from_optimized_tree(state['tree'], state['aln'],
+                state['dates'], known_dates_fraction)
+            runtime = _run_treetime(myTree)
+        _write_treetime_results(myTree, state['tree_name'], known_dates_fraction,
+            state['out_dir'], state['dates'], runtime)
 
     if RUN_BEAST:
-        beast_res_file = os.path.join(out_dir, "beast_res.csv")
-        _run_beast(aln_name, tree_name, known_dates_fraction, out_dir)
+        beast_res_file = os.path.join(state['out_dir'], "beast_res.csv")
+        with cluster_utils.stage_usage('beast'):
+            _run_beast(state['aln_name'], state['tree_name'], known_dates_fraction, state['out_dir'],
+                state['subtree'] + state['filename_suffix'] + "_Nk{}_{}".format(known_dates_fraction, point),
+                beast_res_file)
+
+def run_batch(out_dir, subtree, fractions, n_points, filename_suffix="", n_jobs=None):
+    """
+    Run the TreeTime and BEAST inference for a single subtree and all given
+    fractions of the known dates. The alignment and the tree are read, and the
+    branch lengths are optimized (this does not depend on the known dates) only
+    once. Then, every fraction and point is run from the optimized tree in
+    parallel processes.
+
+    The optimized tree is kept in the snapshot (<subtree>.missing_dates.snapshot)
+    and reused by the next batches of the same subtree.
+
+    Args:
+
+     - out_dir(str): output directory
+
+     - subtree(str): path to the subtree (without extension)
+
+     - fractions(list): fractions of the known dates
+
+     - n_points(int): number of the runs per fraction
 
+     - filename_suffix(str): suffix of the BEAST output file names. The
+     fraction and the point index are appended.
+
+     - n_jobs(int or None): number of the parallel processes. One per CPU, if
+     None.
+    """
+    import multiprocessing
+    for frac in fractions:
+        assert(frac > 0 and frac <= 1.0)
+
+    aln_name = subtree + ".fasta"
+    tree_name = subtree + ".nwk"
+
+    with cluster_utils.stage_usage('treetime'):
+        tree, aln, dates = flu_utils.optimize_missing_dates_tree(aln_name, tree_name,
+            snapshot_dir=subtree + ".missing_dates.snapshot")
+
+    _BATCH_STATE.update({'tree': tree, 'aln': aln, 'dates': dates, 'out_dir': out_dir,
+        'subtree': subtree, 'aln_name': aln_name, 'tree_name': tree_name,
+        'filename_suffix': filename_suffix})
+
+    points = [(frac, point) for frac in fractions for point in range(n_points)]
+    seeds = np.random.randint(0, 2**31 - 1, size=len(points))
+    tasks = [(frac, point, seed) for (frac, point), seed in zip(points, seeds)]
+    if n_jobs == 1:
+        map(_batch_point, tasks)
+        return
+
+    pool = multiprocessing.Pool(n_jobs)
+    try:
+        pool.map(_batch_point, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+if __name__ == "__main__":
+
+    print sys.argv[0]
 
+    main(sys.argv[1:])
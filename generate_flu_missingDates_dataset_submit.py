@@ -1,8 +1,31 @@
 #!/usr/bin/env python
 import subprocess as sp
 import os
+import utility_functions_cluster as cluster_utils
+import generate_flu_missingDates_dataset_run as run_script
 
 CLUSTER = True
+# cluster scheduler: 'sge' (qsub) or 'slurm' (sbatch)
+SCHEDULER = 'sge'
+# put the tasks to the queue of the worker service (run_worker_service.py)
+# instead of starting a separate process for every task
+WORKER_SERVICE = False
+# submit all tasks as a single array job (CLUSTER on) instead of one job per
+# task. The parameter grid is written to the task file.
+ARRAY_JOB = False
+# run the cluster calls with the local stand-in scheduler (fake_scheduler.py)
+FAKE_SCHEDULER = False
+# cluster nodes to run the worker service (CLUSTER and WORKER_SERVICE on)
+N_SERVICE_JOBS = 4
+NODE_MEM_GB = 64
+NODE_CPUS = 16
+# run all fractions and points of a subtree as one task (see run_batch in the
+# run script): the branch lengths are optimized once per subtree, and the
+# fractions are run in BATCH_JOBS parallel processes. The tasks of the worker
+# service and of the array job are sized for a single process, so they run the
+# fractions one after another.
+BATCH_FRACTIONS = False
+BATCH_JOBS = 8
 
 if __name__ =="__main__":
 
@@ -10,6 +33,8 @@ if __name__ =="__main__":
     #output directories
     out_dir = "./flu_H3N2/missing_dates/"
     subtree_dir = os.path.join(out_dir, "subtrees")
+    task_file = os.path.join(out_dir, "tasks.txt")
+    queue_file = os.path.join(out_dir, "tasks.sqlite")
 
     # without extension
     subtree_files = ["./flu_H3N2/missing_dates/subtrees/H3N2_HA_2011_2013_100seqs"]
@@ -20,17 +45,43 @@ if __name__ =="__main__":
     #dates_knonwn_fraction = [0.5]
     #Npoints = 1
 
+    tasks = []
     for subtree in subtree_files:
+        if BATCH_FRACTIONS:
+            arguments = [
+                    out_dir,
+                    subtree,
+                    ",".join([str(k) for k in dates_knonwn_fraction]),
+                    "",
+                    str(Npoints),
+                    str(BATCH_JOBS)
+                    ]
+            if WORKER_SERVICE or (CLUSTER and ARRAY_JOB):
+                tasks.append(arguments[:-1] + ["1"])
+                continue
+
+            if CLUSTER:
+                n_runs = len(dates_knonwn_fraction) * Npoints
+                call = cluster_utils.submit_call('./generate_flu_missingDates_dataset_run.py',
+                    run_script.active_stages(), scheduler=SCHEDULER, cpus=BATCH_JOBS,
+                    runtime_scale=max(1, -(-n_runs // BATCH_JOBS)))
+                if FAKE_SCHEDULER:
+                    call = ['./fake_scheduler.py'] + call
+            else:
+                call = ['./generate_flu_missingDates_dataset_run.py']
+            sp.call(call + arguments)
+            continue
+
         for frac in dates_knonwn_fraction:
             for point in xrange(Npoints):
 
                 if CLUSTER:
-                    call = ['qsub', '-cwd', '-b','y',
-                         '-l', 'h_rt=23:59:0',
-                         #'-o', './stdout.txt',
-                         #'-e', './stderr.txt',
-                         '-l', 'h_vmem=50G',
-                         './generate_flu_missingDates_dataset_run.py']
+                    # runtime and memory are set by the resource profiles of
+                    # the stages enabled in the run script
+                    call = cluster_utils.submit_call('./generate_flu_missingDates_dataset_run.py',
+                        run_script.active_stages(), scheduler=SCHEDULER)
+                    if FAKE_SCHEDULER:
+                        call = ['./fake_scheduler.py'] + call
                 else:
                     call = ['./generate_flu_missingDates_dataset_run.py']
 
@@ -42,7 +93,32 @@ if __name__ =="__main__":
                         str(frac),
                         filename_suffix
                         ]
+                if WORKER_SERVICE or (CLUSTER and ARRAY_JOB):
+                    tasks.append(arguments)
+                    continue
+
                 call.extend(arguments)
                 sp.call(call)
 
+    if CLUSTER and ARRAY_JOB and not WORKER_SERVICE:
+        # single array job, every task reads its parameters from the task file
+        n_tasks = cluster_utils.write_task_file(task_file, 'flu_missing_dates', tasks)
+        call = cluster_utils.array_job_call(task_file, n_tasks,
+            run_script.active_stages(), scheduler=SCHEDULER)
+        if FAKE_SCHEDULER:
+            call = ['./fake_scheduler.py'] + call
+        sp.call(call)
+
+    if WORKER_SERVICE:
+        import utility_functions_queue as queue_utils
+        queue_utils.enqueue_tasks(queue_file, 'flu_missing_dates', tasks)
+        print ("{} tasks added to the queue {}".format(len(tasks), queue_file))
+
+        if CLUSTER:
+            # pack the tasks onto the nodes: every service job takes a node
+            # and runs as many workers as the stage profiles allow
+            for k in range(N_SERVICE_JOBS):
+                sp.call(cluster_utils.worker_service_call(queue_file, run_script.active_stages(),
+                    NODE_MEM_GB, NODE_CPUS, scheduler=SCHEDULER))
+
 
@@ -1,5 +1,4 @@
 #!/usr/bin/env python
-import treetime
 import numpy as np
 import os,sys
 import datetime
@@ -8,6 +7,7 @@ import re
 
 import utility_functions_flu as flu_utils
 import utility_functions_general as gen_utils
+import utility_functions_cluster as cluster_utils
 from utility_functions_beast import run_beast, read_beast_log
 
 aln_name = "./resources/flu_H3N2/H3N2_HA_2011_2013.fasta"
@@ -17,6 +17,28 @@ RUN_TREETIME = True
 RUN_LSD = True
 RUN_BEAST = True
 
+def active_stages():
+    """
+    Names of the stages enabled in this script (see utility_functions_cluster)
+    """
+    flags = [('subtree', True), ('treetime', RUN_TREETIME), ('lsd', RUN_LSD), ('beast', RUN_BEAST)]
+    return [k for k, run in flags if run]
+
+# parsed reference tree and leaf dates. Kept between the calls to main() when
+# the script is run by the worker service.
+_reference_cache = {}
+
+def _reference_tree_and_dates():
+    """
+    Read the reference flu tree and parse the leaf dates. The results are
+    cached, so that the warm worker processes read the big tree only once.
+    """
+    if not _reference_cache:
+        from Bio import Phylo
+        tree = Phylo.read(tree_name, 'newick')
+        _reference_cache['tree'] = tree
+        _reference_cache['dates'] = flu_utils.dates_from_flu_tree(tree)
+    return _reference_cache['tree'], _reference_cache['dates']
 
 def _run_beast(N_leaves, subtree_filename, out_dir, res_file):
 
@@ -32,23 +54,16 @@ def _run_beast(N_leaves, subtree_filename, out_dir, res_file):
         inferred_Mu = df['clock.rate'][-50:].mean()
         inferred_Mu_std = df['clock.rate'][-50:].std()
 
-        if not os.path.exists(res_file):
-            try:
-                with open(res_file, 'w') as of:
-                    of.write("#Filename,N_leaves,LH,LH_std,Tmrca,Tmrca_std,Mu,Mu_std\n")
-            except:
-                pass
-
-        with open(res_file, 'a') as of:
-            of.write("{},{},{},{},{},{},{},{}\n".format(
-                subtree_filename,
-                N_leaves,
-                inferred_LH,
-                inferred_LH_std,
-                inferred_Tmrca,
-                inferred_Tmrca_std,
-                inferred_Mu,
-                inferred_Mu_std))
+        gen_utils.write_results_line(res_file,
+            ["Filename", "N_leaves", "LH", "LH_std", "Tmrca", "Tmrca_std", "Mu", "Mu_std"],
+            [subtree_filename,
+             N_leaves,
+             inferred_LH,
+             inferred_LH_std,
+             inferred_Tmrca,
+             inferred_Tmrca_std,
+             inferred_Mu,
+             inferred_Mu_std])
 
     dates = flu_utils.dates_from_flu_tree(subtree_filename)
     beast_out_dir = os.path.join(out_dir, 'beast_out')
@@ -71,55 +86,65 @@ def sample_subtree(out_dir, N_leaves, subtree_fname_suffix):
             pass
     subtree_fname_format = "H3N2_HA_2011_2013_{}_{}.nwk".format(N_leaves, subtree_fname_suffix)
     subtree_filename = os.path.join(subtrees_dir, subtree_fname_format)
-    tree = flu_utils.subtree_with_same_root(tree_name, N_leaves, subtree_filename)
+    tree, dates = _reference_tree_and_dates()
+    tree = flu_utils.subtree_with_same_root(tree, N_leaves, subtree_filename)
     N_leaves = tree.count_terminals()
     return subtree_filename, N_leaves
 
-if __name__ == "__main__":
+def main(argv):
+    """
+    Run the subtree sampling and the TreeTime, LSD and BEAST inference for a
+    single point of the parameter space.
 
-    N_leaves = int(sys.argv[1])
-    out_dir = sys.argv[2]
-    subtree_fname_suffix = sys.argv[3]
-    treetime_res_file = sys.argv[4]
-    lsd_res_file = sys.argv[5]
-    beast_res_file = sys.argv[6]
+    Args:
 
-    if len(sys.argv) > 7:
-        lsd_params = sys.argv[7].split("|")
+     - argv(list): the command line arguments (without the script name):
+     N_leaves, out_dir, subtree_fname_suffix, treetime_res_file, lsd_res_file,
+     beast_res_file and, optionally, the '|'-separated LSD parameters.
+    """
+
+    N_leaves = int(argv[0])
+    out_dir = argv[1]
+    subtree_fname_suffix = argv[2]
+    treetime_res_file = argv[3]
+    lsd_res_file = argv[4]
+    beast_res_file = argv[5]
+
+    if len(argv) > 6:
+        lsd_params = argv[6].split("|")
     else:
         lsd_params = ['-c', '-r', 'a', '-v']
 
 
 
     #  Sample subtree
-    subtree_filename, N_leaves = sample_subtree(out_dir, N_leaves, subtree_fname_suffix)
+    with cluster_utils.stage_usage('subtree'):
+        subtree_filename, N_leaves = sample_subtree(out_dir, N_leaves, subtree_fname_suffix)
 
     if RUN_TREETIME:
-        dates = flu_utils.dates_from_flu_tree(tree_name)
-        myTree = treetime.TreeTime(gtr='Jukes-Cantor',
-            tree=subtree_filename, aln=aln_name, dates=dates,
-            debug=False, verbose=4)
-        myTree.optimize_seq_and_branch_len(reuse_branch_len=True, prune_short=True, max_iter=5, infer_gtr=False)
-        start = datetime.datetime.now()
-        myTree.run(root='best', relaxed_clock=False, max_iter=3, resolve_polytomies=True, do_marginal=False)
-        end = datetime.datetime.now()
-
-        if not os.path.exists(treetime_res_file):
-            try:
-                with open(treetime_res_file, 'w') as of:
-                    of.write("#Filename,N_leaves,Tmrca,Mu,R^2(initial clock),R^2(internal nodes),Runtime\n")
-            except:
-                pass
-
-        with open(treetime_res_file, 'a') as of:
-            of.write("{},{},{},{},{},{},{}\n".format(
-                subtree_filename,
-                str(N_leaves),
-                str(myTree.tree.root.numdate),
-                str(myTree.date2dist.clock_rate),
-                str(myTree.date2dist.r_val),
-                str(gen_utils.internal_regress(myTree)),
-                str((end-start).total_seconds())    ))
+        import treetime
+        import utility_functions_alignment as aln_utils
+        tree, dates = _reference_tree_and_dates()
+        with cluster_utils.stage_usage('treetime'):
+            # only the subtree rows of the memory-mapped reference alignment
+            aln = aln_utils.subtree_alignment(aln_name, subtree_filename)
+            myTree = treetime.TreeTime(gtr='Jukes-Cantor',
+                tree=subtree_filename, aln=aln, dates=dates,
+                debug=False, verbose=4)
+            myTree.optimize_seq_and_branch_len(reuse_branch_len=True, prune_short=True, max_iter=5, infer_gtr=False)
+            start = datetime.datetime.now()
+            myTree.run(root='best', relaxed_clock=False, max_iter=3, resolve_polytomies=True, do_marginal=False)
+            end = datetime.datetime.now()
+
+        gen_utils.write_results_line(treetime_res_file,
+            ["Filename", "N_leaves", "Tmrca", "Mu", "R^2(initial clock)", "R^2(internal nodes)", "Runtime"],
+            [subtree_filename,
+             str(N_leaves),
+             str(myTree.tree.root.numdate),
+             str(myTree.date2dist.clock_rate),
+             str(myTree.date2dist.r_val),
+             str(gen_utils.internal_regress(myTree)),
+             str((end-start).total_seconds())])
         print ("TreeTime done!")
     else:
         print ("Skip TreeTime run")
@@ -136,22 +161,15 @@ if __name__ == "__main__":
         lsd_outfile = os.path.join(lsd_outdir, os.path.split(subtree_filename)[-1].replace(".nwk", ".txt"))
         datesfile = os.path.join(lsd_outdir, os.path.split(subtree_filename)[-1].replace(".nwk", ".lsd_dates.txt"))
         flu_utils.create_LSD_dates_file_from_flu_tree(subtree_filename, datesfile)
-        runtime = gen_utils.run_LSD(subtree_filename, datesfile, lsd_outfile, lsd_params)
+        with cluster_utils.stage_usage('lsd'):
+            runtime = gen_utils.run_LSD(subtree_filename, datesfile, lsd_outfile, lsd_params)
         #  parse LSD results
         tmrca, mu, objective = gen_utils.parse_lsd_output(lsd_outfile)
         try:
             if float(mu) > 0:
-
-                if not os.path.exists(lsd_res_file):
-                    try:
-                        with open(lsd_res_file, 'w') as of:
-                            of.write("#Filename,N_leaves,Tmrca,Mu,Runtime,Objective\n")
-                    except:
-                        pass
-
-                with open(lsd_res_file, "a") as of:
-                    of.write(",".join([subtree_filename, str(N_leaves), tmrca, mu, runtime, objective]))
-                    of.write("\n")
+                gen_utils.write_results_line(lsd_res_file,
+                    ["Filename", "N_leaves", "Tmrca", "Mu", "Runtime", "Objective"],
+                    [subtree_filename, str(N_leaves), tmrca, mu, runtime, objective])
         except:
             pass
 
@@ -160,12 +178,9 @@ if __name__ == "__main__":
         print ("Skip LSD run")
 
     if RUN_BEAST:
-        _run_beast(N_leaves, subtree_filename, out_dir, beast_res_file)
-
-
-
-
-
-
+        with cluster_utils.stage_usage('beast'):
+            _run_beast(N_leaves, subtree_filename, out_dir, beast_res_file)
 
+if __name__ == "__main__":
 
+    main(sys.argv[1:])
@@ -3,8 +3,24 @@
 import subprocess as sp
 import numpy as np
 import os
+import utility_functions_cluster as cluster_utils
+import generate_flu_subtrees_dataset_run as run_script
 
 CLUSTER = True
+# cluster scheduler: 'sge' (qsub) or 'slurm' (sbatch)
+SCHEDULER = 'sge'
+# put the tasks to the queue of the worker service (run_worker_service.py)
+# instead of starting a separate process for every task
+WORKER_SERVICE = False
+# submit all tasks as a single array job (CLUSTER on) instead of one job per
+# task. The parameter grid is written to the task file.
+ARRAY_JOB = False
+# run the cluster calls with the local stand-in scheduler (fake_scheduler.py)
+FAKE_SCHEDULER = False
+# cluster nodes to run the worker service (CLUSTER and WORKER_SERVICE on)
+N_SERVICE_JOBS = 4
+NODE_MEM_GB = 64
+NODE_CPUS = 16
 
 if __name__ =="__main__":
 
@@ -16,6 +32,8 @@ if __name__ =="__main__":
     treetime_res_file = os.path.join(work_dir, "treetime_res.csv")
     lsd_res_file = os.path.join(work_dir, "lsd_res.csv")
     beast_res_file = os.path.join(work_dir, "beast_res.csv")
+    task_file = os.path.join(work_dir, "tasks.txt")
+    queue_file = os.path.join(work_dir, "tasks.sqlite")
 
     # LSD run configuration
     lsd_parameters = ['-c', '-r', 'a', '-v']
@@ -25,17 +43,18 @@ if __name__ =="__main__":
     #N_leaves_array = [20]
     #n_iter = 1
 
+    tasks = []
     for N_leaves in N_leaves_array:
         for iteration in np.arange(n_iter):
             subtree_fname_suffix = str(iteration)
 
             if CLUSTER:
-                call = ['qsub', '-cwd', '-b','y',
-                        '-l', 'h_rt=23:59:0',
-                        #'-o', './stdout.txt',
-                        #'-e', './stderr.txt',
-                        '-l', 'h_vmem=50G',
-                        './generate_flu_subtrees_dataset_run.py']
+                # runtime and memory are set by the resource profiles of the
+                # stages enabled in the run script
+                call = cluster_utils.submit_call('./generate_flu_subtrees_dataset_run.py',
+                    run_script.active_stages(), scheduler=SCHEDULER)
+                if FAKE_SCHEDULER:
+                    call = ['./fake_scheduler.py'] + call
 
             else:
                 call = ['./generate_flu_subtrees_dataset_run.py']
@@ -50,5 +69,30 @@ if __name__ =="__main__":
                 beast_res_file
             ]
 
+            if WORKER_SERVICE or (CLUSTER and ARRAY_JOB):
+                tasks.append(arguments)
+                continue
+
             call.extend(arguments)
             sp.call(call)
+
+    if CLUSTER and ARRAY_JOB and not WORKER_SERVICE:
+        # single array job, every task reads its parameters from the task file
+        n_tasks = cluster_utils.write_task_file(task_file, 'flu_subtrees', tasks)
+        call = cluster_utils.array_job_call(task_file, n_tasks,
+            run_script.active_stages(), scheduler=SCHEDULER)
+        if FAKE_SCHEDULER:
+            call = ['./fake_scheduler.py'] + call
+        sp.call(call)
+
+    if WORKER_SERVICE:
+        import utility_functions_queue as queue_utils
+        queue_utils.enqueue_tasks(queue_file, 'flu_subtrees', tasks)
+        print ("{} tasks added to the queue {}".format(len(tasks), queue_file))
+
+        if CLUSTER:
+            # pack the tasks onto the nodes: every service job takes a node
+            # and runs as many workers as the stage profiles allow
+            for k in range(N_SERVICE_JOBS):
+                sp.call(cluster_utils.worker_service_call(queue_file, run_script.active_stages(),
+                    NODE_MEM_GB, NODE_CPUS, scheduler=SCHEDULER))
@@ -4,34 +4,58 @@ Actual script to perform LSd/TreeTime computations for a given set of parameters
 """
 import os, sys
 import utility_functions_simulated_data as utils_sim
+import utility_functions_cluster as cluster_utils
 
-if  __name__ == '__main__':
+GENERATE_SIMULATED_DATA = False
+RUN_TREETIME = False
+RUN_LSD = False
+RUN_BEAST = True
+# compare the reconstructed trees to the true tree (needs WRITE_ARCHIVE)
+RUN_TOPOLOGY = False
+# record the results also to the columnar archive (utility_functions_results.py)
+WRITE_ARCHIVE = True
 
-    GENERATE_SIMULATED_DATA = False
-    RUN_TREETIME = False
-    RUN_LSD = False
-    RUN_BEAST = True
+def active_stages():
+    """
+    Names of the stages enabled in this script (see utility_functions_cluster)
+    """
+    flags = [('ffpopsim', GENERATE_SIMULATED_DATA), ('treetime', RUN_TREETIME),
+             ('lsd', RUN_LSD), ('beast', RUN_BEAST),
+             ('topology', RUN_TOPOLOGY and WRITE_ARCHIVE)]
+    return [k for k, run in flags if run]
 
-    sys.stderr.write ("  ".join(sys.argv) + "\n")
+def main(argv):
+    """
+    Run the simulation and the TreeTime, LSD and BEAST inference for a single
+    point of the parameter space.
+
+    Args:
 
-    L = int(float(sys.argv[1]))
-    N = int(sys.argv[2])
-    SAMPLE_VOL = int (sys.argv[3])
-    SAMPLE_NUM = int(sys.argv[4])
-    SAMPLE_FREQ = int(sys.argv[5])
-    MU =  float(sys.argv[6])
-    res_dir = sys.argv[7]
-    suffix = sys.argv[8]
-    outfile_prefix = sys.argv[9]
+     - argv(list): the command line arguments (without the script name):
+     L, N, SAMPLE_VOL, SAMPLE_NUM, SAMPLE_FREQ, MU, res_dir, suffix and
+     outfile_prefix.
+    """
+
+    L = int(float(argv[0]))
+    N = int(argv[1])
+    SAMPLE_VOL = int (argv[2])
+    SAMPLE_NUM = int(argv[3])
+    SAMPLE_FREQ = int(argv[4])
+    MU =  float(argv[5])
+    res_dir = argv[6]
+    suffix = argv[7]
+    outfile_prefix = argv[8]
+    archive_dir = outfile_prefix + "_archive" if WRITE_ARCHIVE else None
 
     # run evolution simulation, produce basic tree and alignment
     if GENERATE_SIMULATED_DATA:
-        print ("Running FFpopSim")
-        basename = utils_sim.run_ffpopsim_simulation(L, N, SAMPLE_VOL, SAMPLE_NUM,
-                                SAMPLE_FREQ, MU, res_dir, suffix, optimize_branch_len=True)
+        with cluster_utils.stage_usage('ffpopsim'):
+            print ("Running FFpopSim")
+            basename = utils_sim.run_ffpopsim_simulation(L, N, SAMPLE_VOL, SAMPLE_NUM,
+                                    SAMPLE_FREQ, MU, res_dir, suffix, optimize_branch_len=True)
 
-        print ("Running FastTree reconstruction")
-        utils_sim.reconstruct_fasttree(basename, optimize_branch_len=False)
+            print ("Running FastTree reconstruction")
+            utils_sim.reconstruct_fasttree(basename, optimize_branch_len=False)
 
     else:  # use previously generated data
         label = "FFpopSim_L{}_N{}_Ns{}_Ts{}_Nv{}_Mu{}".format(str(L), str(N),
@@ -47,7 +71,9 @@ if  __name__ == '__main__':
             # run treetime for original tree:
             print ("Running TreeTime, {} tree".format ("FastTree" if fasttree else "Original"))
             outfile = outfile_prefix + "_treetime_{}res.csv".format("fasttree_" if fasttree else "")
-            utils_sim.run_treetime(basename, outfile, fasttree=fasttree, failed=None, max_iter=3, use_input_branch_length=True)
+            with cluster_utils.stage_usage('treetime'):
+                utils_sim.run_treetime(basename, outfile, fasttree=fasttree, failed=None, max_iter=3, use_input_branch_length=True,
+                    archive_dir=archive_dir)
 
     if RUN_LSD:
         # run LSD for original tree:
@@ -58,6 +84,7 @@ if  __name__ == '__main__':
         except:
             pass
 
+        lsd_jobs = []
         for fasttree in [True, False]:
             # file to store formatted results of LSD run
             print ("Running LSd, {} tree".format("FastTree" if fasttree else "Original"))
@@ -65,10 +92,28 @@ if  __name__ == '__main__':
             treefile = basename + ".ft.nwk" if fasttree else basename + ".opt.nwk"
             lsd_res_file = os.path.join(outfile_prefix + "_lsd", os.path.split(basename)[-1]) + "{}".format("_fasttree" if fasttree else "")
             lsd_dates_file = os.path.join(outfile_prefix + "_lsd", os.path.split(basename)[-1] + ".lsd_dates.txt")
-            utils_sim.run_lsd(treefile, lsd_dates_file, lsd_res_file, outfile)
+            lsd_jobs.append((treefile, lsd_dates_file, lsd_res_file, outfile))
+        # both trees are processed in parallel
+        with cluster_utils.stage_usage('lsd'):
+            utils_sim.run_lsd_trees(lsd_jobs, archive_dir=archive_dir)
 
     if RUN_BEAST:
         # run BEAST for the original tree:
         print ("Running BEAST, FastTree tree")
         outfile = outfile_prefix + "_beast_res.csv"
-        utils_sim.run_beast(basename, out_dir=outfile_prefix+"_beast", res_file=outfile, fast_tree=True)
+        with cluster_utils.stage_usage('beast'):
+            utils_sim.run_beast(basename, out_dir=outfile_prefix+"_beast", res_file=outfile, fast_tree=True,
+                archive_dir=archive_dir)
+
+    if RUN_TOPOLOGY and archive_dir is not None:
+        # RF and KF distances of the FastTree, TreeTime and BEAST trees
+        import utility_functions_topology as topology_utils
+        print ("Comparing the tree topologies")
+        with cluster_utils.stage_usage('topology'):
+            topology_utils.record_topology(basename, archive_dir, beast_dir=outfile_prefix + "_beast")
+
+if  __name__ == '__main__':
+
+    sys.stderr.write ("  ".join(sys.argv) + "\n")
+
+    main(sys.argv[1:])
@@ -12,10 +12,28 @@ commented, which can be used to perform computations on a local machine.
 import sys, os
 import subprocess as sp
 sys.path.append("./")
+import utility_functions_cluster as cluster_utils
+import generate_simulated_dataset_run as run_script
 
 if __name__ == '__main__':
 
     CLUSTER = False
+    # cluster scheduler: 'sge' (qsub) or 'slurm' (sbatch)
+    SCHEDULER = 'sge'
+    # put the tasks to the queue of the worker service (run_worker_service.py)
+    # instead of starting a separate process for every task
+    WORKER_SERVICE = False
+    queue_file = "./simulated_data/tasks.sqlite"
+    # submit all tasks as a single array job (CLUSTER on) instead of one job
+    # per task. The parameter grid is written to the task file.
+    ARRAY_JOB = False
+    task_file = "./simulated_data/tasks.txt"
+    # run the cluster calls with the local stand-in scheduler (fake_scheduler.py)
+    FAKE_SCHEDULER = False
+    # cluster nodes to run the worker service (CLUSTER and WORKER_SERVICE on)
+    N_SERVICE_JOBS = 4
+    NODE_MEM_GB = 64
+    NODE_CPUS = 16
 
     # Directory to store results (FFPOPsim simulations, fasttree reconstruction, treetime trees)
     res_dir = "./simulated_data/dataset"
@@ -38,37 +56,62 @@ if __name__ == '__main__':
 
     # run treetime in-place:
     Ncalls = 0
+    tasks = []
     for MU in MUS:
         for SAMPLE_FREQ in SAMPLE_FREQS:
             for i in xrange(N_0, N_0 + N_POINTS):
                 suffix = str(i)
 
+                arguments = [str(L),
+                            str(N),
+                            str(SAMPLE_VOL),
+                            str(SAMPLE_NUM),
+                            str(SAMPLE_FREQ),
+                            str(MU),
+                            res_dir,
+                            suffix,
+                            outfile]
+                if WORKER_SERVICE or (CLUSTER and ARRAY_JOB):
+                    tasks.append(arguments)
+                    continue
+
                 Ncalls += 1
                 if Ncalls > 3000:
                     print ("Number of jobs exceeded")
                     break
 
                 if CLUSTER:
-                    call = ['qsub', '-cwd', '-b','y',
-                           '-l', 'h_rt=23:59:0', # BEAST might run long
-                              #'-o', './stdout.txt',
-                              #'-e', './stderr.txt',
-                            '-l', 'h_vmem=50G', # BEAST requires A LOT
-                             './generate_simulated_dataset_run.py']
+                    # runtime and memory are set by the resource profiles of
+                    # the stages enabled in the run script (BEAST requires A LOT)
+                    call = cluster_utils.submit_call('./generate_simulated_dataset_run.py',
+                        run_script.active_stages(), scheduler=SCHEDULER)
+                    if FAKE_SCHEDULER:
+                        call = ['./fake_scheduler.py'] + call
                 else:
                     call = ['./generate_simulated_dataset_run.py']
 
                 # run computations on a cluster
-
-                arguments = [str(L),
-                            str(N),
-                            str(SAMPLE_VOL),
-                            str(SAMPLE_NUM),
-                            str(SAMPLE_FREQ),
-                            str(MU),
-                            res_dir,
-                            suffix,
-                            outfile]
                 call.extend(arguments)
 
                 sp.call(call)
+
+    if CLUSTER and ARRAY_JOB and not WORKER_SERVICE:
+        # single array job, every task reads its parameters from the task file
+        n_tasks = cluster_utils.write_task_file(task_file, 'simulated', tasks)
+        call = cluster_utils.array_job_call(task_file, n_tasks,
+            run_script.active_stages(), scheduler=SCHEDULER)
+        if FAKE_SCHEDULER:
+            call = ['./fake_scheduler.py'] + call
+        sp.call(call)
+
+    if WORKER_SERVICE:
+        import utility_functions_queue as queue_utils
+        queue_utils.enqueue_tasks(queue_file, 'simulated', tasks)
+        print ("{} tasks added to the queue {}".format(len(tasks), queue_file))
+
+        if CLUSTER:
+            # pack the tasks onto the nodes: every service job takes a node
+            # and runs as many workers as the stage profiles allow
+            for k in range(N_SERVICE_JOBS):
+                sp.call(cluster_utils.worker_service_call(queue_file, run_script.active_stages(),
+                    NODE_MEM_GB, NODE_CPUS, scheduler=SCHEDULER))
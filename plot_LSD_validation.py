@@ -87,8 +87,7 @@ for rate_type in ["strict", "relaxed"]:
             tick_label.set_fontsize(tick_fs)
 
     if save_fig:
-        for fmt in ['pdf', 'png', 'svg']:
-            fig.savefig("./figs/LSD_data_%s_%s_Mu.%s"%(data_set, rate_type, fmt))
+        save_figure(fig, "./figs/LSD_data_%s_%s_Mu"%(data_set, rate_type))
 
     tmp = {'TT':TT_data[label][:,1],
             'BSMC':TMRCAs[(rate_type, "BSMC", "True\ntopology")]}
@@ -111,8 +110,7 @@ for rate_type in ["strict", "relaxed"]:
             tick_label.set_fontsize(tick_fs)
 
     if save_fig:
-        for fmt in ['pdf', 'png', 'svg']:
-            fig.savefig("./figs/LSD_data_%s_%s_Tmrca.%s"%(data_set, rate_type, fmt))
+        save_figure(fig, "./figs/LSD_data_%s_%s_Tmrca"%(data_set, rate_type))
 
 
 
@@ -2,9 +2,17 @@ import matplotlib.pyplot as plt
 import numpy as np
 import seaborn as sns
 import matplotlib
+import os
+import json
+import hashlib
+import inspect
 
 formats = ['svg', 'pdf', 'png']
 
+# hashes of the inputs of the figures produced by build_figure, stored in the
+# output directory of the figures
+figure_cache_name = ".figure_inputs.json"
+
 colors = sns.color_palette(n_colors=6)
 sns.set_style('whitegrid')
 sns.set_context('paper')
@@ -34,5 +42,178 @@ def shift_point_by_markersize(axes, x, y, markersize):
     res = inv.transform(pixels+(markersize/2,0))
     return res[:,0], res[:, 1]
 
+def inputs_hash(inputs, params=None, sources=None):
+    """
+    Hash of the figure inputs: the contents of the input files (all files in
+    case of a directory), the plot parameters and the plotting code.
+
+    Args:
+
+     - inputs(list): paths to the input files or directories
+
+     - params(dict or None): parameters of the figure (e.g. T_over_N). Their
+     string representation is hashed.
+
+     - sources(list or None): source files of the plotting code
+    """
+    sha = hashlib.sha1()
+    files = []
+    for path in sorted(inputs):
+        if os.path.isdir(path):
+            for folder, subdirs, fnames in os.walk(path):
+                subdirs.sort()
+                files.extend(os.path.join(folder, k) for k in sorted(fnames))
+        else:
+            files.append(path)
+    files.extend(sorted(set(sources or [])))
+
+    for fname in files:
+        sha.update(fname.encode('utf-8'))
+        if not os.path.exists(fname):
+            sha.update(b"missing")
+            continue
+        with open(fname, 'rb') as inf:
+            for block in iter(lambda: inf.read(1 << 20), b""):
+                sha.update(block)
+    if params is not None:
+        sha.update(repr(sorted(params.items())).encode('utf-8'))
+    return sha.hexdigest()
+
+def _save_format(args):
+    """
+    Render the pickled figure to a single format. Called in the worker process,
+    which uses the non-interactive backend.
+    """
+    import pickle
+    fig_pickle, fname = args
+    plt.switch_backend('Agg')
+    fig = pickle.loads(fig_pickle)
+    fig.savefig(fname)
+    plt.close(fig)
+    return fname
+
+def save_figure(fig, figname, fmts=None, n_jobs=None):
+    """
+    Save the figure in all formats. The formats are rendered in parallel worker
+    processes. If the figure cannot be pickled, the formats are saved one after
+    another.
+
+    Args:
+
+     - fig(matplotlib.figure.Figure): the figure
+
+     - figname(str): path to the output file, without the extension
+
+     - fmts(list or None): formats to save, by default all formats from the
+     module-level list
+
+     - n_jobs(int or None): number of the worker processes, by default one per
+     format
+    """
+    import pickle
+    import multiprocessing
+    fmts = formats if fmts is None else fmts
+    fnames = ["{}.{}".format(figname, fmt) for fmt in fmts]
+    folder = os.path.split(figname)[0]
+    if folder != "" and not os.path.exists(folder):
+        os.makedirs(folder)
+
+    try:
+        fig_pickle = pickle.dumps(fig, protocol=2)
+    except Exception:
+        fig_pickle = None
+
+    if fig_pickle is None or len(fnames) < 2 or n_jobs == 1:
+        for fname in fnames:
+            fig.savefig(fname)
+        return fnames
+
+    pool = multiprocessing.Pool(min(len(fnames), n_jobs or len(fnames)))
+    try:
+        pool.map(_save_format, [(fig_pickle, fname) for fname in fnames])
+    finally:
+        pool.close()
+        pool.join()
+    return fnames
+
+def _figure_cache_file(figname):
+    """
+    Path to the hash file in the output directory of the figure
+    """
+    return os.path.join(os.path.split(figname)[0], figure_cache_name)
+
+def _read_figure_cache(cache_file):
+    if not os.path.exists(cache_file):
+        return {}
+    try:
+        with open(cache_file) as inf:
+            return json.load(inf)
+    except ValueError:
+        return {}
+
+def _plot_sources(plot_function):
+    """
+    Source files of the plotting code: the module of the plot function and
+    this module
+    """
+    sources = [inspect.getsourcefile(_plot_sources)]
+    try:
+        sources.append(inspect.getsourcefile(plot_function))
+    except TypeError:
+        # builtins and callable objects without the source
+        module = inspect.getmodule(plot_function)
+        if module is not None and getattr(module, '__file__', None):
+            sources.append(inspect.getsourcefile(module))
+    return [os.path.abspath(k) for k in sources if k is not None]
+
+def build_figure(figname, inputs, plot_function, params=None, fmts=None, force=False, n_jobs=None):
+    """
+    Produce the figure only if its inputs or the plotting code (the module of
+    the plot_function and plot_defaults.py) have changed since it was produced
+    last time (or if any of the output files is missing). The hashes are stored
+    in the .figure_inputs.json file in the output directory.
+
+    Args:
+
+     - figname(str): path to the output file, without the extension
+
+     - inputs(list): input files (or directories) of the figure, e.g. the CSV
+     files with the results
+
+     - plot_function(callable): function without arguments, which reads the
+     inputs, creates and returns the figure
+
+     - params(dict or None): parameters of the figure, which affect the plot
+     (changing them also triggers the re-rendering)
+
+     - fmts(list or None), n_jobs(int or None): see save_figure
+
+     - force(bool): produce the figure regardless of the inputs
+
+    Returns:
+
+     - rendered(bool): True if the figure was produced, False if it was up to
+     date
+    """
+    fmts = formats if fmts is None else fmts
+    digest = inputs_hash(inputs, params, sources=_plot_sources(plot_function))
+    cache_file = _figure_cache_file(figname)
+    up_to_date = _read_figure_cache(cache_file).get(figname) == digest and \
+        all(os.path.exists("{}.{}".format(figname, fmt)) for fmt in fmts)
+    if up_to_date and not force:
+        print ("Figure {} is up to date".format(figname))
+        return False
+
+    fig = plot_function()
+    save_figure(fig, figname, fmts=fmts, n_jobs=n_jobs)
+    plt.close(fig)
+
+    # re-read the cache: other figures might have been built meanwhile
+    cache = _read_figure_cache(cache_file)
+    cache[figname] = digest
+    with open(cache_file, 'w') as of:
+        json.dump(cache, of, indent=1, sort_keys=True)
+    return True
+
 if __name__ == '__main__':
     pass
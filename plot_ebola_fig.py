@@ -89,8 +89,7 @@ if __name__ == '__main__':
     axs[1].legend(fontsize=legend_fs, loc=1)
     plt.tight_layout()
 
-    for fmt in formats:
-        plt.savefig('figs/ebola.'+fmt)
+    save_figure(fig, 'figs/ebola')
 
 
 
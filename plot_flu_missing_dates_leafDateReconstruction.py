@@ -6,18 +6,71 @@ import pandas
 from scipy.interpolate import interp1d
 from plot_defaults import *
 
+DATES_COLUMNS = ['tree_name', 'known_frac', 'Tmrca', 'Date_sim','Date_given','dT']
+DATES_DTYPES = {'tree_name': str, 'known_frac': np.float64, 'Tmrca': np.float64,
+                'Date_sim': np.float64, 'Date_given': np.float64, 'dT': np.float64}
+
 def read_dates_stat(inf):
-    cols=['tree_name', 'known_frac', 'Tmrca', 'Date_sim','Date_given','dT']
-    df = pandas.read_csv(inf, names=cols,header=0)
+    df = pandas.read_csv(inf, names=DATES_COLUMNS, dtype=DATES_DTYPES, comment='#')
     return df
 
-def make_dates_pivot(df):
+def _read_dates_chunks(inf, chunksize):
+    """
+    Iterate over the known dates fractions and the leaf date errors of the
+    results file, chunk by chunk. Other columns are not parsed.
+    """
+    reader = pandas.read_csv(inf, names=DATES_COLUMNS, usecols=['known_frac', 'dT'],
+        dtype={'known_frac': np.float64, 'dT': np.float64}, comment='#',
+        chunksize=chunksize)
+    for chunk in reader:
+        chunk = chunk[np.isfinite(chunk['dT'].values)]
+        yield chunk['known_frac'].values, chunk['dT'].values
+
+def read_dates_hist(inf, bins=20, chunksize=100000):
+    """
+    Read the leaf dates reconstruction results and bin the leaf date errors
+    into the histograms, one per known dates fraction. The file (one line per
+    leaf) is read in chunks in two passes: the first pass finds the range of
+    the errors for every fraction, the second one fills the histograms. The
+    full per-leaf table is never kept in memory.
+
+    Args:
+
+     - inf(str): path to the leaf dates results file
+
+     - bins(int): number of the histogram bins per fraction
+
+     - chunksize(int): number of the lines to read at once
+
+    Returns:
+
+     - hists(dict): {fraction: (counts, bin edges)}
+    """
+    ranges = {}
+    for fracs, dT in _read_dates_chunks(inf, chunksize):
+        for frac in np.unique(fracs):
+            vals = dT[fracs == frac]
+            lo, hi = ranges.get(frac, (vals.min(), vals.max()))
+            ranges[frac] = (min(lo, vals.min()), max(hi, vals.max()))
+
+    hists = {frac: (np.zeros(bins, dtype=int), np.histogram([], bins=bins, range=rng)[1])
+             for frac, rng in ranges.items()}
+    for fracs, dT in _read_dates_chunks(inf, chunksize):
+        for frac in np.unique(fracs):
+            counts, edges = hists[frac]
+            counts += np.histogram(dT[fracs == frac], bins=edges)[0]
+    return hists
+
+def make_dates_pivot(hists):
+    """
+    Make the table of the normalized leaf date error distributions from the
+    histograms (see read_dates_hist).
+    """
     res = pandas.DataFrame()
-    fracs = np.unique(df['known_frac'])
+    fracs = np.sort(list(hists.keys()))
     print (fracs)
     for frac in fracs:
-        idxs = df['known_frac'] == frac
-        y, x = np.histogram(df['dT'][idxs],bins=20)
+        y, x = hists[frac]
         res["F_{}_x".format(frac)] = 0.5*(x[:-1]+x[1:])
         res["F_{}_y".format(frac)] = 1. * y / y.max()
     return res
@@ -77,8 +130,7 @@ def plot_date_dists(res, label="", figname=None, idx=[0.05, 0.2, 0.4, 0.8]):
             label.set_fontsize(tick_fs)
 
     if figname is not None:
-        for fmt in formats:
-            fig.savefig("{}.{}".format(figname, fmt))
+        save_figure(fig, figname)
 
 if __name__ == '__main__':
 
@@ -90,10 +142,10 @@ if __name__ == '__main__':
     leaf_dates_file = './flu_H3N2/missing_dates/treetime_dates_res.csv'
 
     ##
-    ## Read the leaf dates file, make pivot table:
+    ## Read the leaf dates file into the histograms, make pivot table:
     ##
     print ("Plotting the results")
-    dataframe = make_dates_pivot(read_dates_stat(leaf_dates_file))
+    dataframe = make_dates_pivot(read_dates_hist(leaf_dates_file))
 
     ##
     ## Plot the leaf dates distribution
@@ -1,4 +1,3 @@
-import numpy as np
 from Bio import AlignIO, Phylo
 from Bio.Align import  MultipleSeqAlignment
 import random
@@ -15,6 +14,7 @@ from scipy.interpolate import interp1d
 from plot_defaults import shift_point_by_markersize
 import utility_functions_beast as beast_utils
 import utility_functions_flu as flu_utils
+import utility_functions_stats as stats_utils
 
 def read_treetime_csv(inf):
     cols = ['File', 'Frac', 'Tmrca', 'Mu', 'Mu_R2', 'Internal_R2', 'Runtime']
@@ -27,55 +27,31 @@ def read_beast_csv(fname):
     return df
 
 def make_results_pivot(df):
-
-    fs = np.unique(df['Frac'])
-    fs = fs[fs >= 0.1]
-    Tmrca = []
-    Tmrca_err = []
-    Mu = []
-    Mu_err = []
-    R2 = []
-    R2_err = []
-
-    for frac in fs:
-        idxs = df['Frac'] == frac
-        if idxs.sum() < 10:
-            continue
-
-        Tmrca.append((df['Tmrca'][idxs]).mean())
-        Tmrca_err.append((df['Tmrca'][idxs]).std())
-        Mu.append((df['Mu'][idxs]).mean())
-        Mu_err.append((df['Mu'][idxs]).std())
-        R2.append((df['Mu_R2'][idxs]).mean())
-        R2_err.append((df['Mu_R2'][idxs]).std())
-
+    # only the fractions with enough data points
+    df = df[df['Frac'] >= 0.1]
+    stats = stats_utils.group_stats(df, 'Frac', ['Tmrca', 'Mu', 'Mu_R2'],
+        stats=['mean', 'std'], ddof=1, min_count=10)
     res = pandas.DataFrame(
-        {'Frac': fs,
-         'Tmrca': Tmrca,
-         'Tmrca_err': Tmrca_err,
-         'Mu': Mu,
-         'Mu_err': Mu_err,
-         'R2': R2,
-         'R2_err': R2_err})
+        {'Frac': stats['Frac'],
+         'Tmrca': stats['Tmrca_mean'],
+         'Tmrca_err': stats['Tmrca_std'],
+         'Mu': stats['Mu_mean'],
+         'Mu_err': stats['Mu_std'],
+         'R2': stats['Mu_R2_mean'],
+         'R2_err': stats['Mu_R2_std']})
     return res
 
 def make_beast_pivot(beast_res):
 
-    out_Ns = np.unique(beast_res['Frac'])
+    stats = stats_utils.group_stats(beast_res, 'Frac', ['Tmrca', 'Mu', 'LH'], stats=['mean', 'std'])
     out = pandas.DataFrame({
-        "Frac" : out_Ns,
-        "Tmrca" : [np.mean(beast_res[beast_res['Frac'] == x]['Tmrca'])
-                            for x in out_Ns],
-        "Tmrca_err" : [np.std(beast_res[beast_res['Frac'] == x]['Tmrca'])
-                            for x in out_Ns],
-        "Mu" : [np.mean(beast_res[beast_res['Frac'] == x]['Mu'])
-                            for x in out_Ns],
-        "Mu_err" : [np.std(beast_res[beast_res['Frac'] == x]['Mu'])
-                            for x in out_Ns],
-        "LH" : [np.mean(beast_res[beast_res['Frac'] == x]['LH'])
-                            for x in out_Ns],
-        "LH_err" : [np.std(beast_res[beast_res['Frac'] == x]['LH'])
-                            for x in out_Ns],
+        "Frac" : stats['Frac'],
+        "Tmrca" : stats['Tmrca_mean'],
+        "Tmrca_err" : stats['Tmrca_std'],
+        "Mu" : stats['Mu_mean'],
+        "Mu_err" : stats['Mu_std'],
+        "LH" : stats['LH_mean'],
+        "LH_err" : stats['LH_std'],
         })
     return out
 
@@ -118,8 +94,8 @@ def plot_results(what, treetime=None, beast=None, figname=None):
             label.set_fontsize(tick_fs)
 
     if figname is not None:
-        for fmt in formats:
-            fig.savefig("{}.{}".format(figname, fmt))
+        save_figure(fig, figname)
+    return fig
 
 if __name__ == '__main__':
 
@@ -132,16 +108,21 @@ if __name__ == '__main__':
     treetime_csv = "./flu_H3N2/missing_dates/treetime_res.csv"
 
     ##
-    ## Read results, create pivot tables:
-    ##
-    beast_pivot = make_beast_pivot(read_beast_csv(beast_csv))
-    treetime_pivot = make_results_pivot(read_treetime_csv(treetime_csv))
-
-    ##
-    ## Plot the results:
+    ## Read results, create pivot tables, plot the results. The figures are
+    ## re-rendered only if the results have changed since the last run:
     ##
-    plot_results('Tmrca', treetime=treetime_pivot, beast=beast_pivot,
-        figname="./figs/fluH3N2_missingDates_100seqs" if SAVE_FIG else None)
-
-    plot_results('Mu', treetime=treetime_pivot, beast=beast_pivot,
-        figname="./figs/fluH3N2_missingDates_100seqs" if SAVE_FIG else None)
+    pivots = {}
+    def read_pivots():
+        if not pivots:
+            pivots['beast'] = make_beast_pivot(read_beast_csv(beast_csv))
+            pivots['treetime'] = make_results_pivot(read_treetime_csv(treetime_csv))
+        return pivots
+
+    for what in ['Tmrca', 'Mu']:
+        plot = lambda what=what: plot_results(what, treetime=read_pivots()['treetime'],
+            beast=read_pivots()['beast'])
+        if SAVE_FIG:
+            build_figure("./figs/fluH3N2_missingDates_100seqs_{}".format(what),
+                [beast_csv, treetime_csv], plot)
+        else:
+            plot()
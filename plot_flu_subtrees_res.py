@@ -8,148 +8,102 @@ import os
 
 import utility_functions_flu as flu_utils
 import utility_functions_beast as beast_utils
+import utility_functions_stats as stats_utils
 
 from plot_defaults import *
 
+LSD_COLUMNS = ['File', 'N', 'Tmrca_sim', 'mu_sim', 'Runtime', 'objective']
+TREETIME_COLUMNS = ['File', 'N', "Tmrca_sim", "mu_sim", "R2_leaves", "R2_internal", "Runtime"]
+BEAST_COLUMNS = ['File', 'N', 'LH', 'LH_std', 'Tmrca', 'Tmrca_std', 'Mu', 'Mu_std']
+
 ##  Read datasets as-is
 def read_lsd_dataset(fname):
     """
     TODO
     """
-    lsd_cols = ['File', 'N', 'Tmrca_sim', 'mu_sim', 'Runtime', 'objective']
-    lsd_df = pandas.read_csv(fname, names=lsd_cols, header=0)
+    lsd_df = pandas.read_csv(fname, names=LSD_COLUMNS, header=0)
     return lsd_df
 
 def read_treetime_dataset(fname):
     """
     TODO
     """
-    cols = ['File', 'N', "Tmrca_sim", "mu_sim", "R2_leaves", "R2_internal", "Runtime"]
-    df = pandas.read_csv(fname, names=cols,header=0)
+    df = pandas.read_csv(fname, names=TREETIME_COLUMNS,header=0)
     return df
 
 def read_beast_dataset(fname):
     """
     TODO
     """
-    cols = ['File', 'N', 'LH', 'LH_std', 'Tmrca', 'Tmrca_std', 'Mu', 'Mu_std']
-    df = pandas.read_csv(fname, names=cols,header=0)
+    df = pandas.read_csv(fname, names=BEAST_COLUMNS,header=0)
     return df
 
-def IQD(a):
-    from scipy.stats import scoreatpercentile
-    return scoreatpercentile(a,75) - scoreatpercentile(a,25)
-
-def make_beast_pivot(df):
-
-    Tmrca_median = []
-    Tmrca_err = []
-    LH_median = []
-    LH_err = []
-    Mu_median = []
-    Mu_err = []
-
-    Ns = df["N"].unique()
-
-    Nsidx = np.ones(Ns.shape, dtype=bool)
-    for idx, N in enumerate(Ns):
-        Nidx = df["N"] == N
-        if Nidx.sum() == 0:
-            Nsidx[idx] = False
-            continue
-        Tmrca_median.append(df[Nidx]["Tmrca"].median())
-        Tmrca_err.append(IQD(df[Nidx]["Tmrca"]))
-        Mu_median.append(df[Nidx]["Mu"].median())
-        Mu_err.append(IQD(df[Nidx]["Mu"]))
-        LH_median.append(df[Nidx]["LH"].median())
-        LH_err.append(IQD(df[Nidx]["LH"]))
-
-    res = pandas.DataFrame({
-        "Ns" : Ns[Nsidx],
-        "Tmrca_median" : Tmrca_median,
-        "Tmrca_err" : Tmrca_err,
-        "Mu_median" : Mu_median,
-        "Mu_err" : Mu_err,
-        "LH_median" : LH_median,
-        "LH_err" : LH_err
-        })
+def _median_iqd_pivot(df, columns, n_boot=0):
+    """
+    Median and inter-quartile distance of the given columns for every subtree
+    size (see utility_functions_stats.py).
+
+    Args:
+     - df: results table with the 'N' column
+
+     - columns: dictionary {output name: input column}
 
+     - n_boot: if positive, number of the bootstrap resamplings to compute the
+     confidence intervals of the medians and IQDs
+
+    Returns:
+     - res: table with the 'Ns', '<name>_median' and '<name>_err' columns. With
+     the bootstrap, also the '_lo', '_hi' and '_bias' columns for each of them.
+    """
+    if n_boot > 0:
+        stats = stats_utils.group_bootstrap(df, 'N', columns.values(), stats=['median', 'iqr'], n_boot=n_boot)
+    else:
+        stats = stats_utils.group_stats(df, 'N', columns.values(), stats=['median', 'iqr'])
+    res = pandas.DataFrame({"Ns" : stats['N']})
+    for name, column in columns.items():
+        for stat, out in [("median", "_median"), ("iqr", "_err")]:
+            for suffix in (["", "_lo", "_hi", "_bias"] if n_boot > 0 else [""]):
+                res[name + out + suffix] = stats[column + "_" + stat + suffix]
     return res
 
-def make_treetime_pivot(df):
-
-    Tmrca_median = []
-    Tmrca_err = []
-    Mu_median = []
-    Mu_err = []
-    Runtime_median = []
-    Runtime_err = []
-
-    Ns = df["N"].unique()
-
-    Nsidx = np.ones(Ns.shape, dtype=bool)
-    for idx, N in enumerate(Ns):
-        Nidx = df["N"] == N
-        if Nidx.sum() == 0:
-            Nsidx[idx] = False
-            continue
-        Tmrca_median.append(df[Nidx]["Tmrca_sim"].median())
-        Tmrca_err.append(IQD(df[Nidx]["Tmrca_sim"]))
-        Mu_median.append(df[Nidx]["mu_sim"].median())
-        Mu_err.append(IQD(df[Nidx]["mu_sim"]))
-        Runtime_median.append(df[Nidx]["Runtime"].median())
-        Runtime_err .append(IQD(df[Nidx]["Runtime"]))
-
-    res = pandas.DataFrame({
-        "Ns" : Ns[Nsidx],
-        "Tmrca_median" : Tmrca_median,
-        "Tmrca_err" : Tmrca_err,
-        "Mu_median" : Mu_median,
-        "Mu_err" : Mu_err,
-        "Runtime_median" : Runtime_median,
-        "Runtime_err" : Runtime_err
-        })
+def _incremental_median_iqd_pivot(fname, csv_columns, columns, checkpoint_dir):
+    """
+    Same as _median_iqd_pivot, but reads only the results appended to the file
+    since the previous call. The statistics are kept in the checkpoint file in
+    the checkpoint_dir (see IncrementalPivot in the utility_functions_stats.py).
+    """
+    if not os.path.exists(checkpoint_dir):
+        os.makedirs(checkpoint_dir)
+    checkpoint = os.path.join(checkpoint_dir, os.path.split(fname)[-1] + ".pivot.pkl")
+    agg = stats_utils.incremental_pivot(checkpoint, [fname], csv_columns, 'N', columns.values())
+    stats = agg.pivot(stats=['median', 'iqr'])
+    res = pandas.DataFrame({"Ns" : stats['N']})
+    for name, column in columns.items():
+        res[name + "_median"] = stats[column + "_median"]
+        res[name + "_err"] = stats[column + "_iqr"]
     return res
 
-def make_lsd_pivot(df):
-
-    Tmrca_median = []
-    Tmrca_err = []
-    Mu_median = []
-    Mu_err = []
-    Runtime_median = []
-    Runtime_err = []
-
-    Ns = df["N"].unique()
-    Nsidx = np.ones(Ns.shape, dtype=bool)
-
-    for idx, N in enumerate(Ns):
-        Nidx = df["N"] == N
-        if Nidx.sum() == 0:
-            Nsidx[idx] = False
-            continue
-
-        Tmrca_median.append(df[Nidx]["Tmrca_sim"].median())
-        Tmrca_err.append(IQD(df[Nidx]["Tmrca_sim"]))
-        Mu_median.append(df[Nidx]["mu_sim"].median())
-        Mu_err.append(IQD(df[Nidx]["mu_sim"]))
-        Runtime_median.append(df[Nidx]["Runtime"].median())
-        Runtime_err .append(IQD(df[Nidx]["Runtime"]))
-
-    res = pandas.DataFrame({
-        "Ns" : Ns[Nsidx],
-        "Tmrca_median" : Tmrca_median,
-        "Tmrca_err" : Tmrca_err,
-        "Mu_median" : Mu_median,
-        "Mu_err" : Mu_err,
-        "Runtime_median" : Runtime_median,
-        "Runtime_err" : Runtime_err
-        })
+def make_beast_pivot(df, n_boot=0):
+    return _median_iqd_pivot(df, {"Tmrca" : "Tmrca", "Mu" : "Mu", "LH" : "LH"}, n_boot=n_boot)
 
-    return res
+def make_treetime_pivot(df, n_boot=0):
+    return _median_iqd_pivot(df, {"Tmrca" : "Tmrca_sim", "Mu" : "mu_sim", "Runtime" : "Runtime"}, n_boot=n_boot)
+
+def make_lsd_pivot(df, n_boot=0):
+    return _median_iqd_pivot(df, {"Tmrca" : "Tmrca_sim", "Mu" : "mu_sim", "Runtime" : "Runtime"}, n_boot=n_boot)
 
 ## Plot statistics
-def plot_res(what, tt=None, lsd=None, beast=None, save=True, suffix=None, scatter_points=True, **kwargs):
+def _plot_ci(axes, x, pivot, column, color):
+    """
+    Shade the bootstrap confidence interval of the pivot values (if computed,
+    see the n_boot argument of the pivot functions)
+    """
+    if column + "_lo" not in pivot:
+        return
+    axes.fill_between(np.asarray(x), pivot[column + "_lo"].values, pivot[column + "_hi"].values,
+        color=color, alpha=0.2, lw=0)
+
+def plot_res(what, tt=None, lsd=None, beast=None, save=True, suffix=None, scatter_points=True, ci=False, **kwargs):
 
     if what == 'Tmrca':
         median = 'Tmrca_median'
@@ -178,6 +132,8 @@ def plot_res(what, tt=None, lsd=None, beast=None, save=True, suffix=None, scatte
         else:
             x, y = tt['Ns'], tt[median]
         axes.errorbar(x, y, tt[err]/2, markersize=markersize, marker='o', c=tt_color, label='TreeTime')
+        if ci:
+            _plot_ci(axes, x, tt, median, tt_color)
 
     if lsd is not None:
         if scatter_points:
@@ -185,6 +141,8 @@ def plot_res(what, tt=None, lsd=None, beast=None, save=True, suffix=None, scatte
         else:
             x, y = lsd['Ns'], lsd[median]
         axes.errorbar(x, y, lsd[err]/2, markersize=markersize, marker='o', c=lsd_color, label='LSD')
+        if ci:
+            _plot_ci(axes, x, lsd, median, lsd_color)
 
     if beast is not None:
         #  beast points stay in the center
@@ -194,6 +152,8 @@ def plot_res(what, tt=None, lsd=None, beast=None, save=True, suffix=None, scatte
         # else:
         #     x, y = beast['Ns'], beast[median]
         axes.errorbar(x, y, beast[err]/2, markersize=markersize, marker='o', c=beast_color, label='BEAST')
+        if ci:
+            _plot_ci(axes, x, beast, median, beast_color)
 
     axes.grid('on')
     axes.legend(loc=0,fontsize=legend_fs)
@@ -208,9 +168,8 @@ def plot_res(what, tt=None, lsd=None, beast=None, save=True, suffix=None, scatte
             label.set_fontsize(tick_fs)
 
     if save:
-        fig.savefig("./figs/fluH3N2_subtrees_{}.svg".format(what))
-        fig.savefig("./figs/fluH3N2_subtrees_{}.png".format(what))
-        fig.savefig("./figs/fluH3N2_subtrees_{}.pdf".format(what))
+        save_figure(fig, "./figs/fluH3N2_subtrees_{}".format(what))
+    return fig
 
 if __name__ == "__main__":
 
@@ -218,6 +177,12 @@ if __name__ == "__main__":
     PLOT_LSD = True
     PLOT_BEAST = True
     SAVE_FIG=True
+    # number of the bootstrap resamplings to show the confidence intervals of
+    # the medians (0 - no confidence intervals)
+    N_BOOTSTRAP = 0
+    # update the pivots only with the results appended since the previous run
+    # (to follow the running computations). NOTE no bootstrap in this mode.
+    INCREMENTAL = False
 
     ##
     ##  Specify location of the CSV tables with results
@@ -226,31 +191,54 @@ if __name__ == "__main__":
     treetime_res_file = os.path.join(res_dir, 'treetime_res.csv')
     lsd_res_file = os.path.join(res_dir, 'lsd_res.csv')
     beast_res_file = os.path.join(res_dir, 'beast_res.csv')
+    checkpoint_dir = os.path.join(res_dir, 'pivot_checkpoints')
+
+
+    def read_pivots():
+        """
+        Read datasets and make pivot tables. The pivots are made once and
+        shared by the figures.
+        """
+        if pivots:
+            return pivots
+
+        if PLOT_TREETIME and INCREMENTAL:
+            pivots['tt'] = _incremental_median_iqd_pivot(treetime_res_file, TREETIME_COLUMNS,
+                {"Tmrca" : "Tmrca_sim", "Mu" : "mu_sim", "Runtime" : "Runtime"}, checkpoint_dir)
+        elif PLOT_TREETIME:
+            pivots['tt'] = make_treetime_pivot(read_treetime_dataset(treetime_res_file), n_boot=N_BOOTSTRAP)
+        else:
+            pivots['tt'] = None
 
+        if PLOT_LSD and INCREMENTAL:
+            pivots['lsd'] = _incremental_median_iqd_pivot(lsd_res_file, LSD_COLUMNS,
+                {"Tmrca" : "Tmrca_sim", "Mu" : "mu_sim", "Runtime" : "Runtime"}, checkpoint_dir)
+        elif PLOT_LSD:
+            pivots['lsd'] = make_lsd_pivot(read_lsd_dataset(lsd_res_file), n_boot=N_BOOTSTRAP)
+        else:
+            pivots['lsd'] = None
 
-    ##
-    ## Read datasets and make pivot tablespivots
-    ##
-    if PLOT_TREETIME:
-        tt_df = make_treetime_pivot(read_treetime_dataset(treetime_res_file))
-        tt_df = tt_df.sort(columns='Ns')
-    else:
-        tt_df = None
-
-    if PLOT_LSD:
-        lsd_df = make_lsd_pivot(read_lsd_dataset(lsd_res_file))
-        lsd_df = lsd_df.sort(columns='Ns')
-    else:
-        lsd_df = None
-
-    if PLOT_BEAST:
-        beast =   make_beast_pivot(read_beast_dataset(beast_res_file))
-    else:
-        beast=None
+        if PLOT_BEAST and INCREMENTAL:
+            pivots['beast'] = _incremental_median_iqd_pivot(beast_res_file, BEAST_COLUMNS,
+                {"Tmrca" : "Tmrca", "Mu" : "Mu", "LH" : "LH"}, checkpoint_dir)
+        elif PLOT_BEAST:
+            pivots['beast'] = make_beast_pivot(read_beast_dataset(beast_res_file), n_boot=N_BOOTSTRAP)
+        else:
+            pivots['beast'] = None
+        return pivots
 
     ##
-    ## Plot the results:
+    ## Plot the results. The figures are re-rendered only if the results (or
+    ## the plot settings) have changed since the last run:
     ##
-    plot_res('Tmrca', tt=tt_df, lsd=lsd_df, beast=beast, save=SAVE_FIG)
-    plot_res('Mu', tt=tt_df, lsd=lsd_df, beast=beast, save=SAVE_FIG)
+    pivots = {}
+    figure_inputs = [treetime_res_file, lsd_res_file, beast_res_file]
+    figure_params = {'methods': (PLOT_TREETIME, PLOT_LSD, PLOT_BEAST), 'n_boot': N_BOOTSTRAP}
+    for what in ['Tmrca', 'Mu']:
+        plot = lambda what=what: plot_res(what, tt=read_pivots()['tt'], lsd=read_pivots()['lsd'],
+            beast=read_pivots()['beast'], save=False, ci=N_BOOTSTRAP > 0)
+        if SAVE_FIG:
+            build_figure("./figs/fluH3N2_subtrees_{}".format(what), figure_inputs, plot, params=figure_params)
+        else:
+            plot()
 
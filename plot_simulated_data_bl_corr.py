@@ -30,16 +30,10 @@ from plot_defaults import *
 def corr_points(basename, beast_dir=None):
 
     def initialize_splits(tree):
-
-        all_tips = set(tree.get_terminals())
-        for c in tree.find_clades(order='postorder'):
-            if c.is_terminal():
-                c.tips = [c.name]
-            else:
-                c.tips = set(sum([list(k.tips) for k in c.clades],[]))
-            c.non_tips = set.difference(all_tips, c.tips)
-
-        return tree
+        # leaf sets of the clades in preorder with the branch lengths
+        import utility_functions_tree as tree_utils
+        tree = tree_utils.CompactTree.from_biopython(tree)
+        return zip(tree.clade_leaf_sets(), tree.branch_length)
 
     def get_beast_tree_from_file(beast_file):
         print ("reading BEAST tree from file: " + beast_file)
@@ -66,22 +60,21 @@ def corr_points(basename, beast_dir=None):
     if beast_tree is not None:
         beast_tree = initialize_splits(beast_tree)
 
+    tt_splits = dict(treetime_tree)
+    ft_splits = dict(fasttree_tree)
+    bt_splits = dict(beast_tree) if beast_tree is not None else {}
+
     tt_corr = []
     ft_corr = []
     bt_corr = []
 
-    for orig_split in original_tree.find_clades():
-        for c1 in treetime_tree.find_clades():
-            if c1.tips == orig_split.tips:
-                tt_corr.append((orig_split.branch_length, c1.branch_length))
-                break
-        for c2 in fasttree_tree.find_clades():
-            if c2.tips == orig_split.tips:
-                ft_corr.append((orig_split.branch_length, c2.branch_length))
-        if beast_tree is not None:
-            for c3 in beast_tree.find_clades():
-                if c3.tips == orig_split.tips:
-                    bt_corr.append((orig_split.branch_length, c3.branch_length))
+    for tips, branch_length in original_tree:
+        if tips in tt_splits:
+            tt_corr.append((branch_length, tt_splits[tips]))
+        if tips in ft_splits:
+            ft_corr.append((branch_length, ft_splits[tips]))
+        if tips in bt_splits:
+            bt_corr.append((branch_length, bt_splits[tips]))
 
     return tt_corr, ft_corr, bt_corr
 
@@ -146,8 +139,7 @@ def plot_correlation(tt_corr, ft_corr, bt_corr, include_fast_tree=True, figname=
     axes.set_ylim(0.1, 200)
 
     if figname is not None:
-        for fmt in formats:
-            fig.savefig("{}.{}".format(figname, fmt))
+        save_figure(fig, figname)
 
 if __name__ == '__main__':
 
@@ -8,9 +8,14 @@ from Bio import Phylo
 
 import utility_functions_beast as beast_utils
 import utility_functions_simulated_data as sim_utils
+import utility_functions_results as results_utils
+import utility_functions_stats as stats_utils
 
 from plot_defaults import *
 
+TREETIME_COLUMNS = ['File', 'Sim_Tmrca', 'Tmrca', 'mu', 'R', 'R2_int']
+LSD_COLUMNS = ['File', 'Sim_Tmrca', 'Tmrca', 'mu', 'obj']
+
 def read_treetime_results_dataset(fname):
     """
     Read results of the TreeTime simulations
@@ -22,8 +27,10 @@ def read_treetime_results_dataset(fname):
      - df: Table of results as pandas data-frame
     """
 
-    columns = ['File', 'Sim_Tmrca', 'Tmrca', 'mu', 'R', 'R2_int']
-    df = pandas.read_csv(fname, names=columns)
+    df = pandas.read_csv(fname, names=TREETIME_COLUMNS)
+    return _preprocess_treetime_results(df)
+
+def _preprocess_treetime_results(df):
 
     #filter obviously failed simulations
     df = df[[len(str(k)) > 10 for k in df.File]]
@@ -31,12 +38,7 @@ def read_treetime_results_dataset(fname):
 
     # some very basic preprocessing
     df['dTmrca'] = -(df['Sim_Tmrca'] - df['Tmrca'])
-    df['Sim_mu'] = map(lambda x: float(x.split("/")[-1].split('_')[6][2:]), df.File)
-    df['Ns'] = map(lambda x: int(x.split("/")[-1].split('_')[3][2:]), df.File)
-    df['Ts'] = map(lambda x: int(x.split("/")[-1].split('_')[4][2:]), df.File)
-    df['N'] = map(lambda x: int(x.split("/")[-1].split('_')[2][1:]), df.File)
-    df['T'] = df['Ns']*df['Ts']
-    df['Nmu'] = (df['N']*df['Sim_mu'])
+    df = results_utils.add_ffpopsim_params(df)
 
     return df
 
@@ -51,77 +53,66 @@ def read_lsd_results_dataset(fname):
      - df: Table of results as pandas data-frame
     """
 
-    columns = ['File', 'Sim_Tmrca', 'Tmrca', 'mu', 'obj']
-    df = pandas.read_csv(fname, names=columns)
+    df = pandas.read_csv(fname, names=LSD_COLUMNS)
+    return _preprocess_lsd_results(df)
+
+def _preprocess_lsd_results(df):
 
     # Filter out obviously wrong data
     df = df[[len(k) > 10 for k in df.File]]
 
     #Some basic preprocessing
     df['dTmrca'] = -(df['Sim_Tmrca'] - df['Tmrca'])
-    df['Sim_mu'] = map(lambda x: float(x.split("/")[-1].split('_')[6][2:]), df.File)
-    df['Ns'] = map(lambda x: int(x.split("/")[-1].split('_')[3][2:]), df.File)
-    df['Ts'] = map(lambda x: int(x.split("/")[-1].split('_')[4][2:]), df.File)
-    df['N'] = map(lambda x: int(x.split("/")[-1].split('_')[2][1:]), df.File)
-    df['T'] = df['Ns']*df['Ts']
-    df['Nmu'] = (df['N']*df['Sim_mu'])
+    df = results_utils.add_ffpopsim_params(df)
 
     return df
 
-def create_lsd_tt_pivot(df, T_over_N=None, mean_or_median='median'):
-
-    if T_over_N is not None:
-        DF = df[ df["T"] / df["N"] == T_over_N ]
-    else:
-        DF = df
+def _treetime_errors(df):
+    return stats_utils.simulated_errors(_preprocess_treetime_results(df))
 
-    N_MUS = np.unique(DF.Nmu)
-    N_MUS_idxs = np.ones(N_MUS.shape, dtype=bool)
+def _lsd_errors(df):
+    return stats_utils.simulated_errors(_preprocess_lsd_results(df))
 
-    mu_mean = []
-    mu_err = []
-    tmrca_mean = []
-    tmrca_err = []
+def create_incremental_pivot(fname, method, checkpoint_dir, T_over_N=None, mean_or_median='median'):
+    """
+    Create the pivot table of the TreeTime or LSD results, reading only the
+    results appended to the file since the last call. The statistics are kept
+    in the checkpoint file in the checkpoint_dir (see IncrementalPivot in the
+    utility_functions_stats.py).
 
-    for idx, N_MU  in enumerate(N_MUS):
-        idxs = DF.Nmu == N_MU
-        if idxs.sum() == 0:
-            N_MUS_idxs[idx] = False
-            continue
+    Args:
+     - fname: path to the results file
 
-#        import ipdb; ipdb.set_trace()
-        dMu = -(DF.Sim_mu[idxs] - DF.mu[idxs])/DF.Sim_mu[idxs]
-        dMu.sort_values(inplace=True)
-        #dMu = dMu[int(dMu.shape[0]*0.05) : int(dMu.shape[0]*0.95)]
+     - method: 'treetime' or 'lsd'
 
-        dTmrca = DF.dTmrca[idxs]/DF.N[idxs]
-        dTmrca.sort_values(inplace=True)
-        #dTmrca = dTmrca[int(dTmrca.shape[0]*0.05) : int(dTmrca.shape[0]*0.95)]
+     - checkpoint_dir: directory to store the checkpoints
 
-        if mean_or_median == "mean":
-            mu_mean.append(np.mean(dMu))
-            mu_err.append(np.std(dMu))
+    Returns:
+     - pivot: the pivot table, as returned by create_lsd_tt_pivot
+    """
+    if not os.path.exists(checkpoint_dir):
+        os.makedirs(checkpoint_dir)
+    # without the T_over_N filter, the statistics are aggregated by Nmu only
+    # (the streaming quartiles of the T_over_N groups cannot be merged)
+    by = ['Nmu'] if T_over_N is None else ['T_over_N', 'Nmu']
+    checkpoint = os.path.join(checkpoint_dir, "{}.{}.pivot.pkl".format(
+        os.path.split(fname)[-1], "_".join(by)))
+    if method == 'treetime':
+        columns, transform = TREETIME_COLUMNS, _treetime_errors
+    else:
+        columns, transform = LSD_COLUMNS, _lsd_errors
+    agg = stats_utils.incremental_pivot(checkpoint, [fname], columns,
+        by, ['dMu', 'dTmrca'], transform=transform)
+    return stats_utils.incremental_errors_pivot(agg, mean_or_median=mean_or_median, T_over_N=T_over_N)
 
-            tmrca_mean.append(np.mean(dTmrca))
-            tmrca_err.append(np.std(dTmrca))
-        else:
-            q75, q25 = np.percentile(dMu, [75 ,25])
-            mu_err.append((q75 - q25)) #np.std(DF.dTmrca[idxs])
-            mu_mean.append(np.median(dMu))
-            q75, q25 = np.percentile(dTmrca, [75 ,25])
-            tmrca_err.append((q75 - q25)) #np.std(DF.dTmrca[idxs])
-            tmrca_mean.append(np.median(dTmrca))
+def create_lsd_tt_pivot(df, T_over_N=None, mean_or_median='median', n_boot=0):
 
+    if T_over_N is not None:
+        DF = df[ df["T"] / df["N"] == T_over_N ]
+    else:
+        DF = df
 
-    res = pandas.DataFrame({
-        "Nmu" : N_MUS[N_MUS_idxs],
-        "dMu_mean" : mu_mean,
-        "dMu_err" : mu_err,
-        "dTmrca_mean" : tmrca_mean,
-        "dTmrca_err" : tmrca_err,
-        })
-    res = res.sort_values(by='Nmu')
-    return res
+    return stats_utils.simulated_errors_pivot(DF, mean_or_median=mean_or_median, n_boot=n_boot)
 
 def plot_raw_data(df):
     """
@@ -188,7 +179,8 @@ def plot_mutation_rate_distributions(df, TN_min=3, TN_max=10, plot_title=""):
     plt.legend(loc=0, fontsize=legend_fs)
 
 def T_over_N_from_filename(filename):
-    return 1. * int(filename.split('_')[4][2:]) * int(filename.split('_')[3][2:]) / int(filename.split('_')[2][1:])
+    params = results_utils.ffpopsim_params(filename)
+    return 1. * params['T'] / params['N']
 
 def read_beast_log(filename):
     return beast_utils.read_beast_log(filename, sim_utils.NEAREST_DATE)
@@ -233,12 +225,13 @@ def read_all_beast_logs(logsdir, treesdir, T_over_N=None):
         File.append(beast_log)
 
         Sim_Tmrca.append(Tmrca_from_tree(beast_log, treesdir))
-        Sim_Mu.append(float(beast_log.split("/")[-1].split('_')[6][2:]))
-        Ns.append(int(beast_log.split("/")[-1].split('_')[3][2:]))
-        Ts.append(int(beast_log.split("/")[-1].split('_')[4][2:]))
-        N.append(int(beast_log.split("/")[-1].split('_')[2][1:]))
-        T.append(Ns[-1] * Ts[-1])
-        Nmu.append(N[-1]*Sim_Mu[-1])
+        params = results_utils.ffpopsim_params(beast_log)
+        Sim_Mu.append(params['Sim_mu'])
+        Ns.append(params['Ns'])
+        Ts.append(params['Ts'])
+        N.append(params['N'])
+        T.append(params['T'])
+        Nmu.append(params['Nmu'])
 
         LH.append(df['likelihood'][-50:].mean())
         LH_std.append(df['likelihood'][-50:].std())
@@ -272,7 +265,7 @@ def read_all_beast_logs(logsdir, treesdir, T_over_N=None):
 
     return res
 
-def create_beast_log_pivot(df, T_over_N=None):
+def create_beast_log_pivot(df, T_over_N=None, mean_or_median='median', n_boot=0):
 
 
     if T_over_N is not None:
@@ -280,54 +273,21 @@ def create_beast_log_pivot(df, T_over_N=None):
     else:
         DF = df
 
-    mu_mean = []
-    mu_err = []
-    tmrca_mean = []
-    tmrca_err = []
-
-    N_MUS = np.unique(DF.Nmu)
-    N_MUS_idxs = np.ones(N_MUS.shape, dtype=bool)
-
-    for idx, N_MU  in enumerate(N_MUS):
-
-        idxs = DF.Nmu == N_MU
-        if idxs.sum() == 0:
-            N_MUS_idxs[idx] = False
-            continue
-
-        dMu = -(DF.Sim_Mu[idxs] - DF.Mu[idxs])/DF.Sim_Mu[idxs]
-        dMu.sort_values(inplace=True)
-        dMu[int(dMu.shape[0]*0.05) : int(dMu.shape[0]*0.95)]
-
-        dTmrca = DF.dTmrca[idxs]/DF.N[idxs]
-        dTmrca.sort_values(inplace=True)
-        dTmrca = dTmrca[int(dTmrca.shape[0]*0.05) : int(dTmrca.shape[0]*0.95)]
+    # NOTE the extreme 5% of the Tmrca errors are discarded on either side
+    return stats_utils.simulated_errors_pivot(DF, mean_or_median=mean_or_median,
+        trim_dTmrca=0.05, sim_mu='Sim_Mu', mu='Mu', n_boot=n_boot)
 
-        if mean_or_median == "mean":
-            mu_mean.append(np.mean(dMu))
-            mu_err.append(np.std(dMu))
-
-            tmrca_mean.append(np.mean(dTmrca))
-            tmrca_err.append(np.std(dTmrca))
-        else:
-            q75, q25 = np.percentile(dMu, [75 ,25])
-            mu_err.append((q75 - q25)) #np.std(DF.dTmrca[idxs])
-            mu_mean.append(np.median(dMu))
-            q75, q25 = np.percentile(dTmrca, [75 ,25])
-            tmrca_err.append((q75 - q25)) #np.std(DF.dTmrca[idxs])
-            tmrca_mean.append(np.median(dTmrca))
-
-    res = pandas.DataFrame({
-        "Nmu" : N_MUS[N_MUS_idxs],
-        "dMu_mean" : mu_mean,
-        "dMu_err" : mu_err,
-        "dTmrca_mean" : tmrca_mean,
-        "dTmrca_err" : tmrca_err,
-        })
-    res = res.sort_values(by='Nmu')
-    return res
+def _plot_ci(axes, x, pivot, column, idxs, color):
+    """
+    Shade the bootstrap confidence interval of the pivot values (if computed,
+    see the n_boot argument of the pivot functions)
+    """
+    if column + "_lo" not in pivot:
+        return
+    axes.fill_between(np.asarray(x)[idxs], pivot[column + "_lo"].values[idxs],
+        pivot[column + "_hi"].values[idxs], color=color, alpha=0.2, lw=0)
 
-def plot_data_stat(what, axes, beast=None, tt=None, tt_f=None, lsd=None, lsd_f=None, plot_idxs=None):
+def plot_data_stat(what, axes, beast=None, tt=None, tt_f=None, lsd=None, lsd_f=None, plot_idxs=None, ci=False):
 
     from plot_defaults import shift_point_by_markersize
 
@@ -357,6 +317,8 @@ def plot_data_stat(what, axes, beast=None, tt=None, tt_f=None, lsd=None, lsd_f=N
             markersize=markersize,
             c=beast_color,
             label="Beast")
+        if ci:
+            _plot_ci(axes, beast["Nmu"], beast, mean, beast_plot_idxs, beast_color)
 
     if tt is not None:
         x, y = shift_point_by_markersize(axes, tt["Nmu"], tt[mean], +markersize*.75)
@@ -373,6 +335,8 @@ def plot_data_stat(what, axes, beast=None, tt=None, tt_f=None, lsd=None, lsd_f=N
             markeredgecolor=tt_color,
             mew=1.3,
             c=tt_color, label="TreeTime, original tree")
+        if ci:
+            _plot_ci(axes, x, tt, mean, tt_plot_idxs, tt_color)
 
 
     if tt_f is not None:
@@ -389,6 +353,8 @@ def plot_data_stat(what, axes, beast=None, tt=None, tt_f=None, lsd=None, lsd_f=N
             markeredgecolor=tt_color,
             mew=1.3,
             c=tt_color, label="TreeTime, FastTree")
+        if ci:
+            _plot_ci(axes, x, tt_f, mean, ttf_plot_idxs, tt_color)
 
     if lsd is not None:
         x, y = shift_point_by_markersize(axes, lsd["Nmu"], lsd[mean], +markersize/2)
@@ -403,6 +369,8 @@ def plot_data_stat(what, axes, beast=None, tt=None, tt_f=None, lsd=None, lsd_f=N
             markersize=markersize,
             c=lsd_color,
             label="LSd, original tree")
+        if ci:
+            _plot_ci(axes, x, lsd, mean, lsd_plot_idxs, lsd_color)
 
     if lsd_f is not None:
         x, y = shift_point_by_markersize(axes, lsd_f["Nmu"], lsd_f[mean], -markersize*.75)
@@ -418,6 +386,8 @@ def plot_data_stat(what, axes, beast=None, tt=None, tt_f=None, lsd=None, lsd_f=N
             markeredgecolor=lsd_color,
             mew=1.3,
             c=lsd_color, label="LSD, FastTree")
+        if ci:
+            _plot_ci(axes, x, lsd_f, mean, lsdf_plot_idxs, lsd_color)
 
 
     plt.hlines(0, 0, 1)
@@ -447,16 +417,10 @@ def get_beast_tree_from_file(beast_file):
 def corr_points(basename, beast_dir=None):
 
     def initialize_splits(tree):
-
-        all_tips = set(tree.get_terminals())
-        for c in tree.find_clades(order='postorder'):
-            if c.is_terminal():
-                c.tips = [c.name]
-            else:
-                c.tips = set(sum([list(k.tips) for k in c.clades],[]))
-            c.non_tips = set.difference(all_tips, c.tips)
-
-        return tree
+        # leaf sets of the clades in preorder with the branch lengths
+        import utility_functions_tree as tree_utils
+        tree = tree_utils.CompactTree.from_biopython(tree)
+        return zip(tree.clade_leaf_sets(), tree.branch_length)
 
     def get_beast_tree_from_file(beast_file):
         print ("reading BEAST tree from file: " + beast_file)
@@ -484,22 +448,21 @@ def corr_points(basename, beast_dir=None):
     if beast_tree is not None:
         beast_tree = initialize_splits(beast_tree)
 
+    tt_splits = dict(treetime_tree)
+    ft_splits = dict(fasttree_tree)
+    bt_splits = dict(beast_tree) if beast_tree is not None else {}
+
     tt_corr = []
     ft_corr = []
     bt_corr = []
 
-    for orig_split in original_tree.find_clades():
-        for c1 in treetime_tree.find_clades():
-            if c1.tips == orig_split.tips:
-                tt_corr.append((orig_split.branch_length, c1.branch_length))
-                break
-        for c2 in fasttree_tree.find_clades():
-            if c2.tips == orig_split.tips:
-                ft_corr.append((orig_split.branch_length, c2.branch_length))
-        if beast_tree is not None:
-            for c3 in beast_tree.find_clades():
-                if c3.tips == orig_split.tips:
-                    bt_corr.append((orig_split.branch_length, c3.branch_length))
+    for tips, branch_length in original_tree:
+        if tips in tt_splits:
+            tt_corr.append((branch_length, tt_splits[tips]))
+        if tips in ft_splits:
+            ft_corr.append((branch_length, ft_splits[tips]))
+        if tips in bt_splits:
+            bt_corr.append((branch_length, bt_splits[tips]))
 
     return tt_corr, ft_corr, bt_corr
 
@@ -578,61 +541,91 @@ if __name__ == '__main__':
     PLOT_LSD = True
     PLOT_BEAST = False
     save_fig = True
+    # number of the bootstrap resamplings to show the confidence intervals of
+    # the data points (0 - no confidence intervals)
+    N_BOOTSTRAP = 0
+    # update the TreeTime and LSD pivots only with the results appended since
+    # the previous run (to follow the running simulations). The statistics are
+    # kept in the checkpoint files. NOTE no bootstrap in this mode.
+    INCREMENTAL = False
     plot_idxs = np.array([1,2,4,6,7,9,10])
 
     if PLOT_SIM_RESULTS:
         res_dir = "./simulated_data"
-        res_lsd = read_lsd_results_dataset('./simulated_data/2017-05-31_lsd_res.csv')
-        res_lsd_f = read_lsd_results_dataset('./simulated_data/2017-05-31_lsd_fasttree_res.csv')
+        checkpoint_dir = os.path.join(res_dir, "pivot_checkpoints")
+        lsd_csv = './simulated_data/2017-05-31_lsd_res.csv'
+        lsd_f_csv = './simulated_data/2017-05-31_lsd_fasttree_res.csv'
 
-        res_tt = read_treetime_results_dataset('./simulated_data/2017-06-11_treetime_fasttree_res_use_input_branch_false.csv')
-        res_tt_f =  read_treetime_results_dataset('./simulated_data/2017-06-11_treetime_fasttree_res.csv')
+        tt_csv = './simulated_data/2017-06-11_treetime_fasttree_res_use_input_branch_false.csv'
+        tt_f_csv = './simulated_data/2017-06-11_treetime_fasttree_res.csv'
 
         beast_logs_dir = os.path.join(res_dir, '2017-05-16_beast')
         beast_trees_dir = os.path.join(res_dir, 'dataset')
 
 
-        if PLOT_LSD:
-            pivot_lsd = None #create_lsd_tt_pivot(res_lsd, T_over_N=T_over_N, mean_or_median=mean_or_median)
-            pivot_lsd_f = create_lsd_tt_pivot(res_lsd_f, T_over_N=T_over_N, mean_or_median=mean_or_median)
-        else:
-            pivot_lsd = None
-            pivot_lsd_f = None
-
-        if PLOT_TREETIME:
-            pivot_tt = create_lsd_tt_pivot(res_tt, T_over_N=T_over_N, mean_or_median=mean_or_median)
-            pivot_tt_f =  create_lsd_tt_pivot(res_tt_f, T_over_N=T_over_N, mean_or_median=mean_or_median)
-        else:
-            pivot_tt = None
-            pivot_tt_f = None
-
-        if PLOT_BEAST:
-            beast_df = read_all_beast_logs(beast_logs_dir, beast_trees_dir, T_over_N=T_over_N)
-            pivot_beast = create_beast_log_pivot(beast_df)
-        else:
-            pivot_beast=None
-
-        fig = plt.figure(figsize=onecolumn_figsize)
-        axes = fig.add_subplot(111)
-        plot_data_stat('Mu', axes, beast=pivot_beast, tt=pivot_tt, tt_f=pivot_tt_f, lsd=pivot_lsd, lsd_f=pivot_lsd_f, plot_idxs=plot_idxs)
-        fig.text(0.15, 0.85, '$\mathrm{\mu}$ overestimated', fontsize=tick_fs)
-        fig.text(0.15, 0.15, '$\mathrm{\mu}$ underestimated', fontsize=tick_fs)
-
-        if save_fig:
-            fig.savefig("./figs/simdata_Mu_TN{}_{}.svg".format(T_over_N, mean_or_median))
-            fig.savefig("./figs/simdata_Mu_TN{}_{}.png".format(T_over_N, mean_or_median))
-            fig.savefig("./figs/simdata_Mu_TN{}_{}.pdf".format(T_over_N, mean_or_median))
-
-        fig = plt.figure(figsize=onecolumn_figsize)
-        axes = fig.add_subplot(111)
-        plot_data_stat('Tmrca', axes, beast=pivot_beast, tt=pivot_tt, tt_f=pivot_tt_f, lsd=pivot_lsd, lsd_f=pivot_lsd_f, plot_idxs=plot_idxs)
-        fig.text(0.15, 0.85, '$\mathrm{T_{mrca}}$ too late', fontsize=tick_fs)
-        fig.text(0.15, 0.15, '$\mathrm{T_{mrca}}$ too early', fontsize=tick_fs)
+        def read_pivots():
+            """
+            Read the results and make the pivot tables. The pivots are made
+            once and shared by the figures.
+            """
+            if pivots:
+                return pivots
+
+            if PLOT_LSD:
+                pivots['lsd'] = None #create_lsd_tt_pivot(read_lsd_results_dataset(lsd_csv), T_over_N=T_over_N, mean_or_median=mean_or_median)
+                if INCREMENTAL:
+                    pivots['lsd_f'] = create_incremental_pivot(lsd_f_csv, 'lsd', checkpoint_dir, T_over_N=T_over_N, mean_or_median=mean_or_median)
+                else:
+                    pivots['lsd_f'] = create_lsd_tt_pivot(read_lsd_results_dataset(lsd_f_csv), T_over_N=T_over_N, mean_or_median=mean_or_median, n_boot=N_BOOTSTRAP)
+            else:
+                pivots['lsd'] = None
+                pivots['lsd_f'] = None
+
+            if PLOT_TREETIME:
+                if INCREMENTAL:
+                    pivots['tt'] = create_incremental_pivot(tt_csv, 'treetime', checkpoint_dir, T_over_N=T_over_N, mean_or_median=mean_or_median)
+                    pivots['tt_f'] = create_incremental_pivot(tt_f_csv, 'treetime', checkpoint_dir, T_over_N=T_over_N, mean_or_median=mean_or_median)
+                else:
+                    pivots['tt'] = create_lsd_tt_pivot(read_treetime_results_dataset(tt_csv), T_over_N=T_over_N, mean_or_median=mean_or_median, n_boot=N_BOOTSTRAP)
+                    pivots['tt_f'] =  create_lsd_tt_pivot(read_treetime_results_dataset(tt_f_csv), T_over_N=T_over_N, mean_or_median=mean_or_median, n_boot=N_BOOTSTRAP)
+            else:
+                pivots['tt'] = None
+                pivots['tt_f'] = None
 
-        if save_fig:
-            fig.savefig("./figs/simdata_Tmrca_TN{}_{}.svg".format(T_over_N, mean_or_median))
-            fig.savefig("./figs/simdata_Tmrca_TN{}_{}.png".format(T_over_N, mean_or_median))
-            fig.savefig("./figs/simdata_Tmrca_TN{}_{}.pdf".format(T_over_N, mean_or_median))
+            if PLOT_BEAST:
+                beast_df = read_all_beast_logs(beast_logs_dir, beast_trees_dir, T_over_N=T_over_N)
+                pivots['beast'] = create_beast_log_pivot(beast_df, mean_or_median=mean_or_median, n_boot=N_BOOTSTRAP)
+            else:
+                pivots['beast'] = None
+            return pivots
+
+        def plot_sim_results(what, text_over, text_under):
+            pivot = read_pivots()
+            fig = plt.figure(figsize=onecolumn_figsize)
+            axes = fig.add_subplot(111)
+            plot_data_stat(what, axes, beast=pivot['beast'], tt=pivot['tt'], tt_f=pivot['tt_f'],
+                lsd=pivot['lsd'], lsd_f=pivot['lsd_f'], plot_idxs=plot_idxs, ci=N_BOOTSTRAP > 0)
+            fig.text(0.15, 0.85, text_over, fontsize=tick_fs)
+            fig.text(0.15, 0.15, text_under, fontsize=tick_fs)
+            return fig
+
+        # the figures are re-rendered only if the results (or the plot
+        # settings) have changed since the last run
+        pivots = {}
+        figure_inputs = [lsd_f_csv, tt_csv, tt_f_csv] + ([beast_logs_dir, beast_trees_dir] if PLOT_BEAST else [])
+        figure_params = {'T_over_N': T_over_N, 'mean_or_median': mean_or_median,
+            'methods': (PLOT_TREETIME, PLOT_LSD, PLOT_BEAST), 'n_boot': N_BOOTSTRAP}
+
+        for what, text_over, text_under in [
+                ('Mu', '$\mathrm{\mu}$ overestimated', '$\mathrm{\mu}$ underestimated'),
+                ('Tmrca', '$\mathrm{T_{mrca}}$ too late', '$\mathrm{T_{mrca}}$ too early')]:
+            plot = lambda what=what, text_over=text_over, text_under=text_under: \
+                plot_sim_results(what, text_over, text_under)
+            if save_fig:
+                build_figure("./figs/simdata_{}_TN{}_{}".format(what, T_over_N, mean_or_median),
+                    figure_inputs, plot, params=figure_params)
+            else:
+                plot()
 
 
     if PLOT_CORRELATION:
@@ -645,6 +638,4 @@ if __name__ == '__main__':
         plot_correlation(tt_corr, ft_corr, bt_corr, axes, include_fast_tree=INCLUDE_FAST_TREE)
         if save_fig:
             ft = '_ft' if INCLUDE_FAST_TREE else ""
-            fig.savefig("./figs/simdata_BranchLenCorr{}.svg".format(ft))
-            fig.savefig("./figs/simdata_BranchLenCorr{}.png".format(ft))
-            fig.savefig("./figs/simdata_BranchLenCorr{}.pdf".format(ft))
+            save_figure(fig, "./figs/simdata_BranchLenCorr{}".format(ft))
@@ -19,6 +19,8 @@ from Bio import Phylo
 
 import utility_functions_beast as beast_utils
 import utility_functions_simulated_data as sim_utils
+import utility_functions_results as results_utils
+import utility_functions_stats as stats_utils
 
 from plot_defaults import *
 
@@ -42,12 +44,7 @@ def read_treetime_results_csv(fname):
 
     # some very basic preprocessing
     df['dTmrca'] = -(df['Sim_Tmrca'] - df['Tmrca'])
-    df['Sim_mu'] = map(lambda x: float(x.split("/")[-1].split('_')[6][2:]), df.File)
-    df['Ns'] = map(lambda x: int(x.split("/")[-1].split('_')[3][2:]), df.File)
-    df['Ts'] = map(lambda x: int(x.split("/")[-1].split('_')[4][2:]), df.File)
-    df['N'] = map(lambda x: int(x.split("/")[-1].split('_')[2][1:]), df.File)
-    df['T'] = df['Ns']*df['Ts']
-    df['Nmu'] = (df['N']*df['Sim_mu'])
+    df = results_utils.add_ffpopsim_params(df)
 
     return df
 
@@ -70,12 +67,7 @@ def read_lsd_results_csv(fname):
 
     #Some basic preprocessing
     df['dTmrca'] = -(df['Sim_Tmrca'] - df['Tmrca'])
-    df['Sim_mu'] = map(lambda x: float(x.split("/")[-1].split('_')[6][2:]), df.File)
-    df['Ns'] = map(lambda x: int(x.split("/")[-1].split('_')[3][2:]), df.File)
-    df['Ts'] = map(lambda x: int(x.split("/")[-1].split('_')[4][2:]), df.File)
-    df['N'] = map(lambda x: int(x.split("/")[-1].split('_')[2][1:]), df.File)
-    df['T'] = df['Ns']*df['Ts']
-    df['Nmu'] = (df['N']*df['Sim_mu'])
+    df = results_utils.add_ffpopsim_params(df)
 
     return df
 
@@ -98,6 +90,26 @@ def read_beast_results_csv(fname):
     df['dTmrca'] = -(df['Sim_Tmrca'] - df['Tmrca'])
     return df
 
+def read_results_archive(archive_dir, method):
+    """
+    Read results of the given method from the columnar archive (see
+    utility_functions_results.py). The same filtering as for the CSV files is
+    applied.
+
+    Args:
+     - archive_dir: path to the archive directory
+
+     - method: name of the method: 'treetime', 'lsd', 'beast', or with the
+     '_fasttree' suffix
+
+    Returns:
+     - df: Table of results as pandas data-frame
+    """
+    df = results_utils.read_results(archive_dir, method)
+    if method.startswith('treetime'):
+        df = df[df.R > 0.1]
+    return df
+
 def create_pivot_table(df, T_over_N=None, mean_or_median='median'):
     """
     Create the pivot table to plot from the raw dataframe.
@@ -136,52 +148,7 @@ def create_pivot_table(df, T_over_N=None, mean_or_median='median'):
     else:
         DF = df
 
-    N_MUS = np.unique(DF.Nmu)
-    N_MUS_idxs = np.ones(N_MUS.shape, dtype=bool)
-
-    mu_mean = []
-    mu_err = []
-    tmrca_mean = []
-    tmrca_err = []
-
-    for idx, N_MU  in enumerate(N_MUS):
-        idxs = DF.Nmu == N_MU
-        if idxs.sum() == 0:
-            N_MUS_idxs[idx] = False
-            continue
-
-        dMu = -(DF.Sim_mu[idxs] - DF.mu[idxs])/DF.Sim_mu[idxs]
-        dMu.sort_values(inplace=True)
-        #dMu = dMu[int(dMu.shape[0]*0.05) : int(dMu.shape[0]*0.95)]
-
-        dTmrca = DF.dTmrca[idxs]/DF.N[idxs]
-        dTmrca.sort_values(inplace=True)
-        #dTmrca = dTmrca[int(dTmrca.shape[0]*0.05) : int(dTmrca.shape[0]*0.95)]
-
-        if mean_or_median == "mean":
-            mu_mean.append(np.mean(dMu))
-            mu_err.append(np.std(dMu))
-
-            tmrca_mean.append(np.mean(dTmrca))
-            tmrca_err.append(np.std(dTmrca))
-        else:
-            q75, q25 = np.percentile(dMu, [75 ,25])
-            mu_err.append((q75 - q25)) #np.std(DF.dTmrca[idxs])
-            mu_mean.append(np.median(dMu))
-            q75, q25 = np.percentile(dTmrca, [75 ,25])
-            tmrca_err.append((q75 - q25)) #np.std(DF.dTmrca[idxs])
-            tmrca_mean.append(np.median(dTmrca))
-
-
-    res = pandas.DataFrame({
-        "Nmu" : N_MUS[N_MUS_idxs],
-        "dMu_mean" : mu_mean,
-        "dMu_err" : mu_err,
-        "dTmrca_mean" : tmrca_mean,
-        "dTmrca_err" : tmrca_err,
-        })
-    res = res.sort_values(by='Nmu')
-    return res
+    return stats_utils.simulated_errors_pivot(DF, mean_or_median=mean_or_median)
 
 def plot_simulated_data(Tmrca_or_Mu,
     treetime_pivot=None, lsd_pivot=None, beast_pivot=None,
@@ -284,8 +251,8 @@ def plot_simulated_data(Tmrca_or_Mu,
     fig.text(0.15, 0.15, text_underestimated, fontsize=tick_fs)
 
     if figname is not None:
-        for fmt in formats:
-            fig.savefig("{}.{}".format(figname, fmt))
+        save_figure(fig, figname)
+    return fig
 
 
 if __name__ == '__main__':
@@ -318,8 +285,8 @@ if __name__ == '__main__':
     mean_or_median = 'median'
 
     """
-    Should save figures? If True, note the figure name in the plot_simulated_data
-    function parameters.
+    Should save figures? The figure names are set in the build_figure calls
+    below.
     """
     SAVE_FIG = True
 
@@ -330,30 +297,47 @@ if __name__ == '__main__':
     treetime_csv = "./simulated_data/_treetime_fasttree_res.csv"
     lsd_csv = "./simulated_data/_lsd_fasttree_res.csv"
     beast_csv = "./simulated_data/_beast_res.csv"
+    #  or read the results from the columnar archive instead of the CSV files:
+    READ_ARCHIVE = False
+    archive_dir = "./simulated_data/_archive"
 
     ##
     ## Read, process and plot the data
     ##
-    # read csv's to the pandas dataframes:
-    treetime_df = read_treetime_results_csv(treetime_csv)
-    lsd_df = read_lsd_results_csv(lsd_csv)
-    beast_df = read_beast_results_csv(beast_csv)
-
-    # make pivot tables and filter only the relevant parameters:
-    lsd_pivot = create_pivot_table(lsd_df, T_over_N=T_over_N, mean_or_median=mean_or_median)
-    beast_pivot = create_pivot_table(beast_df, T_over_N=T_over_N, mean_or_median=mean_or_median)
-    treetime_pivot = create_pivot_table(treetime_df, T_over_N=T_over_N, mean_or_median=mean_or_median)
-
-    # plot the data: and save figures if needed:
-    # plot Tmrca figure:
-    plot_simulated_data('Tmrca', treetime_pivot, lsd_pivot, beast_pivot,
-        figname="./figs/simdata_Tmrca_TN{}_{}".format(T_over_N, mean_or_median) if SAVE_FIG else None,
-        #plot_idxs=np.array([1,2,4,6,7,9,10])
-        )
-
-    # plot Mu figure
-    plot_simulated_data('Mu', treetime_pivot, lsd_pivot, beast_pivot,
-        figname="./figs/simdata_Mu_TN{}_{}".format(T_over_N, mean_or_median) if SAVE_FIG else None,
-        #plot_idxs=np.array([1,2,4,6,7,9,10])
-        )
-
+    pivots = {}
+    def read_pivots():
+        """
+        Read the results and make pivot tables, filtered for the relevant
+        parameters. The pivots are made once and shared by the figures.
+        """
+        if pivots:
+            return pivots
+        # read csv's to the pandas dataframes:
+        if READ_ARCHIVE:
+            treetime_df = read_results_archive(archive_dir, 'treetime_fasttree')
+            lsd_df = read_results_archive(archive_dir, 'lsd_fasttree')
+            beast_df = read_results_archive(archive_dir, 'beast')
+        else:
+            treetime_df = read_treetime_results_csv(treetime_csv)
+            lsd_df = read_lsd_results_csv(lsd_csv)
+            beast_df = read_beast_results_csv(beast_csv)
+
+        pivots['lsd'] = create_pivot_table(lsd_df, T_over_N=T_over_N, mean_or_median=mean_or_median)
+        pivots['beast'] = create_pivot_table(beast_df, T_over_N=T_over_N, mean_or_median=mean_or_median)
+        pivots['treetime'] = create_pivot_table(treetime_df, T_over_N=T_over_N, mean_or_median=mean_or_median)
+        return pivots
+
+    # plot the Tmrca and Mu figures. The figures are re-rendered only if the
+    # results (or the plot settings) have changed since the last run:
+    figure_inputs = [archive_dir] if READ_ARCHIVE else [treetime_csv, lsd_csv, beast_csv]
+    figure_params = {'T_over_N': T_over_N, 'mean_or_median': mean_or_median}
+    for what in ['Tmrca', 'Mu']:
+        plot = lambda what=what: plot_simulated_data(what, read_pivots()['treetime'],
+            read_pivots()['lsd'], read_pivots()['beast'],
+            #plot_idxs=np.array([1,2,4,6,7,9,10])
+            )
+        if SAVE_FIG:
+            build_figure("./figs/simdata_{}_TN{}_{}".format(what, T_over_N, mean_or_median),
+                figure_inputs, plot, params=figure_params)
+        else:
+            plot()
@@ -1,6 +1,6 @@
 from external_binaries import FFPOPSIM_SKYLINE_BIN
 from utility_functions_simulated_data import _ffpopsim_tree_aln_postprocess, generations_from_ffpopsim_tree
-import sys,os, glob
+import sys,os
 
 import numpy as np
 from treetime import TreeTime
@@ -10,34 +10,6 @@ import seaborn as sns
 from plot_defaults import *
 cols = sns.color_palette(n_colors=3)
 
-def read_estimate_skyline(infile):
-    with open(infile, 'r') as inf:
-        ss = inf.readlines()
-
-    period = None
-    amp = None
-    x,y,trueY = [],[],[]
-
-    reading_arrays = False
-    for s in ss:
-        if s.startswith('#period'):
-            period = float(s.split('=')[-1].strip())
-        elif s.startswith('#amplitude'):
-            amp = float(s.split('=')[-1].strip())
-        elif s.startswith('#x, y, trueY'):
-            reading_arrays = True
-        elif reading_arrays:
-            try:
-                i,j,k = map(float, s.split(','))
-                x.append(i)
-                y.append(j)
-                trueY.append(k)
-            except:
-                reading_arrays = False
-        else:
-            continue
-    return period, amp, x, y, trueY
-
 def plot_skyline(res, periods, bottle_necks, figname=None):
     fig = plt.figure(figsize=onecolumn_figsize)
 
@@ -78,8 +50,7 @@ def plot_skyline(res, periods, bottle_necks, figname=None):
     axs[1].set_xlabel('time in simulated generations', fontsize = label_fs)
 
     if figname is not None:
-        for fmt in formats:
-            plt.savefig('{}.{}'.format(figname, fmt))
+        save_figure(fig, figname)
 
 
 if __name__ == '__main__':
@@ -91,8 +62,9 @@ if __name__ == '__main__':
     periods = [0.5, 2.0]
     bottle_necks = [0.5, 0.8, 0.9]
 
-    fnames = glob.glob(os.path.join(resdir,'FF*Mu0.001*res.txt'))
-    res = map(read_estimate_skyline, fnames)
+    # the skyline estimates are recorded to the results archive by skyline_tests.py
+    from skyline_tests import read_skyline_results
+    res = read_skyline_results(os.path.join(resdir, '_archive'), replicate=0, Mu=[0.001])
 
     plot_skyline(res, periods, bottle_necks,
         figname='./figs/skyline' if SAVE_FIG else None)
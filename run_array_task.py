@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+"""
+Single task of the array job. The scheduler (SGE or Slurm) sets the index of
+the task in the environment ($SGE_TASK_ID or $SLURM_ARRAY_TASK_ID), the script
+reads the corresponding row of the task file and calls main() of the run script
+for the task type (TASK_RUNNERS in the utility_functions_queue.py). The task
+file is written by the submit scripts with the ARRAY_JOB flag on.
+
+Usage:
+
+    $python run_array_task.py ./simulated_data/tasks.txt [task_id]
+
+The task index given in the command line overrides the environment.
+"""
+import sys
+import importlib
+import utility_functions_queue as queue_utils
+import utility_functions_cluster as cluster_utils
+
+def main(argv):
+    """
+    Run the task from the task file.
+
+    Args:
+
+     - argv(list): the command line arguments (without the script name): path to
+     the task file and, optionally, the (1-based) task index.
+    """
+    task_file = argv[0]
+    if len(argv) > 1:
+        task_id = int(argv[1])
+    else:
+        task_id = cluster_utils.array_task_id()
+    if task_id is None:
+        raise ValueError("Task index is not set. Is this an array job?")
+
+    kind, args = cluster_utils.read_task(task_file, task_id)
+    sys.stderr.write("Task {} ({}): {}\n".format(task_id, kind, " ".join(args)))
+    runner = importlib.import_module(queue_utils.TASK_RUNNERS[kind])
+    runner.main(args)
+
+if __name__ == '__main__':
+
+    main(sys.argv[1:])
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+"""
+Long-living worker service for the validation tasks. The service starts a
+number of worker processes, which import all heavy modules once and then take
+the tasks from the queue (see utility_functions_queue.py) until it is empty
+(or forever, if the service is run as a daemon). The tasks are put to the queue
+by the submit scripts with the WORKER_SERVICE flag on.
+
+Each task is performed by the main() function of the corresponding run script
+(TASK_RUNNERS in the utility_functions_queue.py). The results are written to
+the same CSV files as if the run script was called directly.
+
+Usage:
+
+    $python run_worker_service.py --queue ./simulated_data/tasks.sqlite --workers 8
+"""
+import os, sys
+import time
+import traceback
+import importlib
+import multiprocessing
+import utility_functions_queue as queue_utils
+import utility_functions_cluster as cluster_utils
+
+def _warm_up():
+    """
+    Import the modules, which every task needs. This is done once per worker
+    process instead of once per task.
+    """
+    import treetime
+    import pandas
+    from Bio import Phylo, AlignIO
+    runners = {}
+    for kind, module_name in queue_utils.TASK_RUNNERS.items():
+        runners[kind] = importlib.import_module(module_name)
+    return runners
+
+def worker_loop(db_file, worker_id, poll_interval=5.0, exit_when_empty=True):
+    """
+    Take the tasks from the queue and run them one after another.
+
+    Args:
+
+     - db_file(str): path to the queue database
+
+     - worker_id(str): name of the worker to be stored with the tasks
+
+     - poll_interval(float): time (seconds) to wait before the next check, if
+     the queue is empty.
+
+     - exit_when_empty(bool): if True, the worker stops as soon as there are no
+     pending tasks in the queue. Otherwise, it keeps polling the queue.
+
+    Returns:
+
+     - n_tasks(int): number of the tasks processed by the worker
+    """
+    # the workers are forked from the same parent: draw the random state anew,
+    # otherwise all workers sample the same subtrees and dates
+    import numpy as np
+    np.random.seed()
+    runners = _warm_up()
+    n_tasks = 0
+    while True:
+        task = queue_utils.claim_task(db_file, worker_id)
+        if task is None:
+            if exit_when_empty:
+                break
+            time.sleep(poll_interval)
+            continue
+
+        task_id, kind, args = task
+        sys.stdout.write("Worker {}: task {} ({}): {}\n".format(worker_id, task_id, kind, " ".join(args)))
+        try:
+            runners[kind].main(args)
+        except Exception:
+            owned = queue_utils.finish_task(db_file, task_id, worker_id, error=traceback.format_exc())
+        else:
+            owned = queue_utils.finish_task(db_file, task_id, worker_id)
+        if not owned:
+            sys.stdout.write("Worker {}: task {} was requeued while running\n".format(worker_id, task_id))
+        n_tasks += 1
+
+    return n_tasks
+
+def _worker_main(db_file, idx, poll_interval, exit_when_empty):
+    """
+    Entry point of the worker process: the worker name contains the process id
+    of the worker itself (see queue_utils.worker_name)
+    """
+    worker_loop(db_file, queue_utils.worker_name(idx), poll_interval, exit_when_empty)
+
+def _pending_stages(db_file):
+    """
+    Names of the stages run by the tasks waiting in the queue
+    """
+    stages = set()
+    for kind in queue_utils.pending_kinds(db_file):
+        module = importlib.import_module(queue_utils.TASK_RUNNERS[kind])
+        stages.update(module.active_stages())
+    return sorted(stages)
+
+def run_service(db_file, n_workers, poll_interval=5.0, exit_when_empty=True, max_mem_gb=None,
+                requeue_running=False):
+    """
+    Start the worker processes and wait for them to finish. If the memory limit
+    is given, the number of workers is reduced so that the tasks fit into the
+    memory (see the resource profiles in utility_functions_cluster.py).
+
+    The tasks left running by the dead workers on this host are put back to the
+    queue. Other services may work on the same queue, so all running tasks are
+    requeued only with requeue_running (e.g. after all services were killed).
+    """
+    if requeue_running:
+        n_requeued = queue_utils.requeue_tasks(db_file, status='running')
+    else:
+        n_requeued = queue_utils.requeue_dead_tasks(db_file)
+    if n_requeued:
+        print ("Requeued {} interrupted tasks".format(n_requeued))
+
+    if max_mem_gb is not None:
+        stages = _pending_stages(db_file)
+        n_workers = cluster_utils.workers_per_node(stages, max_mem_gb, n_workers)
+        print ("Running {} workers for the stages: {}".format(n_workers, ", ".join(stages)))
+
+    workers = []
+    for idx in range(n_workers):
+        p = multiprocessing.Process(target=_worker_main,
+                args=(db_file, idx, poll_interval, exit_when_empty))
+        p.start()
+        workers.append(p)
+
+    for p in workers:
+        p.join()
+
+    print ("Queue status: {}".format(queue_utils.queue_status(db_file)))
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+            description="Run the validation tasks from the queue in the warm worker processes")
+    parser.add_argument('--queue', required = True, type = str, help ="Path to the queue database")
+    parser.add_argument('--workers', type = int, default=multiprocessing.cpu_count(),
+                        help ="Number of the worker processes")
+    parser.add_argument('--poll', type = float, default=5.0,
+                        help ="Time (seconds) between the checks of the empty queue")
+    parser.add_argument('--max-mem', type = float, default=None,
+                        help ="Memory (GB) available to all workers. Limits the number of workers")
+    parser.add_argument('--daemon', action='store_true',
+                        help ="Keep polling the queue when it is empty")
+    parser.add_argument('--retry-failed', action='store_true',
+                        help ="Put the failed tasks back to the queue before start")
+    parser.add_argument('--requeue-running', action='store_true',
+                        help ="Put all running tasks back to the queue before start. "
+                              "Use only if no other service works on the queue")
+
+    args = parser.parse_args()
+    if args.retry_failed:
+        queue_utils.requeue_tasks(args.queue, status='failed')
+
+    run_service(args.queue, args.workers, poll_interval=args.poll,
+                exit_when_empty=not args.daemon, max_mem_gb=args.max_mem,
+                requeue_running=args.requeue_running)
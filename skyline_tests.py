@@ -1,6 +1,6 @@
 from external_binaries import FFPOPSIM_SKYLINE_BIN
 from utility_functions_simulated_data import _ffpopsim_tree_aln_postprocess, generations_from_ffpopsim_tree
-import sys,os, glob
+import sys,os, re
 
 import numpy as np
 from treetime import TreeTime
@@ -65,14 +65,28 @@ def _run_ffpopsim_skyline(L=100, N=100, SAMPLE_NUM=10, SAMPLE_FREQ=5, SAMPLE_VOL
     return basename
 
 
+# fluctuation parameters of the skyline simulations, e.g.:
+# FFpopSim_L1000_N300_Ns40_Ts7_Nv20_Mu0.001_Amp0.5_Tfluct2.0_fluct3
+SKYLINE_NAME_REGEX = re.compile(r'_N(?P<N>\d+)_.*_Amp(?P<amp>[0-9.eE+-]+)_Tfluct(?P<period>[0-9.eE+-]+?)(?=_|\.[a-zA-Z]|$)')
+
+def skyline_params(base_name):
+    """
+    Parse the population size and the fluctuation parameters from the name of
+    the skyline simulation.
+
+    Returns:
+
+     - N(float), amp(float), period(float)
+    """
+    match = SKYLINE_NAME_REGEX.search(os.path.split(base_name)[-1])
+    if match is None:
+        raise ValueError("Not a skyline simulation name: {}".format(base_name))
+    return float(match.group('N')), float(match.group('amp')), float(match.group('period'))
+
 def estimate_skyline(base_name, plot=False):
     tree_file = base_name + ".opt.nwk"
     aln_file  = base_name + ".nuc.fasta"
-    params = (os.path.split(base_name)[-1]).split('_')
-    print(params)
-    period = float(params[-2][6:])
-    amp = float(params[-3][3:])
-    N = float(params[2][1:])
+    N, amp, period = skyline_params(base_name)
 
     generations = generations_from_ffpopsim_tree(tree_file)[1]
     T = TreeTime(tree=tree_file, aln=aln_file, dates=generations, gtr="JC69", real_dates=False)
@@ -94,41 +108,154 @@ def estimate_skyline(base_name, plot=False):
     informative_range = x.searchsorted(np.min([n.numdate for n in T.tree.root]))
     return period, amp, x[informative_range:], skyline.y[informative_range:], truePopSize[informative_range:]
 
-def save_estimate_skyline(period, amp, x, y, trueY, outfile):
-    with open(outfile, 'w') as of:
-        of.write("#period={}\n".format(period))
-        of.write("#amplitude={}\n".format(amp))
-        of.write("#x, y, trueY\n")
-        for (i,j,k) in zip(x, y, trueY):
-            of.write('{},{},{}\n'.format(i,j,k))
-
-def read_estimate_skyline(infile):
-    with open(infile, 'r') as inf:
-        ss = inf.readlines()
-
-    period = None
-    amp = None
-    x,y,trueY = [],[],[]
-
-    reading_arrays = False
-    for s in ss:
-        if s.startswith('#period'):
-            period = float(s.split('=')[-1].strip())
-        elif s.startswith('#amplitude'):
-            amp = float(s.split('=')[-1].strip())
-        elif s.startswith('#x, y, trueY'):
-            reading_arrays = True
-        elif reading_arrays:
-            try:
-                i,j,k = map(float, s.split(','))
-                x.append(i)
-                y.append(j)
-                trueY.append(k)
-            except:
-                reading_arrays = False
+def record_skyline(archive_dir, base_name, replicate, period, amp, x, y, trueY):
+    """
+    Record the skyline estimate to the results archive (see
+    utility_functions_results.py) as the 'skyline' method, one row per point
+    of the skyline: File, Period, Amp, Replicate, x, y, trueY and the
+    simulation parameters.
+
+    Returns:
+
+     - n_rows(int): number of the recorded rows
+    """
+    import utility_functions_results as results_utils
+
+    params = results_utils.ffpopsim_params(base_name)
+    if params is None:
+        raise ValueError("Cannot parse the simulation parameters: {}".format(base_name))
+    n_points = len(x)
+    columns = {k: [v] * n_points for k, v in params.items()}
+    columns.update({'File': [os.path.split(base_name)[-1]] * n_points,
+                    'Period': [period] * n_points, 'Amp': [amp] * n_points,
+                    'Replicate': [replicate] * n_points,
+                    'x': list(x), 'y': list(y), 'trueY': list(trueY)})
+    return results_utils.write_partition(archive_dir, "skyline", columns)
+
+def read_skyline_results(archive_dir, replicate=None, Mu=None):
+    """
+    Read the skyline estimates from the results archive.
+
+    Args:
+
+     - archive_dir(str): root directory of the results archive
+
+     - replicate(int or None): read only the given replicate of every grid
+     cell. All replicates, if None.
+
+     - Mu(list or None): mutation rates to read. All, if None.
+
+    Returns:
+
+     - res(list): (period, amp, x, y, trueY) of every run, as returned by
+     estimate_skyline
+    """
+    import utility_functions_results as results_utils
+
+    df = results_utils.read_results(archive_dir, "skyline", Mu=Mu)
+    if df.shape[0] == 0:
+        return []
+    if replicate is not None:
+        df = df[df['Replicate'] == replicate]
+    res = []
+    for (fname, period, amp), run in df.groupby(['File', 'Period', 'Amp'], sort=True):
+        run = run.sort_values('x')
+        res.append((period, amp, run['x'].values, run['y'].values, run['trueY'].values))
+    return res
+
+def _skyline_cell(task):
+    """
+    Simulate and estimate the skyline of one replicate of the grid cell in the
+    pool worker.
+
+    Returns:
+
+     - base_name(str): the simulation, None if failed
+    """
+    (L, N, SAMPLE_VOL, SAMPLE_NUM, SAMPLE_FREQ, MU, amp, period, replicate,
+     sim_dir, archive_dir, run_ffpopsim, run_treetime, seed) = task
+    # the forked processes would otherwise share the random state
+    np.random.seed(seed)
+    try:
+        if run_ffpopsim:
+            base_name = run_ffpopsim_simulation_skyline(L, N, SAMPLE_VOL, SAMPLE_NUM, SAMPLE_FREQ,
+                MU, amp, period, sim_dir, 'fluct{}'.format(replicate))
         else:
-            continue
-    return period, amp, x, y, trueY
+            base_name = os.path.join(sim_dir,
+                "FFpopSim_L{}_N{}_Ns{}_Ts{}_Nv{}_Mu{}_Amp{}_Tfluct{}_fluct".format(
+                L, N, SAMPLE_NUM, SAMPLE_FREQ, SAMPLE_VOL, MU, amp, period))
+            # the simulations without the replicates (suffix '_fluct') are
+            # used as the replicate 0
+            if replicate > 0 or os.path.exists(base_name + "0.opt.nwk") or \
+                    not os.path.exists(base_name + ".opt.nwk"):
+                base_name += str(replicate)
+        if run_treetime:
+            period, amp, x, y, trueY = estimate_skyline(base_name)
+            record_skyline(archive_dir, base_name, replicate, period, amp, x, y, trueY)
+        return base_name
+    except Exception as e:
+        print ("Skyline run failed (period={}, amplitude={}, replicate={}): {}".format(
+            period, amp, replicate, e))
+        return None
+
+def run_skyline_grid(L, N, SAMPLE_VOL, SAMPLE_NUM, SAMPLE_FREQ, MU, periods, amplitudes,
+                     sim_dir, archive_dir, n_replicates=1, run_ffpopsim=True,
+                     run_treetime=True, n_jobs=None):
+    """
+    Run the skyline study over the (period, amplitude) grid. Every replicate
+    of every grid cell (the FFpopSim simulation followed by the TreeTime
+    skyline estimation) is a separate task of the process pool. The
+    estimates are recorded to the results archive (see record_skyline).
+
+    Args:
+
+     - L, N, SAMPLE_VOL, SAMPLE_NUM, SAMPLE_FREQ, MU: simulation parameters
+     (see run_ffpopsim_simulation_skyline)
+
+     - periods(list): periods of the population size fluctuations
+
+     - amplitudes(list): amplitudes of the population size fluctuations
+
+     - sim_dir(str): directory of the simulated trees and alignments
+
+     - archive_dir(str): root directory of the results archive
+
+     - n_replicates(int): number of the simulations per grid cell
+
+     - run_ffpopsim(bool): run the simulations. Otherwise, the existing
+     simulations in the sim_dir are used. The simulations made without the
+     replicates (the '_fluct' suffix) are used as the replicate 0.
+
+     - run_treetime(bool): estimate the skylines
+
+     - n_jobs(int or None): number of the worker processes. One per CPU if
+     None, no pool if 1.
+
+    Returns:
+
+     - base_names(list): the simulations of the successful tasks
+    """
+    import multiprocessing
+
+    cells = [(period, amp, replicate)
+             for period in periods for amp in amplitudes for replicate in range(n_replicates)]
+    seeds = np.random.randint(0, 2**31 - 1, size=len(cells))
+    tasks = [(L, N, SAMPLE_VOL, SAMPLE_NUM, SAMPLE_FREQ, MU, amp, period, replicate,
+              sim_dir, archive_dir, run_ffpopsim, run_treetime, seed)
+             for (period, amp, replicate), seed in zip(cells, seeds)]
+    if n_jobs is None:
+        n_jobs = multiprocessing.cpu_count()
+    if n_jobs <= 1 or len(tasks) <= 1:
+        res = [_skyline_cell(k) for k in tasks]
+    else:
+        pool = multiprocessing.Pool(min(n_jobs, len(tasks)))
+        try:
+            # the tasks are long, send them one by one
+            res = pool.map(_skyline_cell, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    return [k for k in res if k is not None]
 
 if __name__=="__main__":
 
@@ -146,17 +273,10 @@ if __name__=="__main__":
     SampleSize = 20
     periods = [0.5, 2.0]
     bottle_necks = [0.5, 0.8, 0.9]
-    if RUN_FFPOPSIM:
-        for period in periods:
-            for amp in bottle_necks:
-                run_ffpopsim_simulation_skyline(L, N, SampleSize, Nsamples, DeltaT, mu, amp, period, sim_dir, 'fluct')
-
-
-    if RUN_TREETIME:
-        fnames = glob.glob(os.path.join(sim_dir,'FF*Mu0.001*fluct.nwk'))
-        res = []
-        for fname in fnames:
-            tmp = estimate_skyline(fname[:-4])
-            resname = os.path.join(resdir, os.path.split(fname)[-1].replace('_fluct.nwk', '_res.txt'))
-            save_estimate_skyline(tmp[0], tmp[1],tmp[2],tmp[3],tmp[4], resname)
-            res.append(tmp)
+    N_REPLICATES = 1
+    N_JOBS = None
+    archive_dir = os.path.join(resdir, '_archive')
+    if RUN_FFPOPSIM or RUN_TREETIME:
+        run_skyline_grid(L, N, SampleSize, Nsamples, DeltaT, mu, periods, bottle_necks,
+            sim_dir, archive_dir, n_replicates=N_REPLICATES, run_ffpopsim=RUN_FFPOPSIM,
+            run_treetime=RUN_TREETIME, n_jobs=N_JOBS)
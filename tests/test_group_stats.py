@@ -0,0 +1,71 @@
+"""
+The vectorised group statistics (utility_functions_stats.py) against the
+per-group loop, which they replace.
+"""
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import utility_functions_stats as stats_utils
+
+STATS = ['count', 'mean', 'std', 'median', 'q25', 'q75', 'iqr', 'min', 'max']
+
+def _loop_stats(keys, values, trim, ddof):
+    """
+    The statistics of every group computed group by group
+    """
+    groups = np.unique(keys)
+    res = {k: [] for k in STATS}
+    for group in groups:
+        x = np.sort(values[(keys == group) & ~np.isnan(values)])
+        x = x[int(np.floor(len(x) * trim)):int(np.floor(len(x) * (1. - trim)))]
+        res['count'].append(len(x))
+        if len(x) == 0:
+            for k in STATS[1:]:
+                res[k].append(np.nan)
+            continue
+        res['mean'].append(np.mean(x))
+        res['std'].append(np.std(x, ddof=ddof) if len(x) > ddof else np.nan)
+        q25, q50, q75 = np.percentile(x, [25, 50, 75])
+        res['median'].append(q50)
+        res['q25'].append(q25)
+        res['q75'].append(q75)
+        res['iqr'].append(q75 - q25)
+        res['min'].append(x.min())
+        res['max'].append(x.max())
+    return groups, {k: np.array(v, dtype=float) for k, v in res.items()}
+
+@pytest.mark.parametrize("trim", [0.0, 0.05, 0.25])
+@pytest.mark.parametrize("ddof", [0, 1])
+def test_against_loop(trim, ddof):
+    rng = np.random.RandomState(0)
+    # group sizes from 1 (trimmed to no values) to 20, with NaN values
+    keys = np.repeat(np.arange(12), rng.randint(1, 20, size=12))
+    rng.shuffle(keys)
+    values = rng.normal(size=len(keys))
+    values[rng.rand(len(keys)) < 0.05] = np.nan
+
+    groups, expected = _loop_stats(keys, values, trim, ddof)
+    res = stats_utils._group_column_stats(groups, keys, values, STATS, trim=trim, ddof=ddof)
+    for stat in STATS:
+        np.testing.assert_allclose(res[stat], expected[stat], equal_nan=True, err_msg=stat)
+
+def test_trimmed_to_empty_group():
+    # the single-value group is trimmed to no values: only its std is NaN
+    keys = np.array([1, 2, 2, 2, 2, 3, 3, 3])
+    values = np.arange(len(keys), dtype=float)
+    groups, expected = _loop_stats(keys, values, 0.05, 0)
+    res = stats_utils._group_column_stats(groups, keys, values, ['mean', 'std'], trim=0.05)
+    assert np.isnan(res['std'][0])
+    assert not np.isnan(res['std'][1:]).any()
+    np.testing.assert_allclose(res['std'], expected['std'], equal_nan=True)
+
+def test_group_stats_table():
+    pandas = pytest.importorskip("pandas")
+    df = pandas.DataFrame({'k': [1, 2, 2, 2, 2, 3, 3, 3], 'v': np.arange(8.)})
+    res = stats_utils.group_stats(df, 'k', ['v'], stats=['mean', 'std'], trim=0.05)
+    assert list(np.isnan(res['v_std'])) == [True, False, False]
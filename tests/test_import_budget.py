@@ -0,0 +1,64 @@
+"""
+Import-time budget of the worker scripts: the run scripts are started for
+every task, so their cold start should not load the heavy packages (they are
+imported on first use) and should stay within the time budget.
+
+The run scripts are python-2.7 code, so they are imported by the interpreter
+given in the WORKER_PYTHON environment variable ('python2' by default), each
+in a fresh process.
+"""
+
+import os
+import json
+import subprocess
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+WORKER_PYTHON = os.environ.get("WORKER_PYTHON", "python2")
+
+# seconds to import the run script, without the interpreter start
+IMPORT_BUDGET = float(os.environ.get("IMPORT_BUDGET", "1.0"))
+
+RUN_SCRIPTS = ["generate_flu_missingDates_dataset_run",
+               "generate_flu_subtrees_dataset_run",
+               "generate_simulated_dataset_run"]
+
+HEAVY_MODULES = ["treetime", "pandas", "scipy", "Bio", "matplotlib"]
+
+_CHILD = """
+import sys, time, json
+start = time.time()
+import {module}
+elapsed = time.time() - start
+print(json.dumps({{"elapsed": elapsed,
+                  "loaded": sorted(k for k in {heavy!r} if k in sys.modules)}}))
+"""
+
+def _cold_import(module):
+    out = subprocess.check_output(
+        [WORKER_PYTHON, "-c", _CHILD.format(module=module, heavy=HEAVY_MODULES)],
+        cwd=REPO_DIR)
+    return json.loads(out.decode("ascii").strip().splitlines()[-1])
+
+def _has_worker_python():
+    try:
+        return subprocess.call([WORKER_PYTHON, "-c", "import sys; sys.exit(sys.version_info[0] != 2)"],
+                               stdout=subprocess.DEVNULL if hasattr(subprocess, "DEVNULL") else None,
+                               stderr=subprocess.STDOUT) == 0
+    except OSError:
+        return False
+
+pytestmark = pytest.mark.skipif(not _has_worker_python(),
+                                reason="no python-2.7 interpreter {}".format(WORKER_PYTHON))
+
+@pytest.mark.parametrize("module", RUN_SCRIPTS)
+def test_no_heavy_imports(module):
+    assert _cold_import(module)["loaded"] == []
+
+@pytest.mark.parametrize("module", RUN_SCRIPTS)
+def test_import_time(module):
+    # the best of three runs, to be robust to the file system cache
+    elapsed = min(_cold_import(module)["elapsed"] for _ in range(3))
+    assert elapsed < IMPORT_BUDGET, "{} imports in {:.2f} s".format(module, elapsed)
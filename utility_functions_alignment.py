@@ -0,0 +1,389 @@
+#!/usr/bin/env python
+"""
+This module defines the access to the rows of the big reference alignments
+(e.g. the H3N2 HA alignment of the flu subtrees dataset) without parsing the
+whole FASTA file in every job.
+
+The alignment is converted once to the uint8 matrix (one row per sequence,
+NumPy .npy format) with the row index by the sequence name:
+
+    <name>.u8.npy      the sequences (n_sequences x alignment length)
+    <name>.u8.names    the sequence names, one per line, in the row order
+
+The jobs memory-map the matrix and take only the rows of the subtree leaves.
+The jobs on the same node share the matrix through the page cache.
+
+Alternatively, the rows are read directly from the FASTA file using the
+samtools-style index (<name>.fai: name, length, byte offset, bases per line,
+bytes per line), so that only the requested records are read from disk.
+
+The files are written to the cache directory (ALIGNMENT_CACHE_DIR), not next
+to the FASTA file; <name> is the FASTA file name with the hash of its absolute
+path. If the cache cannot be written, the alignment is read into memory.
+"""
+
+import os
+import uuid
+import hashlib
+import numpy as np
+
+# directory of the alignment matrices and the FASTA indices
+ALIGNMENT_CACHE_DIR = os.environ.get("ALIGNMENT_CACHE_DIR", "./.alignment_cache")
+
+def _cache_prefix(fasta, cache_dir=None):
+    """
+    Prefix of the cache files of the FASTA file
+    """
+    path_hash = hashlib.sha1(os.path.abspath(fasta).encode('utf-8')).hexdigest()[:12]
+    return os.path.join(cache_dir or ALIGNMENT_CACHE_DIR,
+                        "{}.{}".format(os.path.basename(fasta), path_hash))
+
+def alignment_matrix_files(fasta, cache_dir=None):
+    """
+    Paths to the matrix and the names files of the alignment
+    """
+    prefix = _cache_prefix(fasta, cache_dir)
+    return prefix + ".u8.npy", prefix + ".u8.names"
+
+def _fasta_records(fasta):
+    """
+    Iterate over the (name, sequence) records of the FASTA file. The name is
+    the first word of the header line (as Biopython's record name).
+    """
+    name, seq = None, []
+    with open(fasta) as inf:
+        for line in inf:
+            line = line.strip()
+            if line.startswith('>'):
+                if name is not None:
+                    yield name, "".join(seq)
+                name, seq = line[1:].split(None, 1)[0] if len(line) > 1 else '', []
+            elif line:
+                seq.append(line)
+    if name is not None:
+        yield name, "".join(seq)
+
+def _makedirs(fname):
+    folder = os.path.dirname(fname)
+    if folder and not os.path.exists(folder):
+        try:
+            os.makedirs(folder)
+        except OSError:
+            # created by another process
+            if not os.path.isdir(folder):
+                raise
+
+def convert_alignment_to_matrix(fasta, cache_dir=None):
+    """
+    Convert the FASTA alignment to the uint8 matrix and the names files. The
+    file is read in two passes (to get the matrix size and to fill it), so
+    that the whole alignment is never kept in memory. The files are written
+    under temporary names and renamed at the end, so concurrent jobs see
+    either no matrix or the complete one.
+
+    Args:
+
+     - fasta(str): path to the alignment
+
+     - cache_dir(str or None): cache directory, ALIGNMENT_CACHE_DIR if None
+
+    Returns:
+
+     - n_seqs(int), seq_len(int): shape of the matrix
+    """
+    matrix_file, names_file = alignment_matrix_files(fasta, cache_dir)
+    _makedirs(matrix_file)
+    n_seqs, seq_len = 0, None
+    for name, seq in _fasta_records(fasta):
+        if seq_len is None:
+            seq_len = len(seq)
+        elif len(seq) != seq_len:
+            raise ValueError("Sequences are not aligned: {} has length {}, expected {}".format(
+                name, len(seq), seq_len))
+        n_seqs += 1
+
+    tmp = "." + uuid.uuid4().hex
+    try:
+        matrix = np.lib.format.open_memmap(matrix_file + tmp, mode='w+', dtype=np.uint8,
+                                           shape=(n_seqs, seq_len or 0))
+        with open(names_file + tmp, 'w') as of:
+            for idx, (name, seq) in enumerate(_fasta_records(fasta)):
+                matrix[idx] = np.frombuffer(seq.encode('ascii'), dtype=np.uint8)
+                of.write(name + "\n")
+        matrix.flush()
+        del matrix
+        os.rename(names_file + tmp, names_file)
+        os.rename(matrix_file + tmp, matrix_file)
+    except (IOError, OSError):
+        for fname in [matrix_file + tmp, names_file + tmp]:
+            if os.path.exists(fname):
+                os.remove(fname)
+        raise
+    return n_seqs, seq_len
+
+def _read_alignment_matrix(fasta):
+    """
+    Read the alignment to the in-memory uint8 matrix, when the cache cannot be
+    written
+    """
+    names, seqs = [], []
+    for name, seq in _fasta_records(fasta):
+        if seqs and len(seq) != len(seqs[0]):
+            raise ValueError("Sequences are not aligned: {} has length {}, expected {}".format(
+                name, len(seq), len(seqs[0])))
+        names.append(name)
+        seqs.append(np.frombuffer(seq.encode('ascii'), dtype=np.uint8))
+    matrix = np.array(seqs, dtype=np.uint8).reshape(len(seqs), len(seqs[0]) if seqs else 0)
+    return matrix, {name: idx for idx, name in enumerate(names)}
+
+def _matrix_is_current(fasta, cache_dir=None):
+    matrix_file, names_file = alignment_matrix_files(fasta, cache_dir)
+    if not (os.path.exists(matrix_file) and os.path.exists(names_file)):
+        return False
+    return os.path.getmtime(matrix_file) >= os.path.getmtime(fasta)
+
+# opened matrices, kept between the calls in the warm worker processes
+_matrix_cache = {}
+
+def open_alignment_matrix(fasta, cache_dir=None):
+    """
+    Memory-map the alignment matrix. The matrix is created if it does not exist
+    or is older than the FASTA file. If the matrix cannot be written or read,
+    the alignment is read into memory.
+
+    Args:
+
+     - fasta(str): path to the alignment
+
+     - cache_dir(str or None): cache directory, ALIGNMENT_CACHE_DIR if None
+
+    Returns:
+
+     - matrix(numpy.memmap or numpy.array): the alignment matrix (uint8
+     character codes)
+
+     - rows(dict): row index by the sequence name
+    """
+    key = os.path.abspath(fasta)
+    if key in _matrix_cache:
+        return _matrix_cache[key]
+
+    try:
+        if not _matrix_is_current(fasta, cache_dir):
+            convert_alignment_to_matrix(fasta, cache_dir)
+        matrix_file, names_file = alignment_matrix_files(fasta, cache_dir)
+        matrix = np.load(matrix_file, mmap_mode='r')
+        with open(names_file) as inf:
+            rows = {name.strip(): idx for idx, name in enumerate(inf)}
+    except (IOError, OSError):
+        matrix, rows = _read_alignment_matrix(fasta)
+    _matrix_cache[key] = (matrix, rows)
+    return matrix, rows
+
+def alignment_matrix_rows(fasta, names, cache_dir=None):
+    """
+    Take the rows of the given sequences from the alignment matrix.
+
+    Args:
+
+     - fasta(str): path to the alignment
+
+     - names(list): names of the sequences
+
+     - cache_dir(str or None): cache directory, ALIGNMENT_CACHE_DIR if None
+
+    Returns:
+
+     - seqs(numpy.array): the sequences (len(names) x alignment length, uint8),
+     in the order of the names
+    """
+    matrix, rows = open_alignment_matrix(fasta, cache_dir)
+    missing = [k for k in names if k not in rows]
+    if missing:
+        raise KeyError("Sequences not found in {}: {}".format(fasta, ", ".join(missing[:10])))
+    idxs = np.array([rows[k] for k in names], dtype=int)
+    # sorted reads are sequential in the memory-mapped file
+    order = np.argsort(idxs)
+    seqs = np.empty((len(idxs), matrix.shape[1]), dtype=np.uint8)
+    seqs[order] = matrix[idxs[order]]
+    return seqs
+
+def matrix_to_alignment(names, seqs):
+    """
+    Create the Biopython alignment from the sequence names and the uint8
+    sequence matrix.
+    """
+    from Bio.Align import MultipleSeqAlignment
+    from Bio.SeqRecord import SeqRecord
+    from Bio.Seq import Seq
+
+    return MultipleSeqAlignment([
+        SeqRecord(Seq(seq.tostring().decode('ascii')), id=name, name=name, description='')
+        for name, seq in zip(names, seqs)])
+
+def subtree_alignment(fasta, tree, cache_dir=None):
+    """
+    Alignment of the leaves of the tree, taken from the memory-mapped matrix of
+    the big alignment.
+
+    Args:
+
+     - fasta(str): path to the big alignment
+
+     - tree(str or Biopython tree): the (sub)tree
+
+     - cache_dir(str or None): cache directory, ALIGNMENT_CACHE_DIR if None
+
+    Returns:
+
+     - aln(MultipleSeqAlignment): alignment of the tree leaves
+    """
+    if isinstance(tree, str):
+        from Bio import Phylo
+        tree = Phylo.read(tree, 'newick')
+    names = [k.name for k in tree.get_terminals()]
+    return matrix_to_alignment(names, alignment_matrix_rows(fasta, names, cache_dir))
+
+def fasta_index_file(fasta, cache_dir=None):
+    """
+    Path to the index file of the FASTA file
+    """
+    return _cache_prefix(fasta, cache_dir) + ".fai"
+
+def build_fasta_index(fasta, cache_dir=None):
+    """
+    Index the FASTA file: for every record, store the sequence length, the byte
+    offset of the sequence start, the number of bases per line and the number of
+    bytes per line (the samtools faidx format). As in samtools, all sequence
+    lines of the record except the last one should have the same length.
+
+    Args:
+
+     - fasta(str): path to the FASTA file
+
+     - cache_dir(str or None): cache directory, ALIGNMENT_CACHE_DIR if None.
+     If the index cannot be written there, it is only returned.
+
+    Returns:
+
+     - index(dict): {name: (length, offset, line_bases, line_bytes)}
+    """
+    index = {}
+    names = []
+    record = None
+
+    def _close(record):
+        name, length, offset, line_bases, line_bytes, lines = record
+        # all lines but the last should be full
+        if any(k != line_bases for k in lines[:-1]) or (lines and lines[-1] > line_bases):
+            raise ValueError("Record {} in {} has lines of different length, cannot index".format(name, fasta))
+        index[name] = (length, offset, line_bases, line_bytes)
+        names.append(name)
+
+    offset = 0
+    with open(fasta, 'rb') as inf:
+        for line in inf:
+            line_len = len(line)
+            stripped = line.rstrip(b'\r\n')
+            if stripped.startswith(b'>'):
+                if record is not None:
+                    _close(record)
+                header = stripped[1:].decode('ascii').split()
+                name = header[0] if header else ''
+                record = [name, 0, offset + line_len, None, None, []]
+            elif record is not None and stripped:
+                if record[3] is None:
+                    record[3], record[4] = len(stripped), line_len
+                record[1] += len(stripped)
+                record[5].append(len(stripped))
+            offset += line_len
+    if record is not None:
+        _close(record)
+
+    index_file = fasta_index_file(fasta, cache_dir)
+    tmp = index_file + "." + uuid.uuid4().hex
+    try:
+        _makedirs(index_file)
+        with open(tmp, 'w') as of:
+            for name in names:
+                length, start, line_bases, line_bytes = index[name]
+                of.write("{}\t{}\t{}\t{}\t{}\n".format(name, length, start, line_bases or 0, line_bytes or 0))
+        os.rename(tmp, index_file)
+    except (IOError, OSError):
+        # the cache is not writable, use the index in memory
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return index
+
+def read_fasta_index(fasta, cache_dir=None):
+    """
+    Read the index of the FASTA file. The index is built if it does not exist
+    or is older than the FASTA file.
+
+    Returns:
+
+     - index(dict): {name: (length, offset, line_bases, line_bytes)}
+    """
+    index_file = fasta_index_file(fasta, cache_dir)
+    if not os.path.exists(index_file) or os.path.getmtime(index_file) < os.path.getmtime(fasta):
+        return build_fasta_index(fasta, cache_dir)
+    index = {}
+    with open(index_file) as inf:
+        for line in inf:
+            name, length, offset, line_bases, line_bytes = line.rstrip('\n').split('\t')[:5]
+            index[name] = (int(length), int(offset), int(line_bases), int(line_bytes))
+    return index
+
+def extract_rows(fasta, names, packed=False, cache_dir=None):
+    """
+    Read only the given records from the FASTA file using its index.
+
+    Args:
+
+     - fasta(str): path to the FASTA file
+
+     - names(list): names of the records to read
+
+     - packed(bool): return the uint8 matrix instead of the Biopython alignment
+
+     - cache_dir(str or None): cache directory of the index,
+     ALIGNMENT_CACHE_DIR if None
+
+    Returns:
+
+     - aln(MultipleSeqAlignment or numpy.array): the records in the order of
+     the names. The matrix (len(names) x sequence length, uint8 character
+     codes) requires the sequences to be aligned.
+    """
+    index = read_fasta_index(fasta, cache_dir)
+    missing = [k for k in names if k not in index]
+    if missing:
+        raise KeyError("Sequences not found in {}: {}".format(fasta, ", ".join(missing[:10])))
+
+    seqs = {}
+    with open(fasta, 'rb') as inf:
+        # read in the file order
+        for name in sorted(set(names), key=lambda k: index[k][1]):
+            length, offset, line_bases, line_bytes = index[name]
+            if length == 0:
+                seqs[name] = b''
+                continue
+            n_lines = (length + line_bases - 1) // line_bases
+            inf.seek(offset)
+            raw = inf.read(length + (n_lines - 1) * (line_bytes - line_bases))
+            seqs[name] = raw.replace(b'\r', b'').replace(b'\n', b'')
+
+    if packed:
+        lengths = set(len(seqs[k]) for k in names)
+        if len(lengths) > 1:
+            raise ValueError("Sequences are not aligned, cannot pack to the matrix")
+        return np.array([np.frombuffer(seqs[k], dtype=np.uint8) for k in names], dtype=np.uint8).reshape(
+            len(names), lengths.pop() if lengths else 0)
+
+    return matrix_to_alignment(names, [np.frombuffer(seqs[k], dtype=np.uint8) for k in names])
+
+if __name__ == '__main__':
+    import sys
+    # convert the alignments given in the command line
+    for fname in sys.argv[1:]:
+        print ("{}: {} sequences of length {}".format(fname, *convert_alignment_to_matrix(fname)))
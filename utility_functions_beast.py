@@ -3,15 +3,12 @@
 This module defines functions used to facilitate the Beast run from other scripts
 and to parse the Beast output results.
 """
-import pandas
 import xml.etree.ElementTree as XML
 import utility_functions_general as gen_utils
 import os, sys
 import subprocess
-from Bio import AlignIO, Phylo
 import StringIO
 from external_binaries import BEAST_BIN
-import treetime
 
 def read_beast_log(logfile, nearest_leaf_date, take_last_lines=500):
     """
@@ -35,6 +32,7 @@ def read_beast_log(logfile, nearest_leaf_date, take_last_lines=500):
      - LogFile parsed as pandas dataframe is there is enough data lines
      (specified by take_last_lines). None otherwise.
     """
+    import pandas
 
     with open(logfile) as inlog:
         ss = inlog.readlines()
@@ -75,6 +73,7 @@ def create_beast_xml(tree, aln, dates, log_file, template_file):
 
      - config as ElementTree.Xml object
     """
+    from Bio import Phylo
 
     def _set_taxa_dates(xml_root, tree, dates):
 
@@ -112,7 +111,7 @@ def create_beast_xml(tree, aln, dates, log_file, template_file):
         xml_aln = xml_root.find('alignment')
 
         if tree is not None:
-            leaf_names = [k.name for k in tree.get_terminals()]
+            leaf_names = set([k.name for k in tree.get_terminals()])
         else:
             leaf_names = None
 
@@ -219,10 +218,13 @@ def create_beast_xml(tree, aln, dates, log_file, template_file):
 
     # prepare input data
     if isinstance(tree, str):
-        tree = Phylo.read(tree, 'newick')
+        import utility_functions_tree as tree_utils
+        tree = tree_utils.read_newick(tree).to_biopython()
 
     if isinstance(aln, str):
-        aln = AlignIO.read(aln, 'fasta')
+        # read only the sequences of the tree leaves (using the FASTA index)
+        import utility_functions_alignment as aln_utils
+        aln = aln_utils.extract_rows(aln, [k.name for k in tree.get_terminals()])
 
     # read template
     xml = XML.parse(template_file)
@@ -0,0 +1,436 @@
+#!/usr/bin/env python
+"""
+This module defines the resource profiles of the validation stages (BEAST,
+TreeTime, LSD, FFpopSim) and the functions to compose the cluster submit
+commands, which request only the resources needed by the enabled stages.
+
+The profiles are learned from the peak memory and the runtime recorded by the
+run scripts. Until there are enough records for a stage, the defaults below are
+used.
+"""
+
+import os
+import time
+import resource
+import contextlib
+
+# default file to record the resource usage of the stages
+RESOURCE_PROFILE = "./resource_profile.csv"
+
+# default resources per stage: memory in GB, runtime in hours. BEAST runs in the
+# Java virtual machine and requires a lot of memory just to be started.
+STAGE_DEFAULTS = {
+    'beast' : {'mem_gb' : 50.0, 'runtime_h' : 22.0},
+    'treetime' : {'mem_gb' : 3.0, 'runtime_h' : 0.5},
+    'lsd' : {'mem_gb' : 1.0, 'runtime_h' : 0.1},
+    'ffpopsim' : {'mem_gb' : 2.0, 'runtime_h' : 0.5},
+    'subtree' : {'mem_gb' : 2.0, 'runtime_h' : 0.2},
+    'topology' : {'mem_gb' : 1.0, 'runtime_h' : 0.05},
+}
+
+# minimal number of records to use the learned profile instead of the default
+MIN_RECORDS = 5
+
+# the learned values are multiplied by this factor to leave some headroom
+SAFETY_FACTOR = 1.5
+
+# maximal runtime (hours) to request: the jobs should stay under the 24h limit
+# of the default queue
+MAX_RUNTIME_H = 23. + 59. / 60.
+
+# stages measured in this process (see stage_usage)
+_measured_stages = []
+
+def _reset_peak_rss():
+    """
+    Reset the peak resident memory of the current process (Linux only).
+
+    Returns:
+
+     - reset(bool): whether the peak was reset
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as of:
+            of.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+def _self_peak_rss_mb():
+    """
+    Peak resident memory (MB) of the current process since the last reset
+    (VmHWM), None if not available
+    """
+    try:
+        with open('/proc/self/status') as inf:
+            for line in inf:
+                if line.startswith('VmHWM:'):
+                    return float(line.split()[1]) / 1024.
+    except (IOError, OSError):
+        pass
+    return None
+
+def _stage_peak_rss_mb(first, reset, children_before):
+    """
+    Peak resident memory (MB) of the stage: of the current process and of the
+    child processes (LSD, BEAST, FFpopSim) finished during the stage,
+    whichever is larger. ru_maxrss is the maximum over the process lifetime,
+    so only the stages, which can be measured separately, get the value:
+
+     - the current process: the peak was reset before the stage (VmHWM), or
+     this is the first stage in the process
+
+     - the children: the children maximum grew during the stage, or no child
+     ran during the stage, or this is the first stage in the process
+
+    Returns:
+
+     - peak_rss_mb(float): the peak memory, None if it cannot be measured
+    """
+    # NOTE ru_maxrss is in kilobytes on Linux
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    if first or children.ru_maxrss > children_before.ru_maxrss:
+        children_rss = children.ru_maxrss / 1024.
+    elif children.ru_utime + children.ru_stime > children_before.ru_utime + children_before.ru_stime:
+        # the children of the stage are hidden by a heavier earlier child
+        return None
+    else:
+        children_rss = 0.
+
+    self_rss = _self_peak_rss_mb() if reset else None
+    if self_rss is None:
+        if not first:
+            return None
+        self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+    return max(self_rss, children_rss)
+
+def record_stage_usage(stage, runtime, peak_rss_mb, profile_file=RESOURCE_PROFILE):
+    """
+    Append the resource usage of a finished stage to the profile file.
+
+    Args:
+
+     - stage(str): name of the stage, one of the STAGE_DEFAULTS keys
+
+     - runtime(float): runtime of the stage in seconds
+
+     - peak_rss_mb(float): peak memory used by the stage in MB
+
+     - profile_file(str): CSV file to store the records
+    """
+    from utility_functions_general import write_results_line
+    write_results_line(profile_file, ["Stage", "Runtime(sec)", "PeakRSS(MB)"],
+        [stage, runtime, peak_rss_mb])
+
+@contextlib.contextmanager
+def stage_usage(stage, profile_file=RESOURCE_PROFILE):
+    """
+    Context manager to measure the runtime and the peak memory of the stage and
+    record them to the profile file. The stage is recorded only if it finished
+    without exception, and if its peak memory can be told apart from the
+    earlier stages in the same process (see _stage_peak_rss_mb).
+    """
+    first = not _measured_stages
+    reset = _reset_peak_rss()
+    children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.time()
+    yield
+    runtime = time.time() - start
+    _measured_stages.append(stage)
+    peak_rss_mb = _stage_peak_rss_mb(first, reset, children_before)
+    if peak_rss_mb is None:
+        return
+    try:
+        record_stage_usage(stage, runtime, peak_rss_mb, profile_file)
+    except IOError:
+        pass
+
+def read_stage_profiles(profile_file=RESOURCE_PROFILE):
+    """
+    Read the recorded resource usage and compute the resources to request for
+    each stage. For the stages with enough records, the maximal recorded values
+    (times SAFETY_FACTOR) are used, the defaults are used otherwise.
+
+    Returns:
+
+     - profiles(dict): dictionary in format {stage: {'mem_gb': float,
+     'runtime_h': float}}
+    """
+    profiles = {k: dict(v) for k, v in STAGE_DEFAULTS.items()}
+    if profile_file is None or not os.path.exists(profile_file):
+        return profiles
+
+    records = {}
+    with open(profile_file) as inf:
+        for line in inf:
+            if line.startswith('#'):
+                continue
+            try:
+                stage, runtime, rss = line.strip().split(',')
+                records.setdefault(stage, []).append((float(runtime), float(rss)))
+            except ValueError:
+                continue
+
+    for stage, stage_records in records.items():
+        if len(stage_records) < MIN_RECORDS:
+            continue
+        runtime = max(k[0] for k in stage_records)
+        rss = max(k[1] for k in stage_records)
+        profiles[stage] = {
+            'mem_gb' : SAFETY_FACTOR * rss / 1024.,
+            'runtime_h' : SAFETY_FACTOR * runtime / 3600.}
+    return profiles
+
+def job_resources(stages, profile_file=RESOURCE_PROFILE):
+    """
+    Resources needed to run the given stages one after another in a single job.
+
+    Args:
+
+     - stages(list): names of the stages to be run in the job
+
+     - profile_file(str): file with the recorded resource usage
+
+    Returns:
+
+     - mem_gb(float): memory to request (maximum over the stages)
+
+     - runtime_h(float): runtime to request (sum over the stages)
+    """
+    profiles = read_stage_profiles(profile_file)
+    unknown = [k for k in stages if k not in profiles]
+    if unknown:
+        raise ValueError("Unknown stages: {}".format(", ".join(unknown)))
+    if len(stages) == 0:
+        return min(k['mem_gb'] for k in profiles.values()), 0.1
+
+    mem_gb = max(profiles[k]['mem_gb'] for k in stages)
+    runtime_h = sum(profiles[k]['runtime_h'] for k in stages)
+    return mem_gb, runtime_h
+
+def _format_runtime(runtime_h, max_runtime_h=None):
+    """
+    Convert the runtime in hours to the HH:MM:SS format. The runtime is capped
+    by max_runtime_h (MAX_RUNTIME_H if None).
+    """
+    if max_runtime_h is None:
+        max_runtime_h = MAX_RUNTIME_H
+    seconds = int(runtime_h * 3600) + 60  # at least one minute
+    seconds = min(seconds, int(round(max_runtime_h * 3600)))
+    return "{}:{:02d}:{:02d}".format(seconds // 3600, (seconds % 3600) // 60, seconds % 60)
+
+def _format_mem(mem_gb):
+    """
+    Round the memory up to whole gigabytes
+    """
+    return "{}G".format(int(-(-mem_gb // 1)))
+
+def submit_call(script, stages, scheduler='sge', profile_file=RESOURCE_PROFILE, cpus=1, runtime_scale=1.0,
+                max_runtime_h=None):
+    """
+    Compose the command to submit the script to the cluster. The requested
+    memory and runtime are computed from the resource profiles of the stages.
+    The script arguments should be appended to the returned list.
+
+    Args:
+
+     - script(str): path to the script to run
+
+     - stages(list): names of the stages run by the script
+
+     - scheduler(str): 'sge' for the Sun Grid Engine (qsub), or 'slurm' (sbatch)
+
+     - profile_file(str): file with the recorded resource usage
+
+     - cpus(int): number of CPUs to request
+
+     - runtime_scale(float): factor to multiply the runtime by, for the jobs
+     which run the stages several times (e.g. in a batch)
+
+     - max_runtime_h(float or None): cap of the requested runtime (hours),
+     MAX_RUNTIME_H if None
+
+    Returns:
+
+     - call(list): the submit command
+    """
+    mem_gb, runtime_h = job_resources(stages, profile_file)
+    runtime_h *= runtime_scale
+    if scheduler == 'sge':
+        call = ['qsub', '-cwd', '-b','y',
+                '-l', 'h_rt=' + _format_runtime(runtime_h, max_runtime_h),
+                # NOTE h_vmem is requested per slot
+                '-l', 'h_vmem=' + _format_mem(mem_gb)]
+        if cpus > 1:
+            call.extend(['-pe', 'smp', str(cpus)])
+    elif scheduler == 'slurm':
+        call = ['sbatch',
+                '--time=' + _format_runtime(runtime_h, max_runtime_h),
+                '--mem=' + _format_mem(mem_gb * cpus),
+                '--cpus-per-task=' + str(cpus)]
+    else:
+        raise ValueError("Unknown scheduler: {}".format(scheduler))
+    call.append(script)
+    return call
+
+def workers_per_node(stages, node_mem_gb, node_cpus, profile_file=RESOURCE_PROFILE):
+    """
+    Number of the tasks running the given stages, which can be packed on a
+    single node (or the local machine) without exceeding its memory and CPUs.
+    """
+    mem_gb, runtime_h = job_resources(stages, profile_file)
+    return max(1, min(int(node_cpus), int(node_mem_gb // mem_gb)))
+
+def worker_service_call(queue_file, stages, node_mem_gb, node_cpus, scheduler='sge',
+                        profile_file=RESOURCE_PROFILE):
+    """
+    Compose the command to submit the worker service (run_worker_service.py) to
+    the cluster. The service job takes a whole node and runs as many workers as
+    the resource profiles of the stages allow. This is the way to pack many
+    light (TreeTime, LSD) tasks onto a node.
+
+    Returns:
+
+     - call(list): the submit command, including the service arguments
+    """
+    n_workers = workers_per_node(stages, node_mem_gb, node_cpus, profile_file)
+    mem_gb, runtime_h = job_resources(stages, profile_file)
+    if scheduler == 'sge':
+        call = ['qsub', '-cwd', '-b','y',
+                '-l', 'h_rt=' + _format_runtime(MAX_RUNTIME_H),
+                '-l', 'h_vmem=' + _format_mem(mem_gb),
+                '-pe', 'smp', str(n_workers)]
+    elif scheduler == 'slurm':
+        call = ['sbatch',
+                '--time=' + _format_runtime(MAX_RUNTIME_H),
+                '--mem=' + _format_mem(mem_gb * n_workers),
+                '--cpus-per-task=' + str(n_workers)]
+    else:
+        raise ValueError("Unknown scheduler: {}".format(scheduler))
+    call.extend(['./run_worker_service.py', '--queue', queue_file,
+                 '--workers', str(n_workers)])
+    return call
+
+# environment variables with the (1-based) index of the array task
+ARRAY_TASK_ID_VARS = ['SGE_TASK_ID', 'SLURM_ARRAY_TASK_ID']
+
+def write_task_file(task_file, kind, args_list):
+    """
+    Write the parameter grid to the task file for the array job. The first line
+    is the task type, every next line is the list of the command line arguments
+    of a single task (JSON-encoded). The task N of the array job runs the
+    arguments from line N+1.
+
+    Args:
+
+     - task_file(str): path to the task file. Overwritten if exists.
+
+     - kind(str): type of the tasks, one of the TASK_RUNNERS keys (see
+     utility_functions_queue.py)
+
+     - args_list(list): list of the task arguments. Each entry is the list of
+     the command line arguments for the corresponding run script.
+
+    Returns:
+
+     - n_tasks(int): number of the tasks written to the file
+    """
+    import json
+    from utility_functions_queue import TASK_RUNNERS
+    if kind not in TASK_RUNNERS:
+        raise ValueError("Unknown task type: {}".format(kind))
+
+    folder = os.path.split(task_file)[0]
+    if folder != "" and not os.path.exists(folder):
+        try:
+            os.makedirs(folder)
+        except:
+            pass
+
+    with open(task_file, 'w') as of:
+        of.write("#{}\n".format(kind))
+        for args in args_list:
+            of.write(json.dumps([str(k) for k in args]) + "\n")
+    return len(args_list)
+
+def read_task(task_file, task_id):
+    """
+    Read the task with the given (1-based) index from the task file.
+
+    Returns:
+
+     - (kind, args) tuple: type of the task and its command line arguments
+    """
+    import json
+    with open(task_file) as inf:
+        kind = inf.readline().strip().lstrip('#')
+        for idx, line in enumerate(inf):
+            if idx + 1 == task_id:
+                return kind, [str(k) for k in json.loads(line)]
+    raise ValueError("Task {} not found in {}".format(task_id, task_file))
+
+def array_task_id():
+    """
+    Index of the current array task as set by the scheduler (SGE or Slurm), or
+    None if the process is not an array job task.
+    """
+    for var in ARRAY_TASK_ID_VARS:
+        # NOTE SGE sets the variable to 'undefined' for the non-array jobs
+        value = os.environ.get(var, '')
+        if value.isdigit():
+            return int(value)
+    return None
+
+def array_job_call(task_file, n_tasks, stages, scheduler='sge', profile_file=RESOURCE_PROFILE,
+                   max_running=None, max_runtime_h=None):
+    """
+    Compose the command to submit all tasks from the task file as a single
+    array job. Every array task runs run_array_task.py, which picks its row of
+    the task file by the task index. The resources are requested per task, as
+    in submit_call.
+
+    Args:
+
+     - task_file(str): path to the task file (see write_task_file)
+
+     - n_tasks(int): number of the tasks in the file
+
+     - stages(list): names of the stages run by every task
+
+     - scheduler(str): 'sge' for the Sun Grid Engine (qsub), or 'slurm' (sbatch)
+
+     - profile_file(str): file with the recorded resource usage
+
+     - max_running(int): maximal number of the tasks running at the same time.
+     No limit if None.
+
+     - max_runtime_h(float or None): cap of the requested runtime (hours),
+     MAX_RUNTIME_H if None
+
+    Returns:
+
+     - call(list): the submit command
+    """
+    mem_gb, runtime_h = job_resources(stages, profile_file)
+    if scheduler == 'sge':
+        call = ['qsub', '-cwd', '-b','y',
+                '-l', 'h_rt=' + _format_runtime(runtime_h, max_runtime_h),
+                '-l', 'h_vmem=' + _format_mem(mem_gb),
+                '-t', '1-{}'.format(n_tasks)]
+        if max_running is not None:
+            call.extend(['-tc', str(max_running)])
+    elif scheduler == 'slurm':
+        array = '1-{}'.format(n_tasks)
+        if max_running is not None:
+            array += '%{}'.format(max_running)
+        call = ['sbatch',
+                '--time=' + _format_runtime(runtime_h, max_runtime_h),
+                '--mem=' + _format_mem(mem_gb),
+                '--array=' + array]
+    else:
+        raise ValueError("Unknown scheduler: {}".format(scheduler))
+    call.extend(['./run_array_task.py', task_file])
+    return call
+
+if __name__ == '__main__':
+    pass
@@ -5,19 +5,14 @@ to Flu trees and alignments.
 """
 
 import numpy as np
-from Bio import AlignIO, Phylo
-from Bio.Align import  MultipleSeqAlignment
-import random
 import subprocess
 import datetime
-import os, copy
-import matplotlib.pyplot as plt
-from scipy.stats import linregress
+import os
+import copy
 from collections import Counter
-import StringIO
-import treetime
 from utility_functions_general import remove_polytomies
-from utility_functions_beast import run_beast, create_beast_xml, read_beast_log
+import utility_functions_tree as tree_utils
+from utility_functions_beast import create_beast_xml, read_beast_log
 import xml.etree.ElementTree as XML
 from external_binaries import BEAST_BIN
 
@@ -90,6 +85,7 @@ def dates_from_flu_tree(tree):
      - dates(dict): dictionary of dates in format {seq_name: numdate}. Only the
      entries which were parsed successfully are included.
     """
+    from Bio import Phylo
 
     if isinstance(tree, str):
         tree = Phylo.read(tree, 'newick')
@@ -111,11 +107,16 @@ def subtree_with_same_root(tree, Nleaves, outfile, optimize=True):
 
      - outfile(str): path to save the resulting subtree
 
-     optimize(bool): perform branch length optimization for the subtree?
+     optimize(bool): perform branch length optimization for the subtree? If
+     True, the snapshot of the optimized subtree with its alignment is also
+     written to <outfile without extension>.opt.snapshot (see
+     utility_functions_snapshot.py)
 
     Returns:
      - tree(Biopython tree): the subtree
     """
+    from Bio import Phylo
+
     if isinstance(tree, str):
         treecopy = Phylo.read(tree, 'newick')
     else:
@@ -146,20 +147,22 @@ def subtree_with_same_root(tree, Nleaves, outfile, optimize=True):
     right_sample_idx = np.random.choice(np.arange(len(right_terminals)), size=n_right_sampled, replace=False)
     right_sample = [right_terminals[i] for i in right_sample_idx]
 
-    for leaf in treecopy.get_terminals():
-        if leaf not in right_sample and leaf not in left_sample:
-            treecopy.prune(leaf)
-        else:
-            pass
-            #print ("leaving leaf {} in the tree".format(leaf.name))
+    # prune the rest of the leaves in one pass over the tree arrays
+    compact = tree_utils.CompactTree.from_biopython(treecopy)
+    sample = [k.name for k in left_sample + right_sample]
+    treecopy = compact.subtree(compact.leaf_mask(sample)).to_biopython()
 
     if optimize:
         import treetime
+        import utility_functions_alignment as aln_utils
         dates = dates_from_flu_tree(treecopy)
-        aln = './resources/flu_H3N2/H3N2_HA_2011_2013.fasta'
+        # only the subtree rows of the memory-mapped reference alignment
+        aln = aln_utils.subtree_alignment('./resources/flu_H3N2/H3N2_HA_2011_2013.fasta', treecopy)
         tt = treetime.TreeAnc(tree=treecopy, aln=aln,gtr='Jukes-Cantor')
         tt.optimize_seq_and_branch_len(prune_short=False)
         Phylo.write(tt.tree, outfile, 'newick')
+        import utility_functions_snapshot as snapshot_utils
+        snapshot_utils.write_treeanc_snapshot(os.path.splitext(outfile)[0] + ".opt.snapshot", tt, aln)
         return tt.tree
     else:
         Phylo.write(treecopy, outfile, 'newick')
@@ -185,6 +188,7 @@ def subtree_year_vol(tree, N_per_year, outfile):
     Returns:
      - tree(Biopython tree): the subtree
     """
+    from Bio import Phylo
 
     if isinstance(tree, str):
         treecopy = Phylo.read(tree, 'newick')
@@ -207,12 +211,9 @@ def subtree_year_vol(tree, N_per_year, outfile):
             sample += list(np.random.choice(all_names, size=N_per_year, replace=False))
 
 
-    for leaf in treecopy.get_terminals():
-        if leaf.name not in sample:
-            treecopy.prune(leaf)
-        else:
-            pass
-            #print ("leaving leaf {} in the tree".format(leaf.name))
+    # prune the rest of the leaves in one pass over the tree arrays
+    compact = tree_utils.CompactTree.from_biopython(treecopy)
+    treecopy = compact.subtree(compact.leaf_mask(sample)).to_biopython()
 
     Phylo.write(treecopy, outfile, 'newick')
     return treecopy
@@ -239,14 +240,20 @@ def create_LSD_dates_file_from_flu_tree(tree, outfile):
         df.write("\n".join([str(k) + "\t" + str(dates[k]) for k in dates]))
     return dates
 
-def make_known_dates_dict(alnfile, dates_known_fraction=1.0):
+def known_dates_subset(dates, dates_known_fraction=1.0):
     """
-    Read all the dates of the given flu sequences, and make the dates dictionary
-    for only a fraction of them. The sequences in the resulting dict are chosen
-    randomly.
+    Choose randomly the fraction of the dates, which should stay known.
+
+    Args:
+
+     - dates(dict): all dates {sequence name: numeric date}
+
+     - dates_known_fraction(float): fraction of the dates to keep
+
+    Returns:
+
+     - dates(dict): dates of the randomly chosen sequences
     """
-    aln = AlignIO.read(alnfile, 'fasta')
-    dates = {k.name: date_from_seq_name(k.name) for k in aln}
     # randomly choose the dates so that only the  known_ratio number of dates is known
     if dates_known_fraction != 1.0:
         assert(dates_known_fraction > 0 and dates_known_fraction < 1.0)
@@ -254,6 +261,18 @@ def make_known_dates_dict(alnfile, dates_known_fraction=1.0):
         dates = {k : dates[k] for k in knonw_keys}
     return dates
 
+def make_known_dates_dict(alnfile, dates_known_fraction=1.0):
+    """
+    Read all the dates of the given flu sequences, and make the dates dictionary
+    for only a fraction of them. The sequences in the resulting dict are chosen
+    randomly.
+    """
+    from Bio import AlignIO
+
+    aln = AlignIO.read(alnfile, 'fasta')
+    dates = {k.name: date_from_seq_name(k.name) for k in aln}
+    return known_dates_subset(dates, dates_known_fraction)
+
 def create_treetime_with_missing_dates(alnfile, treefile, dates_known_fraction=1.0):
     """dates = {k.name: date_from_seq_name(k.name) for k in aln}
     Create TreeTime object with fraction of leaves having no sampling dates.
@@ -269,8 +288,7 @@ def create_treetime_with_missing_dates(alnfile, treefile, dates_known_fraction=1
      sampling date information.
 
     """
-    aln = AlignIO.read(alnfile, 'fasta')
-    tt = Phylo.read(treefile, 'newick')
+    import treetime
 
     dates = make_known_dates_dict(alnfile, dates_known_fraction)
     myTree = treetime.TreeTime(gtr='Jukes-Cantor', tree = treefile,
@@ -278,6 +296,97 @@ def create_treetime_with_missing_dates(alnfile, treefile, dates_known_fraction=1
     myTree.optimize_seq_and_branch_len(reuse_branch_len=True, prune_short=True, max_iter=5, infer_gtr=False)
     return myTree
 
+def copy_tree_topology(tree):
+    """
+    Copy the topology, the branch lengths and the node names of the tree. All
+    other attributes of the nodes (e.g. the sequences attached by TreeAnc) are
+    dropped, so the copy is small and can be passed to a new TreeTime object.
+    Unlike writing to newick, the branch lengths are not rounded.
+
+    Args:
+
+     - tree(Biopython tree): tree to copy
+
+    Returns:
+
+     - tree(Biopython tree): the copy
+    """
+    from Bio.Phylo import BaseTree
+
+    def _copy_clade(clade):
+        return BaseTree.Clade(branch_length=clade.branch_length, name=clade.name,
+            clades=[_copy_clade(c) for c in clade.clades])
+
+    return BaseTree.Tree(root=_copy_clade(tree.root), rooted=tree.rooted)
+
+def optimize_missing_dates_tree(alnfile, treefile, snapshot_dir=None):
+    """
+    Do the part of the create_treetime_with_missing_dates, which does not
+    depend on the known dates: read the tree and the alignment, reconstruct the
+    ancestral sequences and optimize the branch lengths. The result can be
+    used by treetime_from_optimized_tree for any fraction of the known dates.
+
+    Args:
+
+     - alnfile(str): path to the flu alignment
+
+     - treefile(str): path to the Flu newick tree
+
+     - snapshot_dir(str or None): if given, the optimized tree and the
+     alignment are restored from this snapshot (utility_functions_snapshot.py),
+     or the snapshot is written after the optimization, if it does not exist or
+     was written from the different alignment or tree files.
+
+    Returns:
+
+     - tree(Biopython tree): the optimized tree (see copy_tree_topology)
+
+     - aln(MultipleSeqAlignment): the alignment
+
+     - dates(dict): all dates of the sequences
+    """
+    import treetime
+    from Bio import AlignIO
+    import utility_functions_snapshot as snapshot_utils
+
+    if snapshot_dir is not None and snapshot_utils.snapshot_is_current(snapshot_dir, [alnfile, treefile]):
+        tree, aln = snapshot_utils.load_tree_snapshot(snapshot_dir)
+        dates = {k.name: date_from_seq_name(k.name) for k in aln}
+        return tree, aln, dates
+
+    aln = AlignIO.read(alnfile, 'fasta')
+    dates = {k.name: date_from_seq_name(k.name) for k in aln}
+    tt = treetime.TreeAnc(gtr='Jukes-Cantor', tree=treefile, aln=aln, verbose=4)
+    tt.optimize_seq_and_branch_len(reuse_branch_len=True, prune_short=True, max_iter=5, infer_gtr=False)
+    if snapshot_dir is not None:
+        snapshot_utils.write_treeanc_snapshot(snapshot_dir, tt, aln,
+            info={'inputs': snapshot_utils.input_hashes([alnfile, treefile])})
+    return copy_tree_topology(tt.tree), aln, dates
+
+def treetime_from_optimized_tree(tree, aln, dates, dates_known_fraction=1.0):
+    """
+    Create TreeTime object with fraction of leaves having no sampling dates
+    from the tree optimized by optimize_missing_dates_tree. The result is the
+    same as of the create_treetime_with_missing_dates, but the alignment is not
+    read and the branch lengths are not optimized again.
+
+    Args:
+
+     - tree(Biopython tree), aln(MultipleSeqAlignment), dates(dict): output of
+     the optimize_missing_dates_tree
+
+     - dates_known_fraction(float): fraction of leaves, which should have
+     sampling date information.
+    """
+    import treetime
+
+    known_dates = known_dates_subset(dates, dates_known_fraction)
+    myTree = treetime.TreeTime(gtr='Jukes-Cantor', tree=copy_tree_topology(tree),
+            aln=aln, verbose=4, dates=known_dates, debug=False)
+    # ancestral sequences for the copied tree, the branch lengths are kept
+    myTree.infer_ancestral_sequences(infer_gtr=False)
+    return myTree
+
 def create_subtree(tree, n_seqs, out_file, st_type='equal_sampling'):
     """
     Args:
@@ -294,6 +403,8 @@ def create_subtree(tree, n_seqs, out_file, st_type='equal_sampling'):
          The root of the resulting subtree is therefore the same as of the original tree
 
     """
+    from Bio import Phylo
+
     if isinstance(tree, str):
         tree = Phylo.read(tree, 'newick')
 
@@ -5,47 +5,209 @@ which are used from elsewhere.
 """
 
 import numpy as np
-from Bio import AlignIO, Phylo
-from Bio.Align import  MultipleSeqAlignment
-import random
 import subprocess
 import datetime
-import os, copy
-from scipy.stats import linregress
-from collections import Counter
-import StringIO
+import os
+import re
+import time
+from collections import namedtuple
 
+# result of the LSD run for a single tree (see run_lsd_batch)
+LSDResult = namedtuple('LSDResult', ['tree', 'outfile', 'tmrca', 'mu', 'objective', 'runtime',
+                                     'tmrca_ci', 'mu_ci'])
 
-def remove_polytomies(tree):
+# root-to-tip regression of the internal nodes (see InternalRegression)
+RegressionResult = namedtuple('RegressionResult', ['slope', 'intercept', 'r2', 'residual_std', 'n'])
+
+
+def _resolve_polytomy(clades, mode, rng, join=None):
     """
-    Scan tree, and remove the polytomies (if any) by random merging
+    Resolve the polytomy: join the children to the binary subtree with the new
+    internal nodes. The work is linear in the number of the children.
 
     Args:
 
-     - tree(Biopython tree): initial tree
+     - clades(list): children of the polytomous node
+
+     - mode(str): 'balanced' - join the neighbouring pairs level by level (the
+     subtree depth is ceil(log2(k))), 'random' - the same after shuffling the
+     children, 'coalescent' - join random pairs, as in the Kingman coalescent
+     (expected depth O(log k))
+
+     - rng(numpy.random.RandomState): random generator for the random modes
+
+     - join(callable or None): function, which creates the new node from the
+     two children. By default, the Biopython clade named "None" with the branch
+     length 1e-5 is created.
 
     Returns:
 
-     - tree without polytomies
+     - clades(list): the two children of the resolved node
     """
-    for clade in tree.find_clades():
-        #if not hasattr(clade, "name") or clade.name is None:
-        #    clade.name = "None"
-        if len(clade.clades) < 3:
-            continue
-        clades = clade.clades
-        while len(clades) > 2:
-            c1 = clades.pop()
-            c2 = clades.pop()
+    if join is None:
+        from Bio import Phylo
+
+        def join(c1, c2):
             new_node = Phylo.BaseTree.Clade()
-            new_node.name="None"
+            new_node.name = "None"
             new_node.branch_length = 1e-5
-            new_node.clades = [c1,c2]
-            clades.append(new_node)
-        clade.clades = clades
+            new_node.clades = [c1, c2]
+            return new_node
 
+    clades = list(clades)
+    if mode == 'coalescent':
+        while len(clades) > 2:
+            # pick two random nodes and swap-remove them from the pool
+            for k in (0, 1):
+                idx = rng.randint(k, len(clades))
+                clades[k], clades[idx] = clades[idx], clades[k]
+            clades.append(join(clades[0], clades[1]))
+            clades[0] = clades.pop()
+            clades[1] = clades.pop()
+        return clades
+
+    if mode == 'random':
+        clades = [clades[k] for k in rng.permutation(len(clades))]
+    elif mode != 'balanced':
+        raise ValueError("Unknown polytomy resolution mode: {}".format(mode))
+    while len(clades) > 2:
+        joined = [join(clades[k], clades[k + 1]) for k in range(0, len(clades) - 1, 2)]
+        if len(clades) % 2:
+            joined.append(clades[-1])
+        clades = joined
+    return clades
+
+def remove_polytomies(tree, mode='balanced', seed=None):
+    """
+    Scan tree, and remove the polytomies (if any) by merging the children of
+    the polytomous nodes into the binary subtrees. The polytomous nodes are
+    collected first and resolved after the traversal, the total work is linear
+    in the tree size.
+
+    Args:
+
+     - tree(Biopython tree): initial tree
+
+     - mode(str): how to resolve the polytomies: 'balanced' (default),
+     'random' or 'coalescent' (see _resolve_polytomy)
+
+     - seed(int or None): seed of the random resolution, for reproducible trees
+
+    Returns:
+
+     - tree without polytomies
+    """
+    rng = np.random.RandomState(seed)
+    polytomies = [clade for clade in tree.find_clades() if len(clade.clades) > 2]
+    for clade in polytomies:
+        clade.clades = _resolve_polytomy(clade.clades, mode, rng)
     return tree
 
+def _regression_sums(x, y, x0, y0):
+    valid = np.isfinite(x) & np.isfinite(y)
+    dx, dy = x[valid] - x0, y[valid] - y0
+    return np.array([valid.sum(), dx.sum(), dy.sum(), (dx * dx).sum(), (dx * dy).sum(), (dy * dy).sum()])
+
+class InternalRegression(object):
+    """
+    Linear regression of the root-to-node distance vs the node date over the
+    internal nodes of the tree. The dates and distances are gathered into the
+    arrays in one pass, and the regression is kept as the sums over the nodes
+    (count, x, y, x^2, xy, y^2, shifted by the first values for the
+    precision). When the dates of only some nodes change (e.g. between the
+    TreeTime iterations or for the relaxed-clock variants), update(nodes)
+    replaces their contributions without visiting the rest of the tree.
+    """
+
+    def __init__(self, tree):
+        tree = getattr(tree, 'tree', tree)
+        self.nodes = tree.get_nonterminals()
+        self._index = {id(n): i for i, n in enumerate(self.nodes)}
+        self.numdate = np.full(len(self.nodes), np.nan)
+        self.dist2root = np.full(len(self.nodes), np.nan)
+        self.x0, self.y0 = 0., 0.
+        self.sums = np.zeros(6)
+        self.update()
+
+    @staticmethod
+    def _node_values(nodes):
+        numdate = np.array([getattr(k, 'numdate', np.nan) for k in nodes], dtype=float)
+        dist2root = np.array([getattr(k, 'dist2root', np.nan) for k in nodes], dtype=float)
+        return numdate, dist2root
+
+    def update(self, nodes=None, numdate=None, dist2root=None):
+        """
+        Update the regression with the new values of the nodes.
+
+        Args:
+
+         - nodes(list or None): the internal nodes, which have changed. If None,
+         the values of all nodes are re-read and the sums recomputed.
+
+         - numdate(array or None), dist2root(array or None): the new values of
+         the nodes. If not given, they are read from the node attributes.
+
+        Returns:
+
+         - result(RegressionResult): the updated regression
+        """
+        if nodes is None:
+            numdate, dist2root = self._node_values(self.nodes)
+            valid = np.isfinite(numdate) & np.isfinite(dist2root)
+            if valid.any():
+                self.x0, self.y0 = numdate[valid][0], dist2root[valid][0]
+            self.numdate, self.dist2root = numdate, dist2root
+            self.sums = _regression_sums(numdate, dist2root, self.x0, self.y0)
+            return self.result()
+
+        idx = np.array([self._index[id(k)] for k in nodes], dtype=int)
+        if numdate is None or dist2root is None:
+            numdate, dist2root = self._node_values(nodes)
+        numdate, dist2root = np.asarray(numdate, dtype=float), np.asarray(dist2root, dtype=float)
+        self.sums += _regression_sums(numdate, dist2root, self.x0, self.y0) - \
+                     _regression_sums(self.numdate[idx], self.dist2root[idx], self.x0, self.y0)
+        self.numdate[idx] = numdate
+        self.dist2root[idx] = dist2root
+        return self.result()
+
+    def result(self):
+        """
+        Regression parameters from the current sums.
+
+        Returns:
+
+         - result(RegressionResult): slope, intercept, R^2, standard deviation
+         of the residuals and the number of the nodes used. R^2 is 0 if there
+         are less than two nodes with dates.
+        """
+        n, sx, sy, sxx, sxy, syy = self.sums
+        if n < 2:
+            return RegressionResult(np.nan, np.nan, 0., np.nan, int(n))
+        ssx = sxx - sx * sx / n
+        ssy = syy - sy * sy / n
+        ssxy = sxy - sx * sy / n
+        slope = ssxy / ssx if ssx > 0 else np.nan
+        intercept = self.y0 + (sy - slope * sx) / n - slope * self.x0
+        r2 = ssxy * ssxy / (ssx * ssy) if ssx * ssy > 0 else 0.
+        residual_std = np.sqrt(max(ssy - slope * ssxy, 0.) / (n - 2)) if n > 2 and ssx > 0 else np.nan
+        return RegressionResult(slope, intercept, min(r2, 1.), residual_std, int(n))
+
+def internal_regression(myTree):
+    """
+    Build linear regression of the node root-to-tip distance vs dates for the
+    internal nodes (see InternalRegression).
+
+    Args:
+
+     - myTree(treetime object or Biopython tree): the TreeTime tree.
+
+    Returns:
+
+     - result(RegressionResult): slope, intercept, R^2, residual standard
+     deviation and the number of nodes
+    """
+    return InternalRegression(myTree).result()
+
 def internal_regress(myTree):
     """
     Build linear regression of the node  root-to-tip distance vs dates. The
@@ -57,19 +219,88 @@ def internal_regress(myTree):
 
     Returns:
 
-     - linregress(tuple): the regression parameters in the scipy.linregress format
+     - r2(float): R^2 of the regression (0 if there are no dated internal
+     nodes). See internal_regression for the other parameters.
     """
-    resarr = []
-    for node in myTree.tree.get_nonterminals():
-        try:
-            resarr.append((node.numdate, node.dist2root))
-        except:
-            continue
-    resarr = np.array(resarr)
-    if resarr.shape[0] == 0:
-        return 0.
-    else:
-        return linregress(resarr[:, 0], resarr[:, 1]).rvalue**2
+    return internal_regression(myTree).r2
+
+# LSD result line of a tree, e.g. (the confidence intervals are added with -f):
+#   Tree 1 rate 0.00389 [0.0031; 0.0047], tMRCA 1993.29 [1991.2; 1994.5], objective function 7.7
+_LSD_NUMBER = r'([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)'
+_LSD_CI = r'(?:\s*\[\s*' + _LSD_NUMBER + r'\s*[;,]\s*' + _LSD_NUMBER + r'\s*\])?'
+LSD_RATE_REGEX = re.compile(r'\brate\s+' + _LSD_NUMBER + _LSD_CI)
+LSD_TMRCA_REGEX = re.compile(r'\btMRCA\s+' + _LSD_NUMBER + _LSD_CI)
+LSD_OBJECTIVE_REGEX = re.compile(r'\bobjective(?:\s+function)?\s*:?\s+' + _LSD_NUMBER)
+
+# LSD versions differ in whether the '.result' extension is appended to the -o name
+LSD_RESULT_SUFFIXES = ['', '.result']
+
+def lsd_result_file(lsd_outfile):
+    """
+    Path to the LSD results file for the output name given to LSD (-o). Only
+    the known result names are checked, the folder is not listed.
+
+    Returns:
+
+     - fname(str): path to the results file, or None if it does not exist
+    """
+    for suffix in LSD_RESULT_SUFFIXES:
+        if os.path.isfile(lsd_outfile + suffix):
+            return lsd_outfile + suffix
+    return None
+
+# the time-scaled tree written by LSD (0.3: .date.newick, lsd2: .date.nwk)
+LSD_DATE_TREE_SUFFIXES = ['.date.newick', '.date.nwk', '.result.date.newick', '.result.date.nwk']
+
+def lsd_date_tree_file(lsd_outfile):
+    """
+    Path to the time-scaled tree written by LSD for the output name given to
+    LSD (-o), or None if it does not exist
+    """
+    for suffix in LSD_DATE_TREE_SUFFIXES:
+        if os.path.isfile(lsd_outfile + suffix):
+            return lsd_outfile + suffix
+    return None
+
+def _lsd_ci(match):
+    if match is None or match.group(2) is None:
+        return None
+    return float(match.group(2)), float(match.group(3))
+
+def read_lsd_results(lsd_outfile):
+    """
+    Parse the LSD results file in one pass. Every line with the tMRCA value is
+    the result of one tree, so the results of the multi-tree runs are returned
+    in the order of the trees in the input file.
+
+    Args:
+
+     - lsd_outfile(str): path to the lsd results file (as given to LSD with -o)
+
+    Returns:
+
+     - results(list): one dict per tree with the 'tmrca', 'mu', 'objective'
+     values and the 'tmrca_ci', 'mu_ci' confidence intervals ((lower, upper),
+     or None if LSD was run without them). Empty, if there is no results file.
+    """
+    fname = lsd_result_file(lsd_outfile)
+    if fname is None:
+        return []
+    results = []
+    with open(fname, 'r') as inf:
+        for line in inf:
+            tmrca = LSD_TMRCA_REGEX.search(line)
+            if tmrca is None:
+                continue
+            mu = LSD_RATE_REGEX.search(line)
+            objective = LSD_OBJECTIVE_REGEX.search(line)
+            results.append({
+                'tmrca': float(tmrca.group(1)),
+                'mu': float(mu.group(1)) if mu is not None else -1,
+                'objective': float(objective.group(1)) if objective is not None else 0.0,
+                'tmrca_ci': _lsd_ci(tmrca),
+                'mu_ci': _lsd_ci(mu)})
+    return results
 
 def parse_lsd_output(lsd_outfile):
     """
@@ -80,38 +311,95 @@ def parse_lsd_output(lsd_outfile):
 
     Returns:
      - [tmrca, mu, objective] - Date of the most-recent-common ancestor, the
-     mutation  rate and the objective function value. If parsing failed, the
-     [-1, -1, 0] array is returned.
-    """
-    # parse LSD results
-    try:
-        with open (lsd_outfile, 'r') as inf:
-            ss = inf.readlines()
-    except:
-
-        folder, filename = os.path.split(lsd_outfile)
-        files = [k for k in os.listdir(folder) if k.startswith(filename)]
-        if len(files) == 0:
-            return -1, -1, 0.0
-        else:
-            file = os.path.join(folder, files[0])
-            with open(file, 'r') as inf:
-                ss = inf.readlines()
-
-    mystrs = [i for i in ss if 'tMRCA' in i]
-    if len(mystrs) == 0:
+     mutation  rate and the objective function value of the first tree (see
+     read_lsd_results for all trees and the confidence intervals). If parsing
+     failed, the [-1, -1, 0] array is returned.
+    """
+    results = read_lsd_results(lsd_outfile)
+    if len(results) == 0:
         return -1, -1, 0.0
+    return results[0]['tmrca'], results[0]['mu'], results[0]['objective']
 
-    mystr = mystrs[0]
-    tmrca = (mystr.split(" ")[5])[:-1]
-    mu = (mystr.split(" ")[3])[:-1]
+def _lsd_result(tree, outfile, parsed, runtime):
+    if parsed is None:
+        return LSDResult(tree, outfile, -1, -1, 0.0, runtime, None, None)
+    return LSDResult(tree, outfile, parsed['tmrca'], parsed['mu'], parsed['objective'],
+                     runtime, parsed['tmrca_ci'], parsed['mu_ci'])
+
+def run_lsd_batch(jobs, lsd_params=['-r','a','-c','-v'], max_running=None):
+    """
+    Run LSD for many trees. The single-tree LSD processes are run in parallel,
+    with at most max_running processes at a time. The outputs are parsed after
+    all runs are finished.
 
-    if len (mystr.split(" ")) == 8:
-        objective = (mystr.split(" ")[7])[:-1]
-    else:
-        objective =  "0.0" # (mystr.split(" ")[7])
+    Args:
+
+     - jobs(list): list of the (tree file, dates file, output file) tuples
+
+     - lsd_params(list): parameters of the LSD runs
+
+     - max_running(int or None): maximal number of the concurrent LSD
+     processes. One per CPU, if None.
+
+    Returns:
+
+     - results(list): LSDResult records (tree, outfile, tmrca, mu, objective,
+     runtime, tmrca_ci, mu_ci), in the order of the jobs. tmrca=mu=-1 if LSD
+     failed.
+    """
+    import multiprocessing
+    from external_binaries import LSD_BIN
+
+    if max_running is None:
+        max_running = multiprocessing.cpu_count()
+
+    # fan the runs out over the pool of processes
+    runtimes = {}
+    pending = list(range(len(jobs)))
+    running = {}
+    while pending or running:
+        while pending and len(running) < max_running:
+            k = pending.pop(0)
+            tree_file, dates, outfile = jobs[k]
+            call = [LSD_BIN, '-i', tree_file, '-d', dates, '-o', outfile] + list(lsd_params)
+            running[k] = (subprocess.Popen(call), time.time())
+        time.sleep(0.01)
+        for k, (p, start) in list(running.items()):
+            if p.poll() is not None:
+                runtimes[k] = time.time() - start
+                del running[k]
+
+    results = []
+    for k, (tree_file, dates, outfile) in enumerate(jobs):
+        parsed = read_lsd_results(outfile)
+        results.append(_lsd_result(tree_file, outfile, parsed[0] if parsed else None, runtimes[k]))
+    return results
+
+def write_results_line(res_file, columns, values):
+    """
+    Append one line of results to the CSV results file. If the file does not
+    exist yet, it is created and the header line is written first. This is the
+    common results layer used by all run scripts and by the worker service.
+
+    Args:
+
+     - res_file(str): path to the CSV results file
+
+     - columns(list): column names. They are written as the '#'-prefixed
+     header line if the file is created.
+
+     - values(list): values to be written. Each value is converted to string.
+
+    """
+    if not os.path.exists(res_file):
+        try:
+            with open(res_file, 'w') as of:
+                of.write("#" + ",".join(columns) + "\n")
+        except:
+            pass
 
-    return tmrca, mu, objective
+    with open(res_file, 'a') as of:
+        of.write(",".join(["{}".format(k) for k in values]) + "\n")
 
 def run_LSD(tree_filename, dates_filename, outfile, lsd_params = ['-r','a','-c','-v']):
     """
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+"""
+This module defines the date accuracy of all internal nodes of the
+reconstructed trees, not only of the root. The internal nodes of the
+reconstructed tree are matched to the nodes of the true FFpopSim tree
+(<basename>.nwk, the node dates are in the names: <...>_DATE_<date>) by their
+clades: the rooted leaf bitsets of the nodes (see clade_bitsets in
+utility_functions_topology.py) are computed for both trees, and the nodes with
+identical bitsets are matched at once with np.unique. Only the nodes with the
+known dates in both trees are compared.
+
+The date error of every matched node (inferred - true, in years) is reduced to
+the summary statistics and the histogram with the fixed bin edges
+(NODE_ERROR_EDGES), so that the replicates can be aggregated by summing the
+histograms. The results are recorded to the results archive (see
+utility_functions_results.py) as 'node_dates_<method>', one row per replicate:
+
+    File, N_nodes, N_matched, Err_mean, Err_median, Err_rmse, Err_mae, H0, ... Hn
+
+N_nodes is the number of the dated internal nodes of the true tree, Hk is the
+number of the nodes with the error in [NODE_ERROR_EDGES[k], NODE_ERROR_EDGES[k+1]).
+"""
+
+import os
+import numpy as np
+
+import utility_functions_tree as tree_utils
+import utility_functions_topology as topology_utils
+
+# bin edges of the date error histograms (years), symmetric around zero
+NODE_ERROR_EDGES = np.array([-np.inf, -500, -200, -100, -50, -20, -10, -5, -2, -1, -0.5,
+                             0, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, np.inf])
+
+NODE_DATES_COLUMNS = ["File", "N_nodes", "N_matched", "Err_mean", "Err_median", "Err_rmse", "Err_mae"] + \
+    ["H{}".format(k) for k in range(len(NODE_ERROR_EDGES) - 1)]
+
+def ffpopsim_date(name):
+    """
+    Date of the FFpopSim tree node from its name, None if not known
+    """
+    if name and "_DATE_" in name:
+        return float(name.split("_")[-1])
+    return None
+
+def true_tree(basename):
+    """
+    Read the true FFpopSim tree of the simulation with the node dates
+    """
+    return tree_utils.CompactTree.read(basename + ".nwk", date_parser=ffpopsim_date)
+
+def set_time_tree_dates(tree, leaf_dates, root_date=None):
+    """
+    Set the dates of all nodes of the time-scaled tree (the branch lengths are
+    in years, e.g. LSD or BEAST output).
+
+    Args:
+
+     - tree(CompactTree): the time-scaled tree
+
+     - leaf_dates(dict): dates of the leaves by the name
+
+     - root_date(float or None): date of the root. If None, it is estimated
+     from the leaf dates (median of the leaf date minus its distance to the
+     root).
+    """
+    dist2root = tree.dist2root()
+    if root_date is None:
+        names = tree.names[tree.leaves]
+        known = np.array([k in leaf_dates for k in names], dtype=bool)
+        if not known.any():
+            raise ValueError("No leaf dates to place the root")
+        leaf_dates = np.array([leaf_dates[k] for k in names[known]], dtype=np.float64)
+        root_date = np.median(leaf_dates - dist2root[tree.leaves[known]])
+    tree.dates = root_date + dist2root
+    return tree
+
+def match_nodes(tree1, tree2):
+    """
+    Match the internal nodes of the two trees by their rooted clades.
+
+    Args:
+
+     - tree1, tree2(CompactTree): the trees. If the leaf sets differ, the trees
+     are reduced to the common leaves.
+
+    Returns:
+
+     - tree1, tree2(CompactTree): the (reduced) trees
+
+     - nodes1, nodes2(numpy.array): indices of the matched internal nodes in
+     the first and in the second tree
+    """
+    tree1, tree2, taxa = topology_utils.common_leaves(tree1, tree2)
+    internal1 = np.where(~tree1.is_leaf)[0]
+    internal2 = np.where(~tree2.is_leaf)[0]
+    keys1 = topology_utils.bitset_keys(topology_utils.clade_bitsets(tree1, taxa)[internal1])
+    keys2 = topology_utils.bitset_keys(topology_utils.clade_bitsets(tree2, taxa)[internal2])
+
+    # the first node of every clade (the unary chains share the clade)
+    _, first2 = np.unique(keys2, return_index=True)
+    keys2, internal2 = keys2[first2], internal2[first2]
+    _, inverse = np.unique(np.concatenate([keys2, keys1]), return_inverse=True)
+    lookup = np.full(inverse.max() + 1, -1, dtype=np.int64)
+    lookup[inverse[:len(keys2)]] = internal2
+    matched = lookup[inverse[len(keys2):]]
+    found = matched >= 0
+    return tree1, tree2, internal1[found], matched[found]
+
+def node_date_errors(true, inferred):
+    """
+    Date errors of the internal nodes of the inferred tree.
+
+    Args:
+
+     - true(CompactTree): the true tree with the node dates
+
+     - inferred(CompactTree): the inferred tree with the node dates
+
+    Returns:
+
+     - errors(numpy.array): inferred - true date of every matched node
+
+     - n_nodes(int): number of the dated internal nodes of the true tree
+    """
+    true, inferred, nodes1, nodes2 = match_nodes(true, inferred)
+    n_nodes = int(np.isfinite(true.dates[~true.is_leaf]).sum())
+    errors = inferred.dates[nodes2] - true.dates[nodes1]
+    return errors[np.isfinite(errors)], n_nodes
+
+def error_histogram(errors):
+    """
+    Histogram of the date errors with the NODE_ERROR_EDGES bins
+    """
+    bins = np.searchsorted(NODE_ERROR_EDGES, errors, side='right') - 1
+    return np.bincount(np.clip(bins, 0, len(NODE_ERROR_EDGES) - 2),
+                       minlength=len(NODE_ERROR_EDGES) - 1)
+
+def node_dates_summary(errors, n_nodes):
+    """
+    Reduce the date errors to the NODE_DATES_COLUMNS values (without the file
+    name)
+    """
+    if len(errors) == 0:
+        stats = [np.nan] * 4
+    else:
+        stats = [errors.mean(), np.median(errors), np.sqrt((errors ** 2).mean()),
+                 np.abs(errors).mean()]
+    return [n_nodes, len(errors)] + stats + list(error_histogram(errors))
+
+def record_node_dates(archive_dir, method, basename, inferred):
+    """
+    Compare the node dates of the inferred tree to the true tree of the
+    simulation, and record the summary to the results archive as
+    'node_dates_<method>'.
+
+    Args:
+
+     - archive_dir(str): root directory of the results archive
+
+     - method(str): name of the method (e.g. 'treetime', 'lsd_fasttree', 'beast')
+
+     - basename(str): FFpopSim file prefix (the true tree is <basename>.nwk)
+
+     - inferred(CompactTree): the inferred tree with the node dates
+
+    Returns:
+
+     - errors(numpy.array): the date errors of the matched nodes, None if the
+     trees cannot be compared
+    """
+    import utility_functions_results as results_utils
+
+    params = results_utils.ffpopsim_params(basename)
+    if params is None:
+        return None
+    try:
+        errors, n_nodes = node_date_errors(true_tree(basename), inferred)
+    except Exception as e:
+        print ("Cannot compare the node dates of {} ({}): {}".format(basename, method, e))
+        return None
+
+    row = dict(params)
+    row.update(dict(zip(NODE_DATES_COLUMNS,
+        [os.path.split(basename)[-1]] + node_dates_summary(errors, n_nodes))))
+    results_utils.write_partition(archive_dir, "node_dates_" + method,
+                                  {k: [v] for k, v in row.items()})
+    return errors
+
+def read_node_date_histograms(archive_dir, method, Mu=None, Ts=None):
+    """
+    Read the node date errors of the method from the results archive.
+
+    Args:
+
+     - archive_dir(str): root directory of the results archive
+
+     - method(str): name of the method, without the 'node_dates_' prefix
+
+     - Mu, Ts: filter the partitions (see read_results)
+
+    Returns:
+
+     - df(pandas.DataFrame): the summary rows with the simulation parameters
+
+     - counts(numpy.array): histograms of the replicates (rows of the df x
+     bins)
+
+     - edges(numpy.array): the bin edges
+    """
+    import utility_functions_results as results_utils
+
+    df = results_utils.read_results(archive_dir, "node_dates_" + method, Mu=Mu, Ts=Ts)
+    hist_columns = [k for k in NODE_DATES_COLUMNS if k.startswith('H')]
+    if df is None or df.shape[0] == 0:
+        return df, np.zeros((0, len(hist_columns)), dtype=int), NODE_ERROR_EDGES
+    return df, df[hist_columns].values.astype(int), NODE_ERROR_EDGES
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+"""
+This module defines a simple task queue stored in a local SQLite database.
+The submit scripts put the parameter points into the queue, and the worker
+service (run_worker_service.py) takes them out and runs them in the warm
+worker processes.
+"""
+
+import sqlite3
+import json
+import time
+import errno
+import os
+
+# task types and the run scripts, which perform the tasks. Every run script
+# should define main(argv) function, which takes the command line arguments
+# (without the script name).
+TASK_RUNNERS = {
+    'flu_subtrees' : 'generate_flu_subtrees_dataset_run',
+    'flu_missing_dates' : 'generate_flu_missingDates_dataset_run',
+    'simulated' : 'generate_simulated_dataset_run',
+}
+
+def _connect(db_file):
+    """
+    Open connection to the queue database. Create the tasks table if needed.
+    """
+    folder = os.path.split(db_file)[0]
+    if folder != "" and not os.path.exists(folder):
+        try:
+            os.makedirs(folder)
+        except:
+            pass
+
+    # isolation_level=None: transactions are managed explicitly, so that the
+    # task claim is atomic between the concurrent workers
+    conn = sqlite3.connect(db_file, timeout=60, isolation_level=None)
+    conn.execute("""CREATE TABLE IF NOT EXISTS tasks (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    kind TEXT NOT NULL,
+                    args TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    worker TEXT,
+                    submitted REAL,
+                    started REAL,
+                    finished REAL,
+                    error TEXT)""")
+    conn.execute("CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, id)")
+    return conn
+
+def enqueue_tasks(db_file, kind, args_list):
+    """
+    Put tasks to the queue.
+
+    Args:
+
+     - db_file(str): path to the queue database. Created if does not exist.
+
+     - kind(str): type of the tasks, one of the TASK_RUNNERS keys.
+
+     - args_list(list): list of the task arguments. Each entry is the list of
+     the command line arguments for the corresponding run script.
+
+    Returns:
+
+     - n_tasks(int): number of the tasks added to the queue
+    """
+    if kind not in TASK_RUNNERS:
+        raise ValueError("Unknown task type: {}".format(kind))
+
+    conn = _connect(db_file)
+    now = time.time()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.executemany("INSERT INTO tasks (kind, args, submitted) VALUES (?, ?, ?)",
+            [(kind, json.dumps([str(k) for k in args]), now) for args in args_list])
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+    return len(args_list)
+
+def enqueue_task(db_file, kind, args):
+    """
+    Put single task to the queue. See enqueue_tasks for the arguments.
+    """
+    return enqueue_tasks(db_file, kind, [args])
+
+def claim_task(db_file, worker):
+    """
+    Take the oldest pending task from the queue and mark it as running.
+
+    Args:
+
+     - db_file(str): path to the queue database
+
+     - worker(str): worker identifier, which is stored with the task
+
+    Returns:
+
+     - (task_id, kind, args) tuple, or None if there are no pending tasks
+    """
+    conn = _connect(db_file)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute("SELECT id, kind, args FROM tasks WHERE status='pending' "
+                           "ORDER BY id LIMIT 1").fetchone()
+        if row is None:
+            conn.execute("COMMIT")
+            return None
+        conn.execute("UPDATE tasks SET status='running', worker=?, started=? WHERE id=?",
+                     (worker, time.time(), row[0]))
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+    return row[0], str(row[1]), [str(k) for k in json.loads(row[2])]
+
+def finish_task(db_file, task_id, worker, error=None):
+    """
+    Mark the task as done. If the error is given, the task is marked as failed
+    and the error message is stored with the task. The task is only updated if
+    it is still owned by the worker (i.e. it was not requeued and claimed by
+    another worker in the meantime).
+
+    Returns:
+
+     - updated(bool): whether the task was owned by the worker
+    """
+    conn = _connect(db_file)
+    try:
+        cur = conn.execute("UPDATE tasks SET status=?, finished=?, error=? WHERE id=? AND worker=?",
+                     ('failed' if error is not None else 'done', time.time(), error, task_id, worker))
+        updated = cur.rowcount > 0
+    finally:
+        conn.close()
+    return updated
+
+def requeue_tasks(db_file, status='running'):
+    """
+    Put the tasks with the given status back to the queue. This is needed to
+    restart the tasks after the worker service was killed ('running', only if
+    no other service works on the queue, see requeue_dead_tasks), or to retry
+    the failed tasks ('failed').
+
+    Returns:
+
+     - n_tasks(int): number of the tasks put back to the queue
+    """
+    conn = _connect(db_file)
+    try:
+        cur = conn.execute("UPDATE tasks SET status='pending', worker=NULL, error=NULL "
+                           "WHERE status=?", (status,))
+        n_tasks = cur.rowcount
+    finally:
+        conn.close()
+    return n_tasks
+
+def worker_name(idx):
+    """
+    Identifier of the worker process: '<host>:<pid>:<idx>'. The host and the
+    process id allow to check whether the worker is still alive.
+    """
+    return "{}:{}:{}".format(os.uname()[1], os.getpid(), idx)
+
+def _worker_alive(worker):
+    """
+    Check whether the worker process is alive. Only the workers on this host
+    can be checked, the workers on other hosts are assumed to be alive.
+    """
+    parts = str(worker).split(':')
+    if len(parts) != 3 or parts[0] != os.uname()[1]:
+        return True
+    try:
+        os.kill(int(parts[1]), 0)
+    except ValueError:
+        return True
+    except OSError as e:
+        # EPERM: the process exists, but belongs to another user
+        return e.errno == errno.EPERM
+    return True
+
+def requeue_dead_tasks(db_file):
+    """
+    Put the running tasks of the dead workers on this host back to the queue
+    (e.g. after the worker service was killed). The tasks of the live workers
+    and of the workers on other hosts are not touched.
+
+    Returns:
+
+     - n_tasks(int): number of the tasks put back to the queue
+    """
+    conn = _connect(db_file)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        rows = conn.execute("SELECT id, worker FROM tasks WHERE status='running'").fetchall()
+        dead = [(task_id, worker) for task_id, worker in rows if not _worker_alive(worker)]
+        conn.executemany("UPDATE tasks SET status='pending', worker=NULL, error=NULL "
+                         "WHERE id=? AND worker=? AND status='running'", dead)
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+    return len(dead)
+
+def pending_kinds(db_file):
+    """
+    Types of the tasks waiting in the queue.
+
+    Returns:
+
+     - kinds(list): list of the TASK_RUNNERS keys
+    """
+    conn = _connect(db_file)
+    try:
+        rows = conn.execute("SELECT DISTINCT kind FROM tasks WHERE status='pending'").fetchall()
+    finally:
+        conn.close()
+    return [str(k[0]) for k in rows]
+
+def queue_status(db_file):
+    """
+    Count the tasks in the queue by their status.
+
+    Returns:
+
+     - status(dict): dictionary in format {status: number of tasks}
+    """
+    conn = _connect(db_file)
+    try:
+        rows = conn.execute("SELECT status, COUNT(*) FROM tasks GROUP BY status").fetchall()
+    finally:
+        conn.close()
+    return {str(k): n for k, n in rows}
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+"""
+This module defines the columnar archive of the validation results. Every
+result is stored together with the typed simulation parameters (N, Ns, Ts,
+Sim_mu, ...), which are parsed from the FFpopSim file name once, at the time
+the result is recorded. The archive is a directory of NumPy .npz files
+partitioned by the method, the mutation rate and the sampling frequency:
+
+    <archive_dir>/method=treetime/Mu=0.0001/Ts=10/<unique name>.npz
+
+Every .npz file holds one array per column. The concurrent run scripts write
+separate files, so no locking is needed. The reader only opens the partitions,
+which pass the filters, and concatenates the columns.
+"""
+
+import os
+import re
+import uuid
+import numpy as np
+
+# simulation parameters encoded in the FFpopSim file names, e.g.:
+# FFpopSim_L10000_N100_Ns20_Ts10_Nv10_Mu0.0001_3.ft.nwk
+FFPOPSIM_NAME_REGEX = re.compile(
+    r'_L(?P<L>[0-9.eE+-]+)_N(?P<N>\d+)_Ns(?P<Ns>\d+)_Ts(?P<Ts>\d+)'
+    r'_Nv(?P<Nv>\d+)_Mu(?P<Sim_mu>[0-9.eE+-]+?)(?=_|\.[a-zA-Z]|$)')
+
+# simulation parameters and their types
+FFPOPSIM_PARAMS = [('L', float), ('N', int), ('Ns', int), ('Ts', int), ('Nv', int), ('Sim_mu', float)]
+
+def ffpopsim_params(filename):
+    """
+    Parse the simulation parameters from the FFpopSim file name.
+
+    Args:
+
+     - filename(str): file name or path, which contains the FFpopSim label
+
+    Returns:
+
+     - params(dict): simulation parameters: L, N, Ns, Ts, Nv, Sim_mu, and the
+     derived T (Ns*Ts) and Nmu (N*Sim_mu). None, if the name cannot be parsed.
+    """
+    match = FFPOPSIM_NAME_REGEX.search(os.path.split(str(filename))[-1])
+    if match is None:
+        return None
+    params = {k: t(match.group(k)) for k, t in FFPOPSIM_PARAMS}
+    params['T'] = params['Ns'] * params['Ts']
+    params['Nmu'] = params['N'] * params['Sim_mu']
+    return params
+
+def add_ffpopsim_params(df, column='File'):
+    """
+    Parse the simulation parameters from the file names in the given column of
+    the data-frame, and add them as the typed columns (see ffpopsim_params).
+    The rows with the file names, which cannot be parsed, are dropped.
+
+    Returns:
+
+     - df(pandas.DataFrame): data-frame with the parameter columns
+    """
+    filenames = df[column].astype(str).str.split('/').str[-1]
+    params = filenames.str.extract(FFPOPSIM_NAME_REGEX.pattern, expand=True)
+    df = df[params['N'].notnull().values].copy()
+    params = params[params['N'].notnull()]
+    for k, t in FFPOPSIM_PARAMS:
+        df[k] = params[k].astype(t).values
+    df['T'] = df['Ns'] * df['Ts']
+    df['Nmu'] = df['N'] * df['Sim_mu']
+    return df
+
+def _column_array(values):
+    """
+    Convert the column values to the numeric array, if possible, or to the
+    array of strings otherwise.
+    """
+    try:
+        return np.array(values, dtype=float)
+    except (ValueError, TypeError):
+        return np.array([str(k) for k in values])
+
+def _partition_dir(archive_dir, method, mu, ts):
+    return os.path.join(archive_dir, "method={}".format(method),
+                        "Mu={}".format(mu), "Ts={}".format(ts))
+
+def write_partition(archive_dir, method, data):
+    """
+    Write the results table to the archive. The rows are split between the
+    partitions by the mutation rate and the sampling frequency.
+
+    Args:
+
+     - archive_dir(str): root directory of the archive
+
+     - method(str): name of the method (e.g. 'treetime', 'lsd_fasttree')
+
+     - data(dict): columns of the results table, {column name: list of values}.
+     Should contain the simulation parameters (see ffpopsim_params).
+
+    Returns:
+
+     - n_rows(int): number of the rows written
+    """
+    columns = {k: _column_array(v) for k, v in data.items()}
+    for k, t in FFPOPSIM_PARAMS + [('T', int), ('Nmu', float)]:
+        if k in columns:
+            columns[k] = columns[k].astype(t)
+    mus = columns['Sim_mu']
+    tss = columns['Ts'].astype(int)
+    for mu, ts in set(zip(mus, tss)):
+        rows = (mus == mu) & (tss == ts)
+        folder = _partition_dir(archive_dir, method, mu, ts)
+        if not os.path.exists(folder):
+            try:
+                os.makedirs(folder)
+            except:
+                pass
+        # write to the temporary file first, so that the readers never see
+        # the partially written file
+        fname = os.path.join(folder, uuid.uuid4().hex)
+        with open(fname + '.tmp', 'wb') as of:
+            np.savez(of, **{k: v[rows] for k, v in columns.items()})
+        os.rename(fname + '.tmp', fname + '.npz')
+    return len(mus)
+
+def record_result(archive_dir, method, columns, values):
+    """
+    Record one result line to the archive. This is the columnar counterpart of
+    the write_results_line in the utility_functions_general.py. The simulation
+    parameters are parsed from the 'File' column and stored as typed columns.
+
+    Args:
+
+     - archive_dir(str): root directory of the archive
+
+     - method(str): name of the method (e.g. 'treetime', 'lsd_fasttree')
+
+     - columns(list): column names. Should include 'File'.
+
+     - values(list): values to be written
+    """
+    row = dict(zip(columns, values))
+    params = ffpopsim_params(row['File'])
+    if params is None:
+        raise ValueError("Cannot parse the simulation parameters from: {}".format(row['File']))
+    row.update(params)
+    write_partition(archive_dir, method, {k: [v] for k, v in row.items()})
+
+def _filter_partitions(folder, key, values):
+    """
+    List the partition sub-directories of the folder, which pass the filter.
+    """
+    if not os.path.exists(folder):
+        return []
+    res = []
+    for sub in sorted(os.listdir(folder)):
+        if not sub.startswith(key + '='):
+            continue
+        if values is not None:
+            value = float(sub.split('=', 1)[1])
+            if not np.any(np.isclose(value, np.array(values, dtype=float))):
+                continue
+        res.append(os.path.join(folder, sub))
+    return res
+
+def read_results(archive_dir, method, Mu=None, Ts=None, columns=None):
+    """
+    Read the results of the method from the archive. Only the partitions,
+    which pass the filters, are read.
+
+    Args:
+
+     - archive_dir(str): root directory of the archive
+
+     - method(str): name of the method
+
+     - Mu(list or None): mutation rates to read. All, if None.
+
+     - Ts(list or None): sampling frequencies to read. All, if None.
+
+     - columns(list or None): columns to read. All, if None.
+
+    Returns:
+
+     - df(pandas.DataFrame): table of the results. If both true and inferred
+     Tmrca are present, the dTmrca column is added.
+    """
+    import pandas
+    method_dir = os.path.join(archive_dir, "method={}".format(method))
+    data = {}
+    for mu_dir in _filter_partitions(method_dir, 'Mu', Mu):
+        for ts_dir in _filter_partitions(mu_dir, 'Ts', Ts):
+            for fname in sorted(os.listdir(ts_dir)):
+                if not fname.endswith('.npz'):
+                    continue
+                with np.load(os.path.join(ts_dir, fname)) as part:
+                    for k in (part.files if columns is None else columns):
+                        data.setdefault(k, []).append(part[k])
+
+    df = pandas.DataFrame({k: np.concatenate(v) for k, v in data.items()})
+    if 'Sim_Tmrca' in df and 'Tmrca' in df:
+        df['dTmrca'] = -(df['Sim_Tmrca'] - df['Tmrca'])
+    return df
+
+def compact_archive(archive_dir):
+    """
+    Merge the files of every partition into a single file. Should be called
+    after the runs are finished to speed up the reading. The files written
+    during the compaction are kept as is.
+
+    Returns:
+
+     - n_files(int): number of the files merged
+    """
+    n_files = 0
+    for folder, subdirs, files in os.walk(archive_dir):
+        parts = sorted([k for k in files if k.endswith('.npz')])
+        if len(parts) < 2:
+            continue
+        data = {}
+        for fname in parts:
+            with np.load(os.path.join(folder, fname)) as part:
+                for k in part.files:
+                    data.setdefault(k, []).append(part[k])
+        fname = os.path.join(folder, uuid.uuid4().hex)
+        with open(fname + '.tmp', 'wb') as of:
+            np.savez(of, **{k: np.concatenate(v) for k, v in data.items()})
+        os.rename(fname + '.tmp', fname + '.npz')
+        for k in parts:
+            os.remove(os.path.join(folder, k))
+        n_files += len(parts)
+    return n_files
+
+def import_results_csv(fname, archive_dir, method, columns):
+    """
+    Convert the existing CSV results file to the archive.
+
+    Args:
+
+     - fname(str): path to the CSV file (as written by write_results_line)
+
+     - archive_dir(str): root directory of the archive
+
+     - method(str): name of the method
+
+     - columns(list): names of the CSV columns. Should include 'File'.
+
+    Returns:
+
+     - n_rows(int): number of the rows imported
+    """
+    import pandas
+    df = pandas.read_csv(fname, names=columns, comment='#')
+    df = add_ffpopsim_params(df)
+    if df.shape[0] == 0:
+        return 0
+    return write_partition(archive_dir, method, {k: df[k].values for k in df.columns})
+
+if __name__ == '__main__':
+    pass
@@ -3,18 +3,14 @@
 This module defines some  utility functions,
 which are needed to operate the simulated data workflow.
 """
-import treetime
-from Bio import Phylo, AlignIO, Align
 import os, sys
-import treetime
 import numpy as np
 from external_binaries import *
-from utility_functions_general import internal_regress, remove_polytomies, parse_lsd_output
-import subprocess
+from utility_functions_general import internal_regress, remove_polytomies, write_results_line, run_lsd_batch, lsd_date_tree_file
 
 NEAREST_DATE = 2016.5
 
-def evolve_seq(treefile, basename, mu=0.0001, L=1000, mygtr = treetime.GTR.standard('jc')):
+def evolve_seq(treefile, basename, mu=0.0001, L=1000, mygtr=None):
     """
     Generate a random sequence of a given length, and evolve it on the tree
 
@@ -24,14 +20,17 @@ def evolve_seq(treefile, basename, mu=0.0001, L=1000, mygtr = treetime.GTR.stand
      - mu: mutation rate. The units of the mutation rate should be consistent with
      the tree branch length
      - L: sequence length.
-     - mygtr: GTR model for sequence evolution
+     - mygtr: GTR model for sequence evolution. If None, the Jukes-Cantor
+     model is used.
 
     """
+    import treetime
     from treetime import seq_utils
-    from Bio import Phylo, AlignIO
-    import numpy as np
+    from Bio import Phylo, AlignIO, Align
     from itertools import izip
 
+    if mygtr is None:
+        mygtr = treetime.GTR.standard('jc')
     mygtr.mu = mu
     tree = Phylo.read(treefile, 'newick')
     tree.root.ref_seq = np.random.choice(mygtr.alphabet, p=mygtr.Pi, size=L)
@@ -77,6 +76,8 @@ def _create_random_gtr(mu, alphabet='nuc'):
     """
     Create random GTR model
     """
+    import treetime
+
     alph = treetime.seq_utils.alphabets[alphabet]
     pis = np.random.rand(alph.shape[0])
     pis /= np.sum(pis)
@@ -90,6 +91,9 @@ def _evolve_sequence(tree, L, gtr):
     Produce random sequence of a given length L, evolve it on a given tree
     using the given gtr model.
     """
+    import treetime
+    from Bio import Phylo, Align
+
     if isinstance(tree, str):
         tree = Phylo.read(tree, 'newick')
 
@@ -126,15 +130,11 @@ def gtr_comparison(basename, mu_avg_t, L=1e3):
     """
     Compare the two GTR models.
     """
+    import treetime
 
     def _get_avg_branch_len(treefile):
-
-        n_b, t_b = 0, 0
-        tt = Phylo.read(treefile, 'newick')
-        for clade in tt.find_clades():
-            n_b += 1
-            t_b += clade.branch_length
-        return t_b / n_b
+        import utility_functions_tree as tree_utils
+        return np.mean(tree_utils.CompactTree.read(treefile).branch_length)
 
 
 
@@ -160,7 +160,7 @@ def gtr_comparison(basename, mu_avg_t, L=1e3):
 
     return KL
 
-def run_treetime(basename, outfile, fasttree=False, failed=None, **kwargs):
+def run_treetime(basename, outfile, fasttree=False, failed=None, archive_dir=None, **kwargs):
     """
     Infer the dates of the internal nodes using the TreeTime package.
     Append results to the given file.
@@ -174,15 +174,24 @@ def run_treetime(basename, outfile, fasttree=False, failed=None, **kwargs):
      append mode.
 
      - fasttree(bool): whether to use fasttree-generated tree (<basename>.ft.nwk)
-     or not (use <basename>.opt.nwk)
+     or not (use <basename>.opt.nwk). In the latter case, the tree and the
+     alignment are restored from the snapshot (<basename>.opt.snapshot), if it
+     exists.
 
      - failed(list or None): in not None, in case of treetime failure, the basename
      will be appended to the list for further analysis
 
+     - archive_dir(str or None): if not None, the results are also recorded to
+     the columnar archive (see utility_functions_results.py) as 'treetime' or
+     'treetime_fasttree' method.
+
     **Kwargs:
 
      - all arguments will be passe down to the treetime object run function.
     """
+    import treetime
+    from Bio import Phylo
+
     if fasttree:
         treefile = basename + ".ft.nwk"
         outtree = basename + ".treetime.ft.nwk"
@@ -190,29 +199,43 @@ def run_treetime(basename, outfile, fasttree=False, failed=None, **kwargs):
         treefile = basename + ".opt.nwk"
         outtree = basename + ".treetime.nwk"
     aln = basename+'.nuc.fasta'
-    Tmrca, dates = dates_from_ffpopsim_tree(Phylo.read(treefile, "newick"))
+    snapshot_dir = basename + ".opt.snapshot"
+    import utility_functions_snapshot as snapshot_utils
+    if not fasttree and snapshot_utils.snapshot_exists(snapshot_dir):
+        treefile, aln = snapshot_utils.load_tree_snapshot(snapshot_dir)
+        Tmrca, dates = dates_from_ffpopsim_tree(treefile)
+    else:
+        # the parsed tree is cached (see utility_functions_tree.read_newick)
+        tree = _compact_tree(treefile)
+        Tmrca, dates = dates_from_ffpopsim_tree(tree)
+        treefile = tree.to_biopython()
     myTree = treetime.TreeTime(gtr='Jukes-Cantor', tree = treefile,
         aln = aln, verbose = 4, dates = dates, debug=False)
 
     print ("Use input branch length is set to: {}".format(kwargs['use_input_branch_length']))
     myTree.run(root='best', **kwargs)
     Phylo.write(myTree.tree, outtree, 'newick')
-
-    if not os.path.exists(outfile):
-        try:
-            with open(outfile, 'w') as of:
-                of.write("#File,Tmrca_real,Tmrca,Mu,R^2(initial_clock),R^2(internal_nodes)\n")
-        except:
-            pass
-
-    with open(outfile, 'a') as of:
-        of.write("{},{},{},{},{},{}\n".format(
-            basename,
-            str(Tmrca),
-            str(myTree.tree.root.numdate),
-            str(myTree.date2dist.clock_rate),
-            str(myTree.date2dist.r_val),
-            str(internal_regress(myTree)) ))
+    r2_internal = internal_regress(myTree)
+
+    write_results_line(outfile,
+        ["File", "Tmrca_real", "Tmrca", "Mu", "R^2(initial_clock)", "R^2(internal_nodes)"],
+        [basename,
+         str(Tmrca),
+         str(myTree.tree.root.numdate),
+         str(myTree.date2dist.clock_rate),
+         str(myTree.date2dist.r_val),
+         str(r2_internal)])
+
+    if archive_dir is not None:
+        import utility_functions_results as results_utils
+        results_utils.record_result(archive_dir, "treetime_fasttree" if fasttree else "treetime",
+            ["File", "Sim_Tmrca", "Tmrca", "mu", "R", "R2_int"],
+            [basename, Tmrca, myTree.tree.root.numdate, myTree.date2dist.clock_rate,
+             myTree.date2dist.r_val, r2_internal])
+        import utility_functions_tree as tree_utils
+        import utility_functions_node_dates as node_dates_utils
+        node_dates_utils.record_node_dates(archive_dir, "treetime_fasttree" if fasttree else "treetime",
+            basename, tree_utils.CompactTree.from_biopython(myTree.tree, date_attr='numdate'))
 
     return myTree
 
@@ -227,7 +250,7 @@ def _create_date_file_from_ffpopsim_tree(treefile, datesfile):
         df.write("\n".join([str(k) + "\t" + str(dates[k]) for k in dates]))
     return Tmrca, dates
 
-def run_lsd(treefile, datesfile, outfile, res_file):
+def run_lsd(treefile, datesfile, outfile, res_file, archive_dir=None):
     """
     Infer the dates of the internal nodes using the LSD package.
     Append results to the given file.
@@ -243,29 +266,69 @@ def run_lsd(treefile, datesfile, outfile, res_file):
 
      - res_file: file where to write the formatted result string. This file is
      then parsed by the processing scripts to produce comparison with TreeTime
+
+     - archive_dir: if not None, the results are also recorded to the columnar
+     archive (see utility_functions_results.py) as 'lsd' or 'lsd_fasttree' method.
     """
-    outfile = outfile.replace(".nwk", ".res.txt")
-    Tmrca, dates = _create_date_file_from_ffpopsim_tree(treefile, datesfile)
-    # call LSD binary
-    call = [LSD_BIN, '-i', treefile, '-d', datesfile, '-o', outfile,
-            '-r', 'a', '-c', 'v']
+    run_lsd_trees([(treefile, datesfile, outfile, res_file)], archive_dir=archive_dir)
 
-    subprocess.call(call)
-    print ("LSD Done!")
+def run_lsd_trees(jobs, archive_dir=None, max_running=None):
+    """
+    Infer the dates of the internal nodes using the LSD package for several
+    trees at once: the LSD processes are run in parallel (see run_lsd_batch in
+    utility_functions_general.py). Append results to the given files.
+
+    Args:
+
+     - jobs(list): list of the (treefile, datesfile, outfile, res_file) tuples.
+     See run_lsd for the meaning of the fields.
+
+     - archive_dir: if not None, the results are also recorded to the columnar
+     archive (see utility_functions_results.py) as 'lsd' or 'lsd_fasttree' method.
 
-    tmrca, mu, objective = parse_lsd_output(outfile)
-    if float(mu) <= 0:
-        return
+     - max_running(int or None): maximal number of the concurrent LSD
+     processes. One per CPU, if None.
+    """
+    lsd_jobs = []
+    sim_tmrca = []
+    leaf_dates = []
+    for treefile, datesfile, outfile, res_file in jobs:
+        Tmrca, dates = _create_date_file_from_ffpopsim_tree(treefile, datesfile)
+        sim_tmrca.append(Tmrca)
+        leaf_dates.append(dates)
+        lsd_jobs.append((treefile, datesfile, outfile.replace(".nwk", ".res.txt")))
 
-    if not os.path.exists(res_file):
-        try:
-            with open(res_file, 'w') as of:
-                of.write("#File,Tmrca_real,Tmrca,Mu,objective\n")
-        except:
-            pass
+    # call LSD binary
+    results = run_lsd_batch(lsd_jobs, lsd_params=['-r', 'a', '-c', 'v'], max_running=max_running)
+    print ("LSD Done!")
+
+    for (treefile, datesfile, outfile, res_file), (_, _, lsd_outfile), Tmrca, dates, res in \
+            zip(jobs, lsd_jobs, sim_tmrca, leaf_dates, results):
+        if res.mu <= 0:
+            continue
 
-    with open(res_file, "a") as of:
-        of.write("{},{},{},{},{}\n".format(treefile, str(Tmrca), tmrca, mu, objective))
+        write_results_line(res_file,
+            ["File", "Tmrca_real", "Tmrca", "Mu", "objective"],
+            [treefile, str(Tmrca), res.tmrca, res.mu, res.objective])
+
+        if archive_dir is not None:
+            import utility_functions_results as results_utils
+            results_utils.record_result(archive_dir,
+                "lsd_fasttree" if treefile.endswith(".ft.nwk") else "lsd",
+                ["File", "Sim_Tmrca", "Tmrca", "mu", "obj"],
+                [treefile, Tmrca, res.tmrca, res.mu, res.objective])
+
+            # dates of all internal nodes from the time-scaled tree
+            date_tree = lsd_date_tree_file(lsd_outfile)
+            if date_tree is not None:
+                import utility_functions_tree as tree_utils
+                import utility_functions_node_dates as node_dates_utils
+                fasttree = treefile.endswith(".ft.nwk")
+                basename = treefile[:-len(".ft.nwk" if fasttree else ".opt.nwk")]
+                tree = tree_utils.CompactTree.read(date_tree, cache=False)
+                node_dates_utils.set_time_tree_dates(tree, dates, root_date=res.tmrca)
+                node_dates_utils.record_node_dates(archive_dir,
+                    "lsd_fasttree" if fasttree else "lsd", basename, tree)
 
 def run_ffpopsim_simulation(L, N, SAMPLE_VOL, SAMPLE_NUM, SAMPLE_FREQ, MU, res_dir, res_suffix, failed=None, **kwargs):
     """
@@ -329,6 +392,7 @@ def _ffpopsim_tree_aln_postprocess(basename, optimize_branch_len=False, prefix='
     resolved randomly). The nodes of tree are named in a unified way and if there are
     non-unique names found, they resolved by adding additional suffixes
     """
+    from Bio import Phylo, AlignIO
 
     def ffpopsim_aln_to_nuc(basename):
 
@@ -351,49 +415,12 @@ def _ffpopsim_tree_aln_postprocess(basename, optimize_branch_len=False, prefix='
                         nuc_seq[replace_ind] = 'C'
                         of.write("".join(nuc_seq)+'\n')
 
-    def generation_from_node_name(name):
-        try:
-            return int(name.split("_")[1])
-        except:
-            return -1
-
-
     from collections import Counter
+    import utility_functions_tree as tree_utils
 
-    t = Phylo.read(basename + ".nwk", "newick")
-    if len(t.root.clades)==1:
-        t.root = t.root.clades[0]
-    t = remove_polytomies(t)
-    cs = [k for k in t.find_clades() if len(k.clades)==1]
-    for clade in cs:
-        t.collapse(clade)
-    t.root.branch_length = 1e-5
-    t.ladderize()
-    # remove duplicate names:
-    t_counter = Counter(t.find_clades())
-    for clade in t.find_clades():
-        if clade.name is None:
-            continue
-        if t_counter[clade] > 1 :
-            name_suffix = t_counter[clade]
-            clade.name += "/"+str(name_suffix)
-            t_counter[clade] -= 1
-
-        if clade.name is not None and not clade.name.startswith(prefix):
-            clade.name = prefix + clade.name
-
-    max_generation = np.max([generation_from_node_name(k.name) for k in t.find_clades()])
-    min_generation = generation_from_node_name(t.root.name)
-    assert(max_generation > min_generation and min_generation > 0)
-
-    for clade in t.find_clades():
-        node_gen = generation_from_node_name(clade.name)
-        if clade.name is not None and not '_DATE_' in clade.name and node_gen != -1:
-            #clade.name += "_DATE_%d"%node_gen # + str(2016.5 - (max_generation - node_gen))
-            clade.name += "_DATE_" + str(NEAREST_DATE - (max_generation - node_gen))
-
-
-    Phylo.write(t, basename + ".nwk", "newick")
+    # unary nodes, polytomies, ladderization, names and dates in one pass
+    max_generation = tree_utils.normalize_ffpopsim_tree(basename + ".nwk", basename + ".nwk",
+                                                         NEAREST_DATE, prefix=prefix)
 
     # prepare alignment
     ffpopsim_aln_to_nuc(basename)
@@ -402,35 +429,34 @@ def _ffpopsim_tree_aln_postprocess(basename, optimize_branch_len=False, prefix='
     aln_counter = Counter(names)
     for k in aln:
         key = k.id
-        # remove duplicate names
+        # remove duplicate names, add name prefix and date
+        dup_suffix = None
         if (aln_counter[key] > 1):
-            k.id = k.id + "/" + str(aln_counter[k.id])
-            k.name = k.id
+            dup_suffix = aln_counter[key]
             aln_counter[key] -= 1
-        # add name prefix
-        if not k.id.startswith(prefix):
-            k.id = prefix + k.id
-            k.name = k.id
-
-        node_gen = generation_from_node_name(k.id)
-        if not "_DATE_" in k.id and node_gen != -1:
-            k.id += "_DATE_" + str( NEAREST_DATE- (max_generation - node_gen))
-            k.name = k.id
+        k.id = tree_utils.ffpopsim_node_name(k.id, max_generation, NEAREST_DATE, prefix, dup_suffix)
+        k.name = k.id
 
     AlignIO.write(aln, basename + ".nuc.fasta", "fasta")
 
     if optimize_branch_len:
         import treetime
         gtr = treetime.GTR.standard('jc')
-        tanc = treetime.TreeAnc(aln=aln,tree=t,gtr=gtr)
+        tanc = treetime.TreeAnc(aln=aln,tree=basename + ".nwk",gtr=gtr)
         tanc.optimize_seq_and_branch_len(reuse_branch_len=False,prune_short=False,infer_gtr=False)
         Phylo.write(tanc.tree, basename+".opt.nwk", "newick")
+        # binary snapshot of the optimized tree and the alignment for the
+        # downstream stages (see run_treetime)
+        import utility_functions_snapshot as snapshot_utils
+        snapshot_utils.write_treeanc_snapshot(basename + ".opt.snapshot", tanc, aln)
 
 def reconstruct_fasttree(basename, optimize_branch_len=False):
     """
     Run the fast tree reconstruction given the alignment produced by FFPopSim
     simulations
     """
+    from Bio import Phylo
+
     def fasttree_post_process(aln, basename, optimize_branch_len):
         ffpopsim_treefile = basename + ".nwk"
         treefile = basename + ".ft.nwk"
@@ -442,6 +468,7 @@ def reconstruct_fasttree(basename, optimize_branch_len=False):
 
         # optimize branch lengths (mainly, to remove the fasttree zero-lengths artefacts)
         if optimize_branch_len:
+            import treetime
             gtr = treetime.GTR.standard('jc')
             tanc = treetime.TreeAnc(tree=tree, aln=aln, gtr=gtr)
             tanc.optimize_seq_and_branch_len(reuse_branch_len=True,prune_short=False,infer_gtr=False,max_iter=5)
@@ -458,18 +485,26 @@ def reconstruct_fasttree(basename, optimize_branch_len=False):
     os.remove(outfile)
     Phylo.write(tree, outfile, 'newick')
 
-def generations_from_ffpopsim_tree(t):
+def _compact_tree(t):
     """
+    Convert the tree (file name or Biopython tree) to the CompactTree. The
+    files are read through the cache of the parsed trees.
     """
+    import utility_functions_tree as tree_utils
+    if isinstance(t, tree_utils.CompactTree):
+        return t
     if isinstance(t, str):
-        t = Phylo.read(t, 'newick')
+        return tree_utils.CompactTree.read(t)
+    return tree_utils.CompactTree.from_biopython(t)
+
+def generations_from_ffpopsim_tree(t):
+    """
+    """
+    tree = _compact_tree(t)
     try:
-        generations = {}
-        for clade in t.get_terminals():
-            if "_DATE_"not in clade.name:
-                continue
-            generations[clade.name] = float(clade.name.split("_")[1])
-        Gen_mrca = float (t.root.name.split("_")[1])
+        generations = {name: float(name.split("_")[1]) for name in tree.names[tree.leaves]
+                       if "_DATE_" in name}
+        Gen_mrca = float (tree.names[tree.root].split("_")[1])
         return Gen_mrca, generations
     except:
         return 0, {}
@@ -479,23 +514,20 @@ def dates_from_ffpopsim_tree(t):
     Args:
      - t: tree filename or BioPyhton tree object
     """
-    if isinstance(t, str):
-        t = Phylo.read(t, 'newick')
+    tree = _compact_tree(t)
     try:
-        dates = {}
-        for clade in t.get_terminals():
-            if "_DATE_"not in clade.name:
-                continue
-            dates[clade.name] = float(clade.name.split("_")[-1])
-        Tmrca = float (t.root.name.split("_")[-1])
+        dates = {name: float(name.split("_")[-1]) for name in tree.names[tree.leaves]
+                 if "_DATE_" in name}
+        Tmrca = float (tree.names[tree.root].split("_")[-1])
         return Tmrca, dates
     except:
         return NEAREST_DATE, {}
 
-def run_beast(basename, out_dir, res_file, fast_tree=True):
+def run_beast(basename, out_dir, res_file, fast_tree=True, archive_dir=None):
     """
     From basename, compose names for the tree, dates and lignment, and call
-    run_beast from the beast_utilities.py module
+    run_beast from the beast_utilities.py module. If the archive_dir is given,
+    the results are also recorded to the columnar archive as 'beast' method.
     """
 
     try: # if running in parallel, migh be simultaneous creation of the same dir from different threads
@@ -504,6 +536,7 @@ def run_beast(basename, out_dir, res_file, fast_tree=True):
     except:
         pass
     import utility_functions_beast as beast_utils
+    import utility_functions_results as results_utils
 
     if fast_tree:
         treename = basename + ".ft.nwk"
@@ -511,7 +544,7 @@ def run_beast(basename, out_dir, res_file, fast_tree=True):
         treename = basename + ".opt.nwk"
 
     alnname = basename + ".nuc.fasta"
-    Tmrca, dates = dates_from_ffpopsim_tree(Phylo.read(treename, "newick"))
+    Tmrca, dates = dates_from_ffpopsim_tree(treename)
     beast_res_prefix = os.path.join(out_dir, os.path.split(basename)[-1])
 
     # define log post-processing:
@@ -524,12 +557,13 @@ def run_beast(basename, out_dir, res_file, fast_tree=True):
             print ("Beast log {} is corrupted or BEAST run did not finish".format(log_file))
             return
 
-        Sim_Mu = float(log_file.split("/")[-1].split('_')[6][2:])
-        Ns = int(log_file.split("/")[-1].split('_')[3][2:])
-        Ts = int(log_file.split("/")[-1].split('_')[4][2:])
-        N = int(log_file.split("/")[-1].split('_')[2][1:])
-        T = Ns * Ts
-        Nmu = N * Sim_Mu
+        params = results_utils.ffpopsim_params(log_file)
+        Sim_Mu = params['Sim_mu']
+        Ns = params['Ns']
+        Ts = params['Ts']
+        N = params['N']
+        T = params['T']
+        Nmu = params['Nmu']
 
         inferred_LH = df['likelihood'][-50:].mean()
         inferred_LH_std = df['likelihood'][-50:].std()
@@ -541,20 +575,32 @@ def run_beast(basename, out_dir, res_file, fast_tree=True):
         #dTmrca = -(Sim_Tmrca[-1] - Tmrca[-1])
         #dMu =  Sim_Mu[-1] - Mu[-1]
 
-        res_str = "{},{},{},{},{},{},{},{},{},{},{},{},{},{}\n".format(
-            os.path.split(basename)[-1],
-            N,Tmrca,Sim_Mu,Ns,Ts,T,Nmu,
-            inferred_LH,inferred_LH_std,inferred_Tmrca,inferred_Tmrca_std,inferred_Mu,inferred_Mu_std)
-
-        if not os.path.exists(res_file):
-            try:
-                with open(res_file, 'w') as of:
-                    of.write("#Filename,PopSize,Tmrca_real,ClockRate_real,SamplesNum,SampleFreq,TotEvoTime(Ns*Ts),Nmu,LH,LH_std,Tmrca,Tmrca_std,Mu,Mu_std\n")
-            except:
-                pass
-
-        with open(res_file, 'a') as outfile:
-            outfile.write(res_str)
+        write_results_line(res_file,
+            ["Filename", "PopSize", "Tmrca_real", "ClockRate_real", "SamplesNum",
+             "SampleFreq", "TotEvoTime(Ns*Ts)", "Nmu", "LH", "LH_std", "Tmrca",
+             "Tmrca_std", "Mu", "Mu_std"],
+            [os.path.split(basename)[-1],
+             N,Tmrca,Sim_Mu,Ns,Ts,T,Nmu,
+             inferred_LH,inferred_LH_std,inferred_Tmrca,inferred_Tmrca_std,inferred_Mu,inferred_Mu_std])
+
+        if archive_dir is not None:
+            results_utils.record_result(archive_dir, "beast",
+                ["File", "Sim_Tmrca", "LH", "LH_std", "Tmrca", "Tmrca_std", "mu", "mu_std"],
+                [os.path.split(basename)[-1], Tmrca,
+                 inferred_LH, inferred_LH_std, inferred_Tmrca, inferred_Tmrca_std, inferred_Mu, inferred_Mu_std])
+
+            # dates of all internal nodes from the last sampled tree
+            trees_file = log_file[:-len(".log.txt")] + ".trees.txt"
+            if os.path.exists(trees_file):
+                import utility_functions_topology as topology_utils
+                import utility_functions_node_dates as node_dates_utils
+                try:
+                    tree = topology_utils.beast_last_tree(trees_file)
+                    node_dates_utils.set_time_tree_dates(tree, dates)
+                except Exception as e:
+                    print ("Cannot read the BEAST trees {}: {}".format(trees_file, e))
+                else:
+                    node_dates_utils.record_node_dates(archive_dir, "beast", basename, tree)
 
     beast_utils.run_beast(treename, alnname, dates, beast_res_prefix,
         template_file="./resources/beast/template_bedford_et_al_2015.xml",
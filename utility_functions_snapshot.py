@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+"""
+This module defines the binary snapshot of the optimized tree: the topology,
+the branch lengths and the alignment of the leaves (compressed to the unique
+alignment columns, or patterns). The branch
+length optimization (optimize_seq_and_branch_len) is the most expensive step
+of the tree preparation, so the optimized state is written once and restored
+by the downstream stages instead of repeating the optimization or parsing the
+newick and FASTA files again.
+
+The snapshot is a directory of NumPy .npy files, which can be memory-mapped:
+
+    <snapshot_dir>/parent.npy          parent index of every node (preorder, -1 for the root)
+    <snapshot_dir>/branch_length.npy   branch lengths (NaN if not set)
+    <snapshot_dir>/names.npy           node names (fixed width strings)
+    <snapshot_dir>/has_name.npy        whether the node has a name
+    <snapshot_dir>/leaves.npy          node indices of the alignment rows
+    <snapshot_dir>/patterns.npy        unique alignment columns (leaves x patterns, uint8)
+    <snapshot_dir>/pattern_index.npy   pattern index of every alignment column
+    <snapshot_dir>/multiplicity.npy    number of the alignment columns per pattern
+    <snapshot_dir>/meta.json           sizes and the user-defined info
+"""
+
+import os
+import json
+import hashlib
+import shutil
+import uuid
+import numpy as np
+
+SNAPSHOT_VERSION = 1
+
+SNAPSHOT_ARRAYS = ['parent', 'branch_length', 'names', 'has_name', 'leaves',
+                   'patterns', 'pattern_index', 'multiplicity']
+
+def _str(value):
+    """
+    Convert the fixed width string (bytes) of the NumPy array to str
+    """
+    if isinstance(value, bytes) and not isinstance(value, str):
+        return value.decode('ascii')
+    return str(value)
+
+def _alignment_dict(aln):
+    """
+    Convert the alignment (Biopython alignment, file name or dict) to the
+    dictionary {sequence name: sequence string}.
+    """
+    if isinstance(aln, dict):
+        return {k: str(v) for k, v in aln.items()}
+    if isinstance(aln, str):
+        from Bio import AlignIO
+        aln = AlignIO.read(aln, 'fasta')
+    return {k.name: str(k.seq) for k in aln}
+
+def compress_alignment(seqs):
+    """
+    Compress the alignment to the unique columns (patterns).
+
+    Args:
+
+     - seqs(list): aligned sequences (strings of the same length)
+
+    Returns:
+
+     - patterns(numpy.array): unique columns of the alignment, shape
+     (n_sequences, n_patterns), dtype uint8 (character codes)
+
+     - pattern_index(numpy.array): index of the pattern of every alignment
+     column
+
+     - multiplicity(numpy.array): number of the alignment columns per pattern
+    """
+    aln = np.array([np.frombuffer(s.encode('ascii'), dtype=np.uint8) for s in seqs])
+    patterns, pattern_index, multiplicity = np.unique(aln.T, axis=0,
+        return_inverse=True, return_counts=True)
+    return (np.ascontiguousarray(patterns.T), pattern_index.astype(np.int32),
+            multiplicity.astype(np.int32))
+
+def write_tree_snapshot(snapshot_dir, tree, aln, info=None):
+    """
+    Write the snapshot of the tree with the alignment of its leaves. The
+    snapshot is written to a temporary directory first and then renamed, so
+    that the readers never see a partially written snapshot.
+
+    Args:
+
+     - snapshot_dir(str): directory to write the snapshot to. Overwritten, if
+     exists.
+
+     - tree(Biopython tree): the tree
+
+     - aln(MultipleSeqAlignment, str or dict): alignment or path to the FASTA
+     file. Only the sequences of the tree leaves are stored.
+
+     - info(dict or None): additional information to store in the meta file
+     (should be JSON serializable)
+    """
+    nodes = list(tree.find_clades(order='preorder'))
+    node_idx = {id(n): i for i, n in enumerate(nodes)}
+    parent = np.full(len(nodes), -1, dtype=np.int32)
+    for n in nodes:
+        for c in n.clades:
+            parent[node_idx[id(c)]] = node_idx[id(n)]
+    branch_length = np.array([np.nan if n.branch_length is None else n.branch_length
+                              for n in nodes], dtype=np.float64)
+    has_name = np.array([n.name is not None for n in nodes], dtype=bool)
+    names = np.array([str(n.name) if n.name is not None else '' for n in nodes], dtype='S')
+
+    seqs = _alignment_dict(aln)
+    leaves = [i for i, n in enumerate(nodes) if n.is_terminal()]
+    missing = [nodes[i].name for i in leaves if nodes[i].name not in seqs]
+    if missing:
+        raise ValueError("No sequences for the leaves: {}".format(", ".join(str(k) for k in missing[:10])))
+    patterns, pattern_index, multiplicity = compress_alignment([seqs[nodes[i].name] for i in leaves])
+
+    arrays = {'parent': parent, 'branch_length': branch_length, 'names': names,
+              'has_name': has_name, 'leaves': np.array(leaves, dtype=np.int32),
+              'patterns': patterns, 'pattern_index': pattern_index,
+              'multiplicity': multiplicity}
+
+    meta = {'version': SNAPSHOT_VERSION, 'n_nodes': len(nodes), 'n_leaves': len(leaves),
+            'seq_len': int(pattern_index.shape[0]), 'n_patterns': int(multiplicity.shape[0]),
+            'rooted': bool(tree.rooted), 'info': info or {}}
+
+    parent_dir = os.path.dirname(os.path.abspath(snapshot_dir))
+    if not os.path.exists(parent_dir):
+        os.makedirs(parent_dir)
+    tmp_dir = os.path.join(parent_dir, ".tmp_" + uuid.uuid4().hex)
+    os.makedirs(tmp_dir)
+    for k, v in arrays.items():
+        np.save(os.path.join(tmp_dir, k + ".npy"), v)
+    with open(os.path.join(tmp_dir, "meta.json"), 'w') as of:
+        json.dump(meta, of, indent=1, sort_keys=True)
+
+    if os.path.exists(snapshot_dir):
+        shutil.rmtree(snapshot_dir)
+    os.rename(tmp_dir, snapshot_dir)
+
+def write_treeanc_snapshot(snapshot_dir, tanc, aln, info=None):
+    """
+    Write the snapshot of the TreeAnc (or TreeTime) object: its tree with the
+    alignment of the leaves. The GTR model is not stored: all trees are
+    optimized with the fixed Jukes-Cantor model.
+
+    Args:
+
+     - tanc(treetime.TreeAnc): the object, e.g. after optimize_seq_and_branch_len
+
+     - aln(MultipleSeqAlignment, str or dict): the alignment used to create
+     the object, or path to the FASTA file
+    """
+    write_tree_snapshot(snapshot_dir, tanc.tree, aln, info=info)
+
+def snapshot_exists(snapshot_dir):
+    """
+    Check whether the snapshot directory contains a complete snapshot
+    """
+    return os.path.exists(os.path.join(snapshot_dir, "meta.json"))
+
+def input_hashes(files):
+    """
+    Content hashes (SHA-1) of the input files of the snapshot, to be stored in
+    the info (see snapshot_is_current)
+    """
+    hashes = []
+    for fname in files:
+        sha = hashlib.sha1()
+        with open(fname, 'rb') as inf:
+            for chunk in iter(lambda: inf.read(1 << 20), b''):
+                sha.update(chunk)
+        hashes.append(sha.hexdigest())
+    return hashes
+
+def snapshot_is_current(snapshot_dir, files):
+    """
+    Check whether the snapshot exists and was written from the input files with
+    the same content, i.e. its info['inputs'] are the input_hashes of the files
+    """
+    if not snapshot_exists(snapshot_dir):
+        return False
+    with open(os.path.join(snapshot_dir, "meta.json")) as inf:
+        meta = json.load(inf)
+    return meta['info'].get('inputs') == input_hashes(files)
+
+def read_tree_snapshot(snapshot_dir, mmap=True):
+    """
+    Read the snapshot arrays.
+
+    Args:
+
+     - snapshot_dir(str): snapshot directory
+
+     - mmap(bool): memory-map the arrays instead of reading them
+
+    Returns:
+
+     - snapshot(dict): the arrays (see module description) and the 'meta'
+     dictionary
+    """
+    with open(os.path.join(snapshot_dir, "meta.json")) as inf:
+        meta = json.load(inf)
+    if meta['version'] != SNAPSHOT_VERSION:
+        raise ValueError("Unsupported snapshot version: {}".format(meta['version']))
+
+    mmap_mode = 'r' if mmap else None
+    snapshot = {k: np.load(os.path.join(snapshot_dir, k + ".npy"), mmap_mode=mmap_mode)
+                for k in SNAPSHOT_ARRAYS}
+    snapshot['meta'] = meta
+    return snapshot
+
+def snapshot_tree(snapshot):
+    """
+    Create the Biopython tree from the snapshot
+    """
+    from Bio.Phylo import BaseTree
+
+    parent = snapshot['parent']
+    branch_length = np.asarray(snapshot['branch_length'])
+    has_name = snapshot['has_name']
+    names = snapshot['names']
+    clades = []
+    for i in range(parent.shape[0]):
+        clade = BaseTree.Clade(
+            branch_length=None if np.isnan(branch_length[i]) else float(branch_length[i]),
+            name=_str(names[i]) if has_name[i] else None)
+        clades.append(clade)
+        # preorder: the parent is always created before its children
+        if parent[i] >= 0:
+            clades[parent[i]].clades.append(clade)
+    return BaseTree.Tree(root=clades[0], rooted=snapshot['meta']['rooted'])
+
+def snapshot_sequences(snapshot):
+    """
+    Expand the alignment patterns back to the full sequences.
+
+    Returns:
+
+     - seqs(dict): {leaf name: sequence string}
+    """
+    aln = np.asarray(snapshot['patterns'])[:, np.asarray(snapshot['pattern_index'])]
+    names = snapshot['names']
+    return {_str(names[node]): _str(aln[i].tostring())
+            for i, node in enumerate(snapshot['leaves'])}
+
+def snapshot_alignment(snapshot):
+    """
+    Create the Biopython alignment of the leaves from the snapshot (in the
+    order of the leaves in the tree)
+    """
+    from Bio.Align import MultipleSeqAlignment
+    from Bio.SeqRecord import SeqRecord
+    from Bio.Seq import Seq
+
+    seqs = snapshot_sequences(snapshot)
+    names = snapshot['names']
+    leaf_names = [_str(names[node]) for node in snapshot['leaves']]
+    return MultipleSeqAlignment([SeqRecord(Seq(seqs[k]), id=k, name=k, description='')
+                                 for k in leaf_names])
+
+def load_tree_snapshot(snapshot_dir):
+    """
+    Restore the tree and the alignment from the snapshot. These can be passed
+    directly to the TreeAnc or TreeTime constructors.
+
+    Returns:
+
+     - tree(Biopython tree), aln(MultipleSeqAlignment)
+    """
+    snapshot = read_tree_snapshot(snapshot_dir)
+    return snapshot_tree(snapshot), snapshot_alignment(snapshot)
+
+if __name__ == '__main__':
+    pass
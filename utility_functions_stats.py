@@ -0,0 +1,669 @@
+#!/usr/bin/env python
+"""
+This module defines the group statistics used to build the pivot tables for
+the figures. All groups are processed at once: the values are sorted by the
+group key and by value, and the statistics are computed from the group
+boundaries in the sorted array, without the Python loop over the groups.
+
+For the results, which are still being produced, the IncrementalPivot keeps
+the streaming statistics of every group and reads only the new results.
+"""
+
+import os
+import numpy as np
+
+# available statistics
+STATS = ['count', 'mean', 'std', 'median', 'q25', 'q75', 'iqr', 'min', 'max']
+
+def _sorted_quantile(x, lo, n, q):
+    """
+    Quantile q of every group of the sorted array. The group values occupy
+    x[lo:lo+n]. Linear interpolation between the data points is used, as in
+    numpy.percentile.
+    """
+    if len(x) == 0:
+        return np.full(len(lo), np.nan)
+    pos = lo + q * (n - 1)
+    i0 = np.clip(np.floor(pos).astype(int), 0, len(x) - 1)
+    i1 = np.clip(np.minimum(i0 + 1, lo + n - 1), 0, len(x) - 1)
+    res = x[i0] + (pos - i0) * (x[i1] - x[i0])
+    res[n <= 0] = np.nan
+    return res
+
+def _group_column_stats(groups, keys, values, stats, trim=0.0, ddof=0):
+    """
+    Compute the statistics of the values for every group.
+
+    Args:
+
+     - groups(numpy.array): sorted unique group keys
+
+     - keys(numpy.array): group key of every value
+
+     - values(numpy.array): the values. NaN values, and the values of the
+     groups not listed in the groups array, are ignored.
+
+     - stats(list): names of the statistics (see STATS)
+
+     - trim(float): fraction of the smallest and of the largest values of every
+     group to be discarded before the statistics are computed
+
+     - ddof(int): delta degrees of freedom for the standard deviation
+
+    Returns:
+
+     - res(dict): {statistic: numpy.array with the value for every group}
+    """
+    values = np.asarray(values, dtype=float)
+    ok = ~np.isnan(values) & np.isin(keys, groups)
+    keys, values = keys[ok], values[ok]
+    order = np.lexsort((values, keys))
+    keys, x = keys[order], values[order]
+
+    start = np.searchsorted(keys, groups, side='left')
+    count = np.searchsorted(keys, groups, side='right') - start
+    lo = start + np.floor(count * trim).astype(int)
+    hi = start + np.floor(count * (1. - trim)).astype(int)
+    n = hi - lo
+
+    res = {}
+    with np.errstate(invalid='ignore', divide='ignore'):
+        csum = np.concatenate([[0.], np.cumsum(x)])
+        mean = (csum[hi] - csum[lo]) / n
+        for stat in stats:
+            if stat == 'count':
+                res[stat] = n
+            elif stat == 'mean':
+                res[stat] = mean
+            elif stat == 'std':
+                # sum of squared deviations from the group mean. The groups
+                # trimmed to no values have NaN mean, which would spoil the
+                # cumulative sum of the next groups.
+                gid = np.repeat(np.arange(len(groups)), count)
+                group_mean = np.where(n > 0, mean, 0.)[gid]
+                csum2 = np.concatenate([[0.], np.cumsum((x - group_mean) ** 2)])
+                res[stat] = np.sqrt((csum2[hi] - csum2[lo]) / (n - ddof))
+                res[stat][n - ddof <= 0] = np.nan
+            elif stat == 'median':
+                res[stat] = _sorted_quantile(x, lo, n, 0.5)
+            elif stat == 'q25':
+                res[stat] = _sorted_quantile(x, lo, n, 0.25)
+            elif stat == 'q75':
+                res[stat] = _sorted_quantile(x, lo, n, 0.75)
+            elif stat == 'iqr':
+                res[stat] = _sorted_quantile(x, lo, n, 0.75) - _sorted_quantile(x, lo, n, 0.25)
+            elif stat == 'min':
+                res[stat] = _sorted_quantile(x, lo, n, 0.)
+            elif stat == 'max':
+                res[stat] = _sorted_quantile(x, lo, n, 1.)
+            else:
+                raise ValueError("Unknown statistic: {}. Available: {}".format(stat, ", ".join(STATS)))
+    return res
+
+def group_stats(df, by, columns, stats=('median', 'iqr'), trim=0.0, ddof=0, min_count=1):
+    """
+    Compute the statistics of the given columns for every group of rows.
+
+    Args:
+
+     - df(pandas.DataFrame): the input table
+
+     - by(str): name of the column with the group keys (e.g. 'Nmu', 'N')
+
+     - columns(list): names of the columns to compute the statistics for
+
+     - stats(list): names of the statistics, see STATS. The median and the
+     quantiles are interpolated linearly, as in numpy.percentile.
+
+     - trim(float): fraction of the smallest and of the largest values of every
+     group to be discarded before the statistics are computed (e.g. 0.05 to
+     keep the 5-95% of the values).
+
+     - ddof(int): delta degrees of freedom for the standard deviation: 0 as in
+     numpy.std, or 1 as in pandas.Series.std
+
+     - min_count(int): groups with fewer rows are dropped
+
+    Returns:
+
+     - res(pandas.DataFrame): table with the group key column and the
+     '<column>_<stat>' columns, sorted by the group key
+    """
+    import pandas
+    keys = np.asarray(df[by])
+    groups, n_rows = np.unique(keys, return_counts=True)
+    groups = groups[n_rows >= min_count]
+
+    res = pandas.DataFrame({by: groups})
+    for column in columns:
+        col_stats = _group_column_stats(groups, keys, np.asarray(df[column]), stats,
+                                        trim=trim, ddof=ddof)
+        for stat in stats:
+            res["{}_{}".format(column, stat)] = col_stats[stat]
+    return res
+
+def _bootstrap_block(args):
+    """
+    Bootstrap statistics of all groups for a block of the resamplings. The
+    resampled values are stored in the (groups x resamplings x max group size)
+    array, padded with NaN for the groups smaller than the largest one.
+
+    Args:
+
+     - args(tuple): (x, start, n, stats, n_boot, ddof, seed): the values sorted
+     by the group key, the group start positions and sizes in x, names of the
+     statistics, number of the resamplings, ddof and the random seed.
+
+    Returns:
+
+     - res(dict): {statistic: array (groups x resamplings)}
+    """
+    x, start, n, stats, n_boot, ddof, seed = args
+    rng = np.random.RandomState(seed)
+    n_groups, n_max = len(start), max(int(n.max()), 1)
+    if len(x) == 0:
+        return {stat: np.full((n_groups, n_boot), np.nan) for stat in stats}
+
+    # B x n index matrix for every group at once
+    idx = start[:, None, None] + (rng.random_sample((n_groups, n_boot, n_max)) * n[:, None, None]).astype(int)
+    valid = np.arange(n_max)[None, None, :] < n[:, None, None]
+    samples = np.where(valid, x[np.clip(idx, 0, len(x) - 1)], np.nan)
+    samples.sort(axis=2)  # NaN are sorted to the end
+
+    rows = np.arange(n_groups)[:, None]
+    cols = np.arange(n_boot)[None, :]
+    def quantile(q):
+        pos = q * (n - 1)
+        i0 = np.clip(np.floor(pos).astype(int), 0, n_max - 1)
+        i1 = np.clip(np.minimum(i0 + 1, n - 1), 0, n_max - 1)
+        res = samples[rows, cols, i0[:, None]] + (pos - i0)[:, None] * \
+            (samples[rows, cols, i1[:, None]] - samples[rows, cols, i0[:, None]])
+        res[n <= 0] = np.nan
+        return res
+
+    res = {}
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for stat in stats:
+            if stat == 'count':
+                res[stat] = np.repeat(n[:, None].astype(float), n_boot, axis=1)
+            elif stat == 'mean':
+                res[stat] = np.nansum(samples, axis=2) / n[:, None]
+            elif stat == 'std':
+                mean = np.nansum(samples, axis=2) / n[:, None]
+                res[stat] = np.sqrt(np.nansum((samples - mean[:, :, None]) ** 2, axis=2) / (n[:, None] - ddof))
+            elif stat == 'median':
+                res[stat] = quantile(0.5)
+            elif stat == 'q25':
+                res[stat] = quantile(0.25)
+            elif stat == 'q75':
+                res[stat] = quantile(0.75)
+            elif stat == 'iqr':
+                res[stat] = quantile(0.75) - quantile(0.25)
+            elif stat == 'min':
+                res[stat] = quantile(0.)
+            elif stat == 'max':
+                res[stat] = quantile(1.)
+            else:
+                raise ValueError("Unknown statistic: {}. Available: {}".format(stat, ", ".join(STATS)))
+    return res
+
+def group_bootstrap(df, by, columns, stats=('median', 'iqr'), n_boot=1000, ci=95.,
+                    ddof=0, min_count=1, seed=None, n_jobs=1, block_size=None):
+    """
+    Bootstrap confidence intervals of the group statistics. All groups are
+    resampled at once: for every group, the B x n matrix of the random indices
+    is drawn, and the statistics are computed along the rows.
+
+    Args:
+
+     - df(pandas.DataFrame), by(str), columns(list), stats(list), ddof(int),
+     min_count(int): as in group_stats. The trimming is not supported.
+
+     - n_boot(int): number of the bootstrap resamplings
+
+     - ci(float): confidence level, in percent
+
+     - seed(int or None): random seed, for the reproducible intervals
+
+     - n_jobs(int): number of the processes to compute the blocks of the
+     resamplings in parallel. Pays off only for large n_boot.
+
+     - block_size(int or None): number of the resamplings computed at once. By
+     default, chosen so that the resampled values take ~16 MB of memory.
+
+    Returns:
+
+     - res(pandas.DataFrame): the group statistics (as returned by group_stats)
+     plus, for every '<column>_<stat>', the '<column>_<stat>_lo',
+     '<column>_<stat>_hi' (percentile confidence interval) and
+     '<column>_<stat>_bias' (mean bootstrap value minus the statistic) columns.
+    """
+    res = group_stats(df, by, columns, stats=stats, ddof=ddof, min_count=min_count)
+    groups = res[by].values
+    keys = np.asarray(df[by])
+
+    rng = np.random.RandomState(seed)
+    for column in columns:
+        values = np.asarray(df[column], dtype=float)
+        ok = ~np.isnan(values) & np.isin(keys, groups)
+        col_keys, x = keys[ok], values[ok]
+        order = np.argsort(col_keys, kind='mergesort')
+        col_keys, x = col_keys[order], x[order]
+        start = np.searchsorted(col_keys, groups, side='left')
+        n = np.searchsorted(col_keys, groups, side='right') - start
+
+        block = block_size
+        if block is None:
+            block = max(1, int(2e6 // max(1, len(groups) * max(n.max(), 1))))
+        blocks = [min(block, n_boot - k) for k in range(0, n_boot, block)]
+        tasks = [(x, start, n, stats, b, ddof, rng.randint(2**31 - 1)) for b in blocks]
+        if n_jobs > 1 and len(tasks) > 1:
+            import multiprocessing
+            pool = multiprocessing.Pool(n_jobs)
+            try:
+                parts = pool.map(_bootstrap_block, tasks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            parts = [_bootstrap_block(k) for k in tasks]
+
+        with np.errstate(invalid='ignore'):
+            for stat in stats:
+                boot = np.concatenate([k[stat] for k in parts], axis=1)
+                name = "{}_{}".format(column, stat)
+                lo, hi = np.nanpercentile(boot, [(100. - ci) / 2., 100. - (100. - ci) / 2.], axis=1)
+                res[name + "_lo"] = lo
+                res[name + "_hi"] = hi
+                res[name + "_bias"] = np.nanmean(boot, axis=1) - res[name].values
+    return res
+
+def trim_groups(df, by, column, trim):
+    """
+    Discard the rows with the smallest and the largest values of the column in
+    every group (as the trim argument of group_stats does). Use it to bootstrap
+    the trimmed statistics.
+
+    Returns:
+
+     - df(pandas.DataFrame): the rows within the trimmed range of their group
+    """
+    keys = np.asarray(df[by])
+    values = np.asarray(df[column], dtype=float)
+    ok = ~np.isnan(values)
+    order = np.lexsort((values, keys))
+    order = order[ok[order]]
+    sorted_keys = keys[order]
+    groups, start, count = np.unique(sorted_keys, return_index=True, return_counts=True)
+    gid = np.repeat(np.arange(len(groups)), count)
+    pos = np.arange(len(order)) - start[gid]
+    keep = (pos >= np.floor(count * trim)[gid]) & (pos < np.floor(count * (1. - trim))[gid])
+    return df.iloc[np.sort(order[keep])]
+
+def simulated_errors(df, sim_mu='Sim_mu', mu='mu'):
+    """
+    Reconstruction errors on the simulated data: the relative error of the
+    mutation rate (dMu) and the error of the Tmrca in the units of the
+    coalescence time (dTmrca/N).
+
+    Returns:
+
+     - errors(pandas.DataFrame): table with the Nmu, T_over_N, dMu and dTmrca
+     columns
+    """
+    import pandas
+    return pandas.DataFrame({
+        "Nmu" : np.asarray(df["Nmu"]),
+        "T_over_N" : np.asarray(1. * df["T"] / df["N"]) if "T" in df else np.nan,
+        "dMu" : np.asarray(-(df[sim_mu] - df[mu]) / df[sim_mu]),
+        "dTmrca" : np.asarray(df["dTmrca"] / df["N"])})
+
+def simulated_errors_pivot(df, mean_or_median='median', trim_dTmrca=0.0, sim_mu='Sim_mu', mu='mu',
+                           n_boot=0, seed=None, n_jobs=1):
+    """
+    Pivot table of the reconstruction errors on the simulated data for every
+    Nmu value: the relative error of the mutation rate (dMu) and the error of
+    the Tmrca in the units of the coalescence time (dTmrca/N).
+
+    Args:
+
+     - df(pandas.DataFrame): results table with the Nmu, N, dTmrca columns and
+     the simulated and reconstructed mutation rates
+
+     - mean_or_median(str): 'mean' - the data point is the mean, the error is
+     the standard deviation; 'median' - the data point is the median, the error
+     is the inter-quartile range.
+
+     - trim_dTmrca(float): fraction of the extreme dTmrca values to discard on
+     either side (see group_stats)
+
+     - sim_mu(str), mu(str): names of the columns with the simulated and the
+     reconstructed mutation rates
+
+     - n_boot(int): if positive, the bootstrap confidence intervals (95%) and
+     the bias of the pivot values are computed with this number of resamplings
+     (see group_bootstrap)
+
+     - seed(int), n_jobs(int): see group_bootstrap
+
+    Returns:
+
+     - res(pandas.DataFrame): table with the Nmu, dMu_mean, dMu_err,
+     dTmrca_mean and dTmrca_err columns, sorted by Nmu. With the bootstrap,
+     also the '_lo', '_hi' and '_bias' columns for each of the values.
+    """
+    import pandas
+    errors = simulated_errors(df, sim_mu=sim_mu, mu=mu)
+    if mean_or_median == "mean":
+        stats = ['mean', 'std']
+    else:
+        stats = ['median', 'iqr']
+
+    dMu = group_stats(errors, 'Nmu', ['dMu'], stats=stats)
+    dTmrca = group_stats(errors, 'Nmu', ['dTmrca'], stats=stats, trim=trim_dTmrca)
+    res = pandas.DataFrame({
+        "Nmu" : dMu["Nmu"],
+        "dMu_mean" : dMu["dMu_" + stats[0]],
+        "dMu_err" : dMu["dMu_" + stats[1]],
+        "dTmrca_mean" : dTmrca["dTmrca_" + stats[0]],
+        "dTmrca_err" : dTmrca["dTmrca_" + stats[1]],
+        })
+
+    if n_boot > 0:
+        for column, data in [("dMu", errors),
+                             ("dTmrca", trim_groups(errors, 'Nmu', 'dTmrca', trim_dTmrca))]:
+            boot = group_bootstrap(data, 'Nmu', [column], stats=stats, n_boot=n_boot,
+                                   seed=seed, n_jobs=n_jobs).set_index('Nmu').reindex(res['Nmu'].values)
+            for name, stat in [("mean", stats[0]), ("err", stats[1])]:
+                for suffix in ["_lo", "_hi", "_bias"]:
+                    res["{}_{}{}".format(column, name, suffix)] = \
+                        boot["{}_{}{}".format(column, stat, suffix)].values
+    return res
+
+class P2Quantile(object):
+    """
+    Streaming estimate of a single quantile with the P-square algorithm (Jain
+    and Chlamtac, 1985). Only five markers are stored, regardless of the number
+    of the observations. Until five values are seen, the quantile is exact.
+    """
+
+    def __init__(self, q):
+        self.q = q
+        self.heights = []
+        self.pos = [1., 2., 3., 4., 5.]
+        self.desired = [1., 1. + 2 * q, 1. + 4 * q, 3. + 2 * q, 5.]
+        self.incr = [0., q / 2., q, (1. + q) / 2., 1.]
+
+    def add(self, x):
+        h, n = self.heights, self.pos
+        if len(h) < 5:
+            h.append(x)
+            h.sort()
+            return
+
+        if x < h[0]:
+            h[0] = x
+            k = 0
+        elif x >= h[4]:
+            h[4] = x
+            k = 3
+        else:
+            k = 0
+            while x >= h[k + 1]:
+                k += 1
+        for i in range(k + 1, 5):
+            n[i] += 1
+        for i in range(5):
+            self.desired[i] += self.incr[i]
+
+        # adjust the heights of the middle markers
+        for i in (1, 2, 3):
+            d = self.desired[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                d = 1. if d > 0 else -1.
+                hp = h[i] + d / (n[i + 1] - n[i - 1]) * (
+                    (n[i] - n[i - 1] + d) * (h[i + 1] - h[i]) / (n[i + 1] - n[i]) +
+                    (n[i + 1] - n[i] - d) * (h[i] - h[i - 1]) / (n[i] - n[i - 1]))
+                if not h[i - 1] < hp < h[i + 1]:
+                    j = i + int(d)
+                    hp = h[i] + d * (h[j] - h[i]) / (n[j] - n[i])
+                h[i] = hp
+                n[i] += d
+
+    def value(self):
+        if len(self.heights) == 0:
+            return np.nan
+        if len(self.heights) < 5 or self.pos[4] <= 5:
+            return np.percentile(self.heights, 100. * self.q)
+        return self.heights[2]
+
+class StreamingStats(object):
+    """
+    Statistics of a stream of values, updated one value at a time: the count,
+    the mean and the variance (Welford's algorithm), min, max and the quartiles.
+    The quartiles are exact until max_exact values are seen, and the P-square
+    estimates (see P2Quantile) after that, so the memory is bounded regardless
+    of the number of the values.
+    """
+
+    def __init__(self, max_exact=1000):
+        self.count = 0
+        self.mean = 0.
+        self.m2 = 0.
+        self.min = np.inf
+        self.max = -np.inf
+        self.max_exact = max_exact
+        self.values = []
+        self.quantiles = None
+
+    def add(self, x):
+        if np.isnan(x):
+            return
+        self.count += 1
+        delta = x - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (x - self.mean)
+        self.min = min(self.min, x)
+        self.max = max(self.max, x)
+        if self.quantiles is None:
+            self.values.append(x)
+            if len(self.values) <= self.max_exact:
+                return
+            # too many values to keep: switch to the streaming estimates
+            self.quantiles = {0.25 : P2Quantile(0.25), 0.5 : P2Quantile(0.5), 0.75 : P2Quantile(0.75)}
+            for value in self.values:
+                for sketch in self.quantiles.values():
+                    sketch.add(value)
+            self.values = []
+        else:
+            for sketch in self.quantiles.values():
+                sketch.add(x)
+
+    def quantile(self, q):
+        if self.quantiles is None:
+            return np.percentile(self.values, 100. * q)
+        return self.quantiles[q].value()
+
+    def stat(self, name, ddof=0):
+        """
+        Value of the statistic. The names are the same as in group_stats (see
+        STATS).
+        """
+        if self.count == 0 and name != 'count':
+            return np.nan
+        if name == 'count':
+            return self.count
+        elif name == 'mean':
+            return self.mean
+        elif name == 'std':
+            return np.sqrt(self.m2 / (self.count - ddof)) if self.count > ddof else np.nan
+        elif name == 'median':
+            return self.quantile(0.5)
+        elif name == 'q25':
+            return self.quantile(0.25)
+        elif name == 'q75':
+            return self.quantile(0.75)
+        elif name == 'iqr':
+            return self.quantile(0.75) - self.quantile(0.25)
+        elif name == 'min':
+            return self.min
+        elif name == 'max':
+            return self.max
+        raise ValueError("Unknown statistic: {}. Available: {}".format(name, ", ".join(STATS)))
+
+class IncrementalPivot(object):
+    """
+    Pivot table, which is updated as the results are appended to the CSV files.
+    For every group and column, the streaming statistics (see StreamingStats)
+    are kept, together with the read position in every file. On update, only
+    the lines appended since the last update are read. The state is saved to
+    the checkpoint file between the runs, so the pivot (and the figure) is
+    produced in the time, which does not depend on the number of the results.
+
+    Args:
+
+     - csv_columns(list): names of the columns in the CSV files
+
+     - by(str or list): column(s) with the group keys, after the transform
+
+     - columns(list): columns to compute the statistics for, after the transform
+
+     - transform(function or None): function to process the new rows (as
+     pandas.DataFrame with csv_columns) before the aggregation, e.g. to compute
+     the errors or to parse the simulation parameters. The function should be
+     defined on the module level, so that the pivot can be saved.
+    """
+
+    def __init__(self, csv_columns, by, columns, transform=None):
+        self.csv_columns = csv_columns
+        self.by = [by] if isinstance(by, str) else list(by)
+        self.columns = columns
+        self.transform = transform
+        self.offsets = {}
+        self.sketches = {}
+
+    def _reset(self):
+        self.offsets = {}
+        self.sketches = {}
+
+    def update(self, files):
+        """
+        Read the lines appended to the files since the last update and add them
+        to the statistics. If a file got shorter (it was re-written), all files
+        are read again from the start.
+
+        Returns:
+
+         - n_rows(int): number of the rows added
+        """
+        import pandas
+        from StringIO import StringIO
+        if isinstance(files, str):
+            files = [files]
+        if any(os.path.getsize(f) < self.offsets.get(f, 0) for f in files if os.path.exists(f)):
+            self._reset()
+
+        n_rows = 0
+        for fname in files:
+            if not os.path.exists(fname):
+                continue
+            with open(fname) as inf:
+                inf.seek(self.offsets.get(fname, 0))
+                chunk = inf.read()
+            # the last line might be still being written
+            chunk = chunk[:chunk.rfind('\n') + 1]
+            if chunk.strip() == "":
+                continue
+            self.offsets[fname] = self.offsets.get(fname, 0) + len(chunk)
+
+            df = pandas.read_csv(StringIO(chunk), names=self.csv_columns, comment='#')
+            if self.transform is not None:
+                df = self.transform(df)
+            keys = zip(*[df[k].values for k in self.by])
+            for column in self.columns:
+                for key, value in zip(keys, np.asarray(df[column], dtype=float)):
+                    if (column, key) not in self.sketches:
+                        self.sketches[(column, key)] = StreamingStats()
+                    self.sketches[(column, key)].add(value)
+            n_rows += df.shape[0]
+        return n_rows
+
+    def pivot(self, stats=('median', 'iqr'), ddof=0, min_count=1):
+        """
+        Current pivot table, in the same format as returned by group_stats.
+        """
+        import pandas
+        keys = sorted(set(k for c, k in self.sketches))
+        res = pandas.DataFrame({b: [k[idx] for k in keys] for idx, b in enumerate(self.by)},
+                               columns=self.by)
+        n_rows = np.zeros(len(keys), dtype=int)
+        for column in self.columns:
+            sketches = [self.sketches.get((column, k), StreamingStats()) for k in keys]
+            n_rows = np.maximum(n_rows, [k.count for k in sketches])
+            for stat in stats:
+                res["{}_{}".format(column, stat)] = [k.stat(stat, ddof) for k in sketches]
+        return res[n_rows >= min_count].reset_index(drop=True)
+
+    def save(self, checkpoint_file):
+        import cPickle
+        with open(checkpoint_file, 'wb') as of:
+            cPickle.dump(self, of, protocol=2)
+
+    @staticmethod
+    def load(checkpoint_file):
+        import cPickle
+        with open(checkpoint_file, 'rb') as inf:
+            return cPickle.load(inf)
+
+def incremental_pivot(checkpoint_file, files, csv_columns, by, columns, transform=None):
+    """
+    Load the incremental pivot from the checkpoint (or create the new one), add
+    the results appended to the files since the last call and save the
+    checkpoint again. See IncrementalPivot for the arguments.
+
+    Returns:
+
+     - pivot(IncrementalPivot): the updated pivot. Call its pivot() method to
+     get the table.
+    """
+    if checkpoint_file is not None and os.path.exists(checkpoint_file):
+        agg = IncrementalPivot.load(checkpoint_file)
+    else:
+        agg = IncrementalPivot(csv_columns, by, columns, transform=transform)
+    agg.update(files)
+    if checkpoint_file is not None:
+        agg.save(checkpoint_file)
+    return agg
+
+def incremental_errors_pivot(agg, mean_or_median='median', T_over_N=None):
+    """
+    Pivot table of the reconstruction errors (as simulated_errors_pivot) from
+    the incremental pivot, which aggregates the dMu and dTmrca columns by the
+    Nmu key, or by the T_over_N and Nmu keys to select the T_over_N value (see
+    simulated_errors). The bootstrap and the trimming need the raw values and
+    are not available here.
+    """
+    import pandas
+    if mean_or_median == "mean":
+        stats = ['mean', 'std']
+    else:
+        stats = ['median', 'iqr']
+    if T_over_N is None and agg.by != ['Nmu']:
+        raise ValueError("Without T_over_N, the pivot should be aggregated by Nmu only, got: {}".format(
+            ", ".join(agg.by)))
+    if T_over_N is not None and 'T_over_N' not in agg.by:
+        raise ValueError("The pivot is not aggregated by T_over_N")
+    table = agg.pivot(stats=stats)
+    if T_over_N is not None:
+        table = table[np.isclose(table["T_over_N"], T_over_N)]
+    res = pandas.DataFrame({
+        "Nmu" : table["Nmu"].values,
+        "dMu_mean" : table["dMu_" + stats[0]].values,
+        "dMu_err" : table["dMu_" + stats[1]].values,
+        "dTmrca_mean" : table["dTmrca_" + stats[0]].values,
+        "dTmrca_err" : table["dTmrca_" + stats[1]].values,
+        })
+    return res.sort_values(by='Nmu').reset_index(drop=True)
+
+if __name__ == '__main__':
+    pass
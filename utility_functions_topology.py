@@ -0,0 +1,361 @@
+#!/usr/bin/env python
+"""
+This module defines the topological accuracy metrics of the reconstructed
+trees: the Robinson-Foulds distance (the number of the bipartitions found in
+only one of the trees), its normalized version and the Kuhner-Felsenstein
+branch score (the Euclidean distance between the branch length vectors of the
+two trees indexed by the bipartitions).
+
+The bipartitions of a tree are the leaf bitsets of its clades (uint64 words,
+one bit per leaf in the common leaf order), computed for all nodes at once
+from the CompactTree arrays (see utility_functions_tree.py). The bitsets are
+oriented so that the first leaf is never in the set, so the trees are compared
+as unrooted, and the two root branches form a single bipartition. The pairs of
+the trees are distributed over the process pool.
+
+The simulated dataset trees are compared to the true FFpopSim topology (with
+the optimized branch lengths in substitutions per site, <basename>.opt.nwk),
+and the results are recorded to the results archive (see
+utility_functions_results.py) as 'topology_<method>'. The BEAST trees are
+scaled in years, so their KF score is not comparable and is stored as NaN:
+
+    fasttree            <basename>.ft.nwk
+    treetime            <basename>.treetime.nwk
+    treetime_fasttree   <basename>.treetime.ft.nwk
+    beast               the last tree of the BEAST run (<beast_dir>/<name>.trees.txt)
+"""
+
+import os
+import numpy as np
+from collections import namedtuple
+
+import utility_functions_tree as tree_utils
+
+# distances between the two trees (see tree_distances)
+TreeDistances = namedtuple('TreeDistances', ['rf', 'nrf', 'kf', 'n_splits1', 'n_splits2', 'n_leaves'])
+
+# the compared trees: method name and the tree file suffix
+TOPOLOGY_METHODS = [('fasttree', ".ft.nwk"), ('treetime', ".treetime.nwk"),
+                    ('treetime_fasttree', ".treetime.ft.nwk")]
+
+# methods, which trees are scaled in time: the KF score is not recorded
+TIME_TREE_METHODS = ['beast']
+
+TOPOLOGY_COLUMNS = ["File", "RF", "nRF", "KF", "N_splits", "N_splits_true", "N_leaves"]
+
+def _popcount(bits):
+    """
+    Number of the set bits in every row of the uint64 matrix
+    """
+    return np.unpackbits(bits.view(np.uint8), axis=1).sum(axis=1)
+
+def clade_bitsets(tree, taxa):
+    """
+    Leaf bitsets of the clades of all nodes of the tree.
+
+    Args:
+
+     - tree(CompactTree): the tree
+
+     - taxa(dict): bit index of every leaf name. All leaves of the tree should
+     be in the dict.
+
+    Returns:
+
+     - bits(numpy.array): uint64 matrix (n_nodes x n_words), the bit of every
+     leaf below the node is set
+    """
+    n_words = (len(taxa) + 63) // 64
+    bits = np.zeros((tree.n_nodes, n_words), dtype=np.uint64)
+    leaf_bit = np.array([taxa[k] for k in tree.names[tree.leaves]], dtype=np.int64)
+    bits[tree.leaves, leaf_bit // 64] = np.left_shift(np.uint64(1), (leaf_bit % 64).astype(np.uint64))
+    return tree.clade_reduce(bits, np.bitwise_or)
+
+def bitset_keys(bits):
+    """
+    Convert the rows of the bitset matrix to the hashable and sortable keys
+    (void dtype), e.g. to match them with np.unique
+    """
+    return np.ascontiguousarray(bits).view(np.dtype((np.void, 8 * bits.shape[1]))).ravel()
+
+def split_bitsets(tree, taxa):
+    """
+    Bipartitions of the tree branches.
+
+    Args:
+
+     - tree(CompactTree): the tree
+
+     - taxa(dict): bit index of every leaf name. All leaves of the tree should
+     be in the dict.
+
+    Returns:
+
+     - keys(numpy.array): bipartitions of the branches (void dtype, can be
+     compared and sorted), one per non-root node
+
+     - size(numpy.array): number of the leaves on the smaller side of every
+     bipartition
+
+     - branch_length(numpy.array): branch lengths (0 if not set)
+    """
+    n_taxa = len(taxa)
+    n_words = (n_taxa + 63) // 64
+    bits = clade_bitsets(tree, taxa)
+
+    nodes = np.where(tree.parent >= 0)[0]
+    bits = bits[nodes]
+    # orient the bipartitions: the first leaf is never in the set
+    full = np.full(n_words, np.uint64(0xFFFFFFFFFFFFFFFF), dtype=np.uint64)
+    if n_taxa % 64:
+        full[-1] = np.uint64((1 << (n_taxa % 64)) - 1)
+    flip = (bits[:, 0] & np.uint64(1)) > 0
+    bits[flip] = ~bits[flip] & full
+
+    size = _popcount(bits)
+    size = np.minimum(size, n_taxa - size)
+    return bitset_keys(bits), size, np.nan_to_num(tree.branch_length[nodes])
+
+def common_leaves(tree1, tree2):
+    """
+    Reduce both trees to their common leaves (see CompactTree.subtree).
+
+    Returns:
+
+     - tree1, tree2(CompactTree): the reduced trees
+
+     - taxa(dict): bit index of every common leaf (in the order of the names)
+    """
+    leaves1, leaves2 = set(tree1.leaf_names()), set(tree2.leaf_names())
+    common = leaves1 & leaves2
+    if len(common) < 2:
+        raise ValueError("The trees have less than two common leaves")
+    if len(common) < len(leaves1):
+        tree1 = tree1.subtree(tree1.leaf_mask(common))
+    if len(common) < len(leaves2):
+        tree2 = tree2.subtree(tree2.leaf_mask(common))
+    return tree1, tree2, {name: idx for idx, name in enumerate(sorted(common))}
+
+def tree_distances(tree1, tree2):
+    """
+    Robinson-Foulds and Kuhner-Felsenstein distances between two trees. If the
+    leaf sets differ, both trees are reduced to the common leaves.
+
+    Args:
+
+     - tree1(CompactTree, Biopython tree or str): the first tree (e.g. the true
+     tree)
+
+     - tree2(CompactTree, Biopython tree or str): the second tree
+
+    Returns:
+
+     - distances(TreeDistances): RF (the number of the non-trivial bipartitions
+     in only one of the trees), normalized RF (RF divided by the total number of
+     the non-trivial bipartitions), KF branch score (over all branches, the
+     terminal ones included), the numbers of the non-trivial bipartitions and
+     the number of the common leaves
+    """
+    tree1, tree2, taxa = common_leaves(_compact(tree1), _compact(tree2))
+    n_taxa = len(taxa)
+
+    keys1, size1, bl1 = split_bitsets(tree1, taxa)
+    keys2, size2, bl2 = split_bitsets(tree2, taxa)
+    keys, inverse = np.unique(np.concatenate([keys1, keys2]), return_inverse=True)
+    inv1, inv2 = inverse[:keys1.shape[0]], inverse[keys1.shape[0]:]
+    n_keys = keys.shape[0]
+
+    size = np.zeros(n_keys, dtype=np.int64)
+    size[inverse] = np.concatenate([size1, size2])
+    # the unary nodes and the root branches give the repeated bipartitions
+    in1 = np.bincount(inv1, minlength=n_keys) > 0
+    in2 = np.bincount(inv2, minlength=n_keys) > 0
+    length1 = np.bincount(inv1, weights=bl1, minlength=n_keys)
+    length2 = np.bincount(inv2, weights=bl2, minlength=n_keys)
+
+    nontrivial = size >= 2
+    n_splits1 = int((nontrivial & in1).sum())
+    n_splits2 = int((nontrivial & in2).sum())
+    rf = int((nontrivial & (in1 != in2)).sum())
+    nrf = float(rf) / (n_splits1 + n_splits2) if n_splits1 + n_splits2 > 0 else 0.
+    kf = float(np.sqrt(((length1 - length2) ** 2).sum()))
+    return TreeDistances(rf, nrf, kf, n_splits1, n_splits2, n_taxa)
+
+def _compact(tree):
+    if isinstance(tree, tree_utils.CompactTree):
+        return tree
+    if isinstance(tree, str):
+        return tree_utils.read_newick(tree)
+    return tree_utils.CompactTree.from_biopython(tree)
+
+def _pair_distances(pair):
+    """
+    Distances for one pair of the trees in the pool worker. None, if any of
+    the trees cannot be read.
+    """
+    tree1, tree2 = pair
+    try:
+        return tree_distances(tree1, tree2)
+    except Exception as e:
+        print ("Cannot compare the trees {} and {}: {}".format(tree1, tree2, e))
+        return None
+
+def batch_tree_distances(pairs, n_jobs=None, chunksize=16):
+    """
+    Compute the distances for many pairs of the trees over the process pool.
+
+    Args:
+
+     - pairs(list): (tree1, tree2) pairs. The trees are preferably given as the
+     file paths, so that only the names are sent to the workers.
+
+     - n_jobs(int or None): number of the worker processes. One per CPU if None,
+     no pool if 1.
+
+     - chunksize(int): number of the pairs sent to a worker at once
+
+    Returns:
+
+     - distances(list): TreeDistances for every pair (None if failed), in the
+     order of the pairs
+    """
+    import multiprocessing
+
+    if n_jobs is None:
+        n_jobs = multiprocessing.cpu_count()
+    if n_jobs <= 1 or len(pairs) <= 1:
+        return [_pair_distances(k) for k in pairs]
+    pool = multiprocessing.Pool(min(n_jobs, len(pairs)))
+    try:
+        return pool.map(_pair_distances, pairs, chunksize=chunksize)
+    finally:
+        pool.close()
+        pool.join()
+
+def beast_last_tree(trees_file):
+    """
+    Read the last tree of the BEAST run (nexus trees file) as the CompactTree
+    """
+    import dendropy
+    import StringIO
+    # keep the underscores of the FFpopSim names (dendropy converts them to spaces)
+    trees = dendropy.TreeList.get_from_path(trees_file, schema="nexus", preserve_underscores=True)
+    out = StringIO.StringIO()
+    trees[-1].write_to_stream(out, 'newick')
+    return tree_utils.parse_newick(out.getvalue())
+
+def topology_jobs(basenames, beast_dir=None):
+    """
+    Create the pairs of the trees to compare for the simulated dataset.
+
+    Args:
+
+     - basenames(list): FFpopSim file prefixes
+
+     - beast_dir(str or None): directory of the BEAST results. If given, the
+     last tree of every BEAST run is compared as well.
+
+    Returns:
+
+     - jobs(list): (method, basename, true tree file, tree) tuples. Only the
+     existing trees are included.
+    """
+    jobs = []
+    for basename in basenames:
+        # the FFpopSim tree (<basename>.nwk) is scaled in generations, so only
+        # the optimized tree is used as the reference
+        true_tree = basename + ".opt.nwk"
+        if not os.path.exists(true_tree):
+            continue
+        for method, suffix in TOPOLOGY_METHODS:
+            if os.path.exists(basename + suffix):
+                jobs.append((method, basename, true_tree, basename + suffix))
+        if beast_dir is not None:
+            beast_file = os.path.join(beast_dir, os.path.split(basename)[-1] + ".trees.txt")
+            if os.path.exists(beast_file):
+                try:
+                    jobs.append(('beast', basename, true_tree, beast_last_tree(beast_file)))
+                except Exception as e:
+                    print ("Cannot read the BEAST trees {}: {}".format(beast_file, e))
+    return jobs
+
+def _record_distances(archive_dir, jobs, distances):
+    """
+    Record the distances of the topology jobs to the results archive, one
+    'topology_<method>' table per method.
+
+    Returns:
+
+     - n_rows(int): number of the recorded rows
+    """
+    import utility_functions_results as results_utils
+
+    by_method = {}
+    for (method, basename, _, _), dist in zip(jobs, distances):
+        if dist is None:
+            continue
+        params = results_utils.ffpopsim_params(basename)
+        if params is None:
+            continue
+        kf = np.nan if method in TIME_TREE_METHODS else dist.kf
+        row = dict(params)
+        row.update(dict(zip(TOPOLOGY_COLUMNS,
+            [os.path.split(basename)[-1], dist.rf, dist.nrf, kf,
+             dist.n_splits2, dist.n_splits1, dist.n_leaves])))
+        columns = by_method.setdefault(method, {})
+        for k, v in row.items():
+            columns.setdefault(k, []).append(v)
+
+    n_rows = 0
+    for method, columns in by_method.items():
+        n_rows += results_utils.write_partition(archive_dir, "topology_" + method, columns)
+    return n_rows
+
+def record_topology(basename, archive_dir, beast_dir=None):
+    """
+    Compare the reconstructed trees of a single simulation to the true tree and
+    record the distances to the results archive (see topology_dataset).
+
+    Returns:
+
+     - n_pairs(int): number of the compared pairs
+    """
+    jobs = topology_jobs([basename], beast_dir)
+    return _record_distances(archive_dir, jobs, [_pair_distances(k[2:]) for k in jobs])
+
+def topology_dataset(res_dir, archive_dir, beast_dir=None, n_jobs=None):
+    """
+    Compare all reconstructed trees of the simulated dataset to the true trees,
+    and record the distances to the results archive as 'topology_<method>'
+    (columns: TOPOLOGY_COLUMNS with the simulation parameters).
+
+    Args:
+
+     - res_dir(str): directory of the simulated dataset (FFpopSim trees and the
+     reconstructed trees)
+
+     - archive_dir(str): root directory of the results archive
+
+     - beast_dir(str or None): directory of the BEAST results
+
+     - n_jobs(int or None): number of the worker processes
+
+    Returns:
+
+     - n_pairs(int): number of the compared pairs
+    """
+    basenames = sorted(set(os.path.join(res_dir, k[:-len(".nuc.fasta")]) for k in os.listdir(res_dir)
+                           if k.startswith("FFpopSim") and k.endswith(".nuc.fasta")))
+    jobs = topology_jobs(basenames, beast_dir)
+    distances = batch_tree_distances([k[2:] for k in jobs], n_jobs=n_jobs)
+    return _record_distances(archive_dir, jobs, distances)
+
+if __name__ == '__main__':
+    import sys
+    # compare the trees of the dataset: res_dir archive_dir [beast_dir [n_jobs]]
+    if len(sys.argv) < 3:
+        sys.stderr.write("Usage: utility_functions_topology.py res_dir archive_dir [beast_dir [n_jobs]]\n")
+        sys.exit(1)
+    beast_dir = sys.argv[3] if len(sys.argv) > 3 and sys.argv[3] != "None" else None
+    n_jobs = int(sys.argv[4]) if len(sys.argv) > 4 else None
+    print ("{} tree pairs compared".format(topology_dataset(sys.argv[1], sys.argv[2], beast_dir, n_jobs)))
@@ -0,0 +1,707 @@
+#!/usr/bin/env python
+"""
+This module defines the tree utilities, which work on the flat array
+representation of the tree instead of the Biopython clade objects: the nodes
+are numbered, and the tree is stored as the arrays of the node names, branch
+lengths and the parent index, with the list of children of every node. The
+CompactTree class wraps these arrays with the vectorized per-node operations
+and the conversion to and from Biopython.
+
+The FFpopSim trees are normalized with a single traversal of the Biopython
+tree: the unary nodes are collapsed while the arrays are built, and the
+polytomy resolution, ladderization, name deduplication and the generation to
+date conversion are done on the arrays before the newick is written once.
+
+The newick files are parsed directly to the arrays (parse_newick), and the
+parsed trees are cached on disk by the hash of the file content (read_newick,
+TREE_CACHE_DIR), so the repeated reads of the same tree are memory-mapped
+loads.
+"""
+
+import os
+import re
+import hashlib
+import shutil
+import uuid
+import numpy as np
+from collections import Counter
+
+# characters, which require the name to be quoted in the newick format
+NEWICK_QUOTE_REGEX = re.compile(r"[\s():;,\[\]']")
+
+def newick_name(name):
+    """
+    Format the node name for the newick string (quoted, if needed)
+    """
+    if name is None:
+        return ''
+    name = str(name)
+    if NEWICK_QUOTE_REGEX.search(name):
+        return "'" + name.replace("'", "''") + "'"
+    return name
+
+def flatten_tree(tree, collapse_unary=True):
+    """
+    Convert the Biopython tree to the arrays (single preorder traversal).
+
+    Args:
+
+     - tree(Biopython tree or clade): the tree
+
+     - collapse_unary(bool): skip the nodes with a single child. The branch
+     length of the skipped node is added to its child (as Biopython's collapse
+     does). The unary root is replaced by its child.
+
+    Returns:
+
+     - names(list): node names (None for the unnamed nodes)
+
+     - branch_length(list): branch lengths (0 for the missing ones)
+
+     - parent(list): parent index of every node, -1 for the root
+
+     - children(list): list of the children indices of every node
+
+    The nodes are numbered in preorder, the root is the node 0.
+    """
+    root = getattr(tree, 'root', tree)
+    names, branch_length, parent, children = [], [], [], []
+    if collapse_unary:
+        while len(root.clades) == 1:
+            root = root.clades[0]
+    stack = [(root, -1, 0.0)]
+    while stack:
+        clade, par, extra = stack.pop()
+        if collapse_unary and par >= 0:
+            while len(clade.clades) == 1:
+                extra += clade.branch_length or 0.0
+                clade = clade.clades[0]
+        idx = len(names)
+        names.append(clade.name)
+        branch_length.append((clade.branch_length or 0.0) + extra)
+        parent.append(par)
+        children.append([])
+        if par >= 0:
+            children[par].append(idx)
+        for child in reversed(clade.clades):
+            stack.append((child, idx, 0.0))
+    return names, branch_length, parent, children
+
+def write_newick(names, branch_length, children, root=0, bl_format="%1.5f"):
+    """
+    Create the newick string of the tree given by the arrays. The branch lengths
+    are formatted as by Biopython's newick writer.
+
+    Args:
+
+     - names(list), branch_length(list), children(list): the tree arrays (see
+     flatten_tree)
+
+     - root(int): index of the root node
+
+    Returns:
+
+     - newick(str): the tree in the newick format, ending with ';'
+    """
+    out = []
+    # (node, next child position)
+    stack = [(root, 0)]
+    while stack:
+        node, pos = stack.pop()
+        if pos < len(children[node]):
+            out.append("(" if pos == 0 else ",")
+            stack.append((node, pos + 1))
+            stack.append((children[node][pos], 0))
+            continue
+        if children[node]:
+            out.append(")")
+        out.append(newick_name(names[node]) + ":" + bl_format % branch_length[node])
+    return "".join(out) + ";"
+
+def ffpopsim_generation(name):
+    """
+    Generation of the node from the FFpopSim node name (-1 if not given)
+    """
+    try:
+        return int(name.split("_")[1])
+    except:
+        return -1
+
+def ffpopsim_node_name(name, max_generation, nearest_date, prefix='Node/', dup_suffix=None):
+    """
+    Create the unified node name from the FFpopSim name: add the duplicate
+    suffix, the name prefix and the date of the node (if the generation is
+    encoded in the name).
+
+    Args:
+
+     - name(str): FFpopSim node name
+
+     - max_generation(int): generation of the most recent node, which gets
+     the nearest_date
+
+     - dup_suffix(int or None): suffix to make the duplicate name unique
+    """
+    node_gen = ffpopsim_generation(name)
+    if dup_suffix is not None:
+        name += "/" + str(dup_suffix)
+    if not name.startswith(prefix):
+        name = prefix + name
+    if not '_DATE_' in name and node_gen != -1:
+        name += "_DATE_" + str(nearest_date - (max_generation - node_gen))
+    return name
+
+def normalize_ffpopsim_tree(tree, outfile, nearest_date, prefix='Node/', mode='balanced', seed=None):
+    """
+    Normalize the FFpopSim tree and write it to the newick file. The Biopython
+    tree is traversed once, the rest is done on the arrays:
+
+     - the unary nodes are collapsed (the unary root is replaced by its child)
+
+     - the polytomies are resolved (see utility_functions_general.remove_polytomies)
+
+     - the root branch length is set to 1e-5, the tree is ladderized
+
+     - the duplicate names get the '/<n>' suffixes, the names get the prefix
+     and the '_DATE_<date>' suffix computed from the generation of the node
+
+    Args:
+
+     - tree(Biopython tree or str): the FFpopSim tree or the path to it
+
+     - outfile(str): path to write the normalized tree to
+
+     - nearest_date(float): date of the most recent node
+
+     - mode(str), seed(int or None): polytomy resolution mode and seed
+
+    Returns:
+
+     - max_generation(int): generation of the most recent node (needed to
+     convert the names of the alignment records)
+    """
+    from utility_functions_general import _resolve_polytomy
+
+    if isinstance(tree, str):
+        from Bio import Phylo
+        tree = Phylo.read(tree, 'newick')
+
+    names, branch_length, parent, children = flatten_tree(tree)
+    n_nodes = len(names)
+
+    # number of the leaves below every node: the children have the larger
+    # indices in preorder, so the reverse order is a postorder
+    n_leaves = [0] * n_nodes
+    for node in range(n_nodes - 1, -1, -1):
+        n_leaves[node] = sum(n_leaves[k] for k in children[node]) if children[node] else 1
+
+    def _join(c1, c2):
+        names.append("None")
+        branch_length.append(1e-5)
+        parent.append(-1)
+        children.append([c1, c2])
+        n_leaves.append(n_leaves[c1] + n_leaves[c2])
+        parent[c1] = parent[c2] = len(names) - 1
+        return len(names) - 1
+
+    rng = np.random.RandomState(seed)
+    for node in range(n_nodes):
+        if len(children[node]) > 2:
+            children[node] = _resolve_polytomy(children[node], mode, rng, join=_join)
+            for k in children[node]:
+                parent[k] = node
+    branch_length[0] = 1e-5
+
+    # ladderize: the stable sort by the number of leaves, as Biopython's ladderize
+    for node_children in children:
+        node_children.sort(key=lambda k: n_leaves[k])
+
+    generations = [ffpopsim_generation(k) for k in names]
+    max_generation = max(generations)
+    min_generation = generations[0]
+    assert(max_generation > min_generation and min_generation > 0)
+
+    # the duplicate names are numbered in the preorder of the ladderized tree,
+    # counting down as in the alignment
+    name_counter = Counter(k for k in names if k is not None)
+    stack = [0]
+    while stack:
+        node = stack.pop()
+        stack.extend(reversed(children[node]))
+        name = names[node]
+        if name is None:
+            continue
+        dup_suffix = None
+        if name_counter[name] > 1:
+            dup_suffix = name_counter[name]
+            name_counter[name] -= 1
+        names[node] = ffpopsim_node_name(name, max_generation, nearest_date, prefix, dup_suffix)
+
+    with open(outfile, 'w') as of:
+        of.write(write_newick(names, branch_length, children) + "\n")
+    return max_generation
+
+class CompactTree(object):
+    """
+    Array representation of the rooted tree. The nodes are numbered, the tree is
+    stored as the arrays of the parent index, the branch length, the name and
+    the date of every node. The children are stored in the CSR form: the
+    children of the node i are child_idx[child_ptr[i]:child_ptr[i+1]], in the
+    order of their indices. The trees converted from Biopython are numbered in
+    preorder, so the root is the node 0 and the children have the larger
+    indices than their parents.
+
+    The per-node quantities (root-to-tip distances, clade sizes, induced
+    subtrees) are computed with NumPy operations over the whole arrays: the
+    path sums by pointer jumping (log(depth) steps) and the clade sums level by
+    level from the leaves.
+
+    Attributes:
+
+     - parent(numpy.array): parent index of every node, -1 for the root
+
+     - branch_length(numpy.array): branch lengths (NaN if not set)
+
+     - names(numpy.array): node names (object array, None for unnamed nodes)
+
+     - dates(numpy.array): node dates (NaN if unknown)
+    """
+
+    def __init__(self, parent, branch_length, names, dates=None, rooted=False):
+        self.parent = np.asarray(parent, dtype=np.int32)
+        n_nodes = self.parent.shape[0]
+        self.branch_length = np.asarray(branch_length, dtype=np.float64)
+        self.names = np.empty(n_nodes, dtype=object)
+        self.names[:] = list(names)
+        self.dates = np.full(n_nodes, np.nan) if dates is None else np.asarray(dates, dtype=np.float64)
+        self.rooted = rooted
+
+        roots = np.where(self.parent < 0)[0]
+        if roots.shape[0] != 1:
+            raise ValueError("The tree should have exactly one root, found {}".format(roots.shape[0]))
+        self.root = int(roots[0])
+
+        # the stable sort by the parent index puts the root first and groups
+        # the children of every node
+        order = np.argsort(self.parent, kind='mergesort')
+        n_children = np.bincount(self.parent[self.parent >= 0], minlength=n_nodes)
+        self.child_ptr = np.concatenate([[0], np.cumsum(n_children)]).astype(np.int32)
+        self.child_idx = order[1:].astype(np.int32)
+        self.is_leaf = n_children == 0
+        self.leaves = np.where(self.is_leaf)[0]
+        self._cache = {}
+
+    @property
+    def n_nodes(self):
+        return self.parent.shape[0]
+
+    def children(self, node):
+        return self.child_idx[self.child_ptr[node]:self.child_ptr[node + 1]]
+
+    @classmethod
+    def from_biopython(cls, tree, date_parser=None, date_attr=None):
+        """
+        Convert the Biopython tree (or clade).
+
+        Args:
+
+         - tree(Biopython tree or clade): the tree
+
+         - date_parser(callable or None): function to get the date of the node
+         from its name. Should return None if the date is not known.
+
+         - date_attr(str or None): attribute of the clades to take the dates
+         from (e.g. 'numdate' of the TreeTime tree). NaN if not set.
+        """
+        root = getattr(tree, 'root', tree)
+        names, branch_length, parent, dates = [], [], [], []
+        stack = [(root, -1)]
+        while stack:
+            clade, par = stack.pop()
+            idx = len(names)
+            names.append(clade.name)
+            if date_attr is not None:
+                dates.append(getattr(clade, date_attr, None))
+            branch_length.append(np.nan if clade.branch_length is None else clade.branch_length)
+            parent.append(par)
+            for child in reversed(clade.clades):
+                stack.append((child, idx))
+        dates = np.array(dates, dtype=np.float64) if date_attr is not None else None
+        tree = cls(parent, branch_length, names, dates, rooted=getattr(tree, 'rooted', False))
+        if date_parser is not None:
+            tree.set_dates(date_parser)
+        return tree
+
+    @classmethod
+    def read(cls, treefile, date_parser=None, cache=True):
+        """
+        Read the tree from the newick file (see read_newick)
+        """
+        tree = read_newick(treefile, cache=cache)
+        if date_parser is not None:
+            tree.set_dates(date_parser)
+        return tree
+
+    def set_dates(self, date_parser):
+        """
+        Set the node dates from the node names.
+
+        Args:
+
+         - date_parser(callable): function to get the date of the node from its
+         name. Should return None if the date is not known.
+        """
+        dates = [date_parser(k) for k in self.names]
+        self.dates = np.array([np.nan if k is None else k for k in dates], dtype=np.float64)
+
+    def write(self, treefile):
+        """
+        Write the tree to the newick file
+        """
+        with open(treefile, 'w') as of:
+            of.write(self.newick() + "\n")
+
+    def to_biopython(self):
+        """
+        Create the Biopython tree
+        """
+        from Bio.Phylo import BaseTree
+
+        clades = [None] * self.n_nodes
+        for node in self.preorder:
+            bl = self.branch_length[node]
+            clades[node] = BaseTree.Clade(branch_length=None if np.isnan(bl) else float(bl),
+                                          name=self.names[node])
+            if node != self.root:
+                clades[self.parent[node]].clades.append(clades[node])
+        return BaseTree.Tree(root=clades[self.root], rooted=self.rooted)
+
+    def newick(self):
+        """
+        The tree in the newick format
+        """
+        children = [list(self.children(k)) for k in range(self.n_nodes)]
+        return write_newick(self.names, np.nan_to_num(self.branch_length), children, root=self.root)
+
+    @property
+    def preorder(self):
+        """
+        Node indices in the depth-first preorder (cached)
+        """
+        if 'preorder' not in self._cache:
+            order = []
+            stack = [self.root]
+            while stack:
+                node = stack.pop()
+                order.append(node)
+                stack.extend(self.children(node)[::-1])
+            self._cache['preorder'] = np.array(order, dtype=np.int32)
+        return self._cache['preorder']
+
+    @property
+    def postorder(self):
+        """
+        Node indices in the depth-first postorder (cached)
+        """
+        if 'postorder' not in self._cache:
+            # the reversed preorder with the reversed children
+            order = []
+            stack = [self.root]
+            while stack:
+                node = stack.pop()
+                order.append(node)
+                stack.extend(self.children(node))
+            self._cache['postorder'] = np.array(order[::-1], dtype=np.int32)
+        return self._cache['postorder']
+
+    def _path_sums(self, values):
+        """
+        Sum of the values on the path from the root to every node (the value of
+        the root is not included), by pointer jumping.
+        """
+        acc = np.array(values, dtype=np.float64)
+        acc[self.root] = 0
+        anc = self.parent.copy()
+        while True:
+            has_anc = np.where(anc >= 0)[0]
+            if has_anc.shape[0] == 0:
+                return acc
+            acc_anc, anc_anc = acc[anc[has_anc]], anc[anc[has_anc]]
+            acc[has_anc] += acc_anc
+            anc[has_anc] = anc_anc
+
+    def depth(self):
+        """
+        Number of the branches between the root and every node (cached)
+        """
+        if 'depth' not in self._cache:
+            self._cache['depth'] = self._path_sums(np.ones(self.n_nodes)).astype(np.int32)
+        return self._cache['depth']
+
+    def dist2root(self):
+        """
+        Root-to-node distances (the missing branch lengths are taken as 0)
+        """
+        return self._path_sums(np.nan_to_num(self.branch_length))
+
+    def _levels(self):
+        if 'levels' not in self._cache:
+            depth = self.depth()
+            order = np.argsort(depth, kind='mergesort')
+            bounds = np.searchsorted(depth[order], np.arange(depth.max() + 2))
+            self._cache['levels'] = [order[bounds[d]:bounds[d + 1]] for d in range(depth.max() + 1)]
+        return self._cache['levels']
+
+    def clade_sums(self, values):
+        """
+        Sum of the values over the clade of every node (the node included),
+        level by level from the deepest nodes.
+        """
+        return self.clade_reduce(np.array(values, dtype=np.float64))
+
+    def clade_reduce(self, values, ufunc=np.add):
+        """
+        Reduce the values over the clade of every node with the ufunc (e.g.
+        np.bitwise_or for the leaf bitsets). The values can have more than one
+        dimension, the first one is the node index.
+
+        Returns:
+
+         - acc(numpy.array): the reduced values (a copy of the input)
+        """
+        acc = np.array(values)
+        for nodes in self._levels()[:0:-1]:
+            ufunc.at(acc, self.parent[nodes], acc[nodes])
+        return acc
+
+    def n_leaves_below(self):
+        """
+        Number of the leaves in the clade of every node
+        """
+        return self.clade_sums(self.is_leaf).astype(np.int64)
+
+    def leaf_names(self):
+        return list(self.names[self.leaves])
+
+    def leaf_mask(self, names):
+        """
+        Boolean mask of the leaves with the given names
+        """
+        names = set(names)
+        return self.is_leaf & np.array([k in names for k in self.names], dtype=bool)
+
+    def clade_leaf_sets(self):
+        """
+        Set of the leaf names in the clade of every node, e.g. to match the
+        clades of the different trees.
+
+        Returns:
+
+         - sets(list): frozensets of the leaf names, by node index
+        """
+        sets = [None] * self.n_nodes
+        for node in self.postorder:
+            if self.is_leaf[node]:
+                sets[node] = frozenset([self.names[node]])
+            else:
+                sets[node] = frozenset().union(*[sets[k] for k in self.children(node)])
+        return sets
+
+    def subtree(self, keep):
+        """
+        Subtree induced by the given leaves, as after pruning all other leaves
+        with Biopython: the nodes left with a single child are removed, their
+        branch lengths added to the child, and if the root is left with a
+        single child, the root moves down and loses its branch length.
+
+        Args:
+
+         - keep(numpy.array): boolean mask (or indices) of the leaves to keep
+
+        Returns:
+
+         - tree(CompactTree): the subtree
+        """
+        keep_mask = np.zeros(self.n_nodes, dtype=bool)
+        keep_mask[keep] = True
+        keep_mask &= self.is_leaf
+        if not keep_mask.any():
+            raise ValueError("No leaves to keep")
+
+        alive = self.clade_sums(keep_mask) > 0
+        alive_children = np.bincount(self.parent[alive & (self.parent >= 0)], minlength=self.n_nodes)
+        retained = keep_mask | (alive & (alive_children >= 2))
+
+        # nearest retained ancestor, by pointer jumping over the removed nodes,
+        # with the sum of the branch lengths on the way
+        anc = self.parent.copy()
+        length = np.nan_to_num(self.branch_length)
+        while True:
+            jump = np.where((anc >= 0) & ~retained[np.maximum(anc, 0)])[0]
+            if jump.shape[0] == 0:
+                break
+            length_anc, anc_anc = length[anc[jump]], anc[anc[jump]]
+            length[jump] += length_anc
+            anc[jump] = anc_anc
+
+        nodes = np.where(retained)[0]
+        new_idx = np.full(self.n_nodes, -1, dtype=np.int32)
+        new_idx[nodes] = np.arange(nodes.shape[0])
+        new_parent = np.where(anc[nodes] >= 0, new_idx[np.maximum(anc[nodes], 0)], -1)
+
+        branch_length = np.where(anc[nodes] >= 0, length[nodes], np.nan)
+        new_root = nodes[anc[nodes] < 0][0]
+        if new_root == self.root:
+            branch_length[new_idx[new_root]] = self.branch_length[self.root]
+        return CompactTree(new_parent, branch_length, self.names[nodes], self.dates[nodes], rooted=self.rooted)
+
+# newick tokens: quoted label, comment, punctuation or unquoted label
+NEWICK_TOKEN_REGEX = re.compile(r"'((?:[^']|'')*)'|\[[^\]]*\]|([(),:;])|([^\s(),:;\[\]']+)")
+
+def parse_newick(newick):
+    """
+    Parse the newick string directly to the CompactTree (no Biopython clades
+    are created). The nodes are numbered in preorder. As in Biopython, the
+    numeric labels of the internal nodes are taken as the support values and
+    are not kept as the names; the comments ([...]) are skipped.
+
+    Args:
+
+     - newick(str): the tree in the newick format
+
+    Returns:
+
+     - tree(CompactTree): the tree
+    """
+    parent, names, branch_length = [-1], [None], [np.nan]
+    node = 0
+    after_colon = False
+    for match in NEWICK_TOKEN_REGEX.finditer(newick):
+        quoted, punct, label = match.groups()
+        if punct is None:
+            if quoted is None and label is None:
+                # comment
+                continue
+            if after_colon:
+                branch_length[node] = float(label)
+                after_colon = False
+            else:
+                names[node] = quoted.replace("''", "'") if quoted is not None else label
+            continue
+        after_colon = False
+        if punct == '(':
+            parent.append(node)
+            names.append(None)
+            branch_length.append(np.nan)
+            node = len(parent) - 1
+        elif punct == ',':
+            if parent[node] < 0:
+                raise ValueError("Malformed newick: ',' outside the brackets")
+            parent.append(parent[node])
+            names.append(None)
+            branch_length.append(np.nan)
+            node = len(parent) - 1
+        elif punct == ')':
+            node = parent[node]
+            if node < 0:
+                raise ValueError("Malformed newick: unbalanced ')'")
+        elif punct == ':':
+            after_colon = True
+        elif punct == ';':
+            break
+    if node != 0:
+        raise ValueError("Malformed newick: unbalanced '('")
+
+    tree = CompactTree(parent, branch_length, names)
+    # numeric labels of the internal nodes are the support values
+    for idx in np.where(~tree.is_leaf)[0]:
+        name = tree.names[idx]
+        if name is not None:
+            try:
+                float(name)
+                tree.names[idx] = None
+            except ValueError:
+                pass
+    return tree
+
+# directory of the parsed trees, by the hash of the newick file content
+TREE_CACHE_DIR = os.environ.get("TREE_CACHE_DIR", "./.tree_cache")
+
+TREE_CACHE_ARRAYS = ['parent', 'branch_length', 'names', 'has_name']
+
+# file content hashes, by (path, size, mtime), kept for the process lifetime
+_content_hashes = {}
+
+def _file_hash(fname):
+    stat = os.stat(fname)
+    key = (os.path.abspath(fname), stat.st_size, stat.st_mtime)
+    if key not in _content_hashes:
+        sha = hashlib.sha1()
+        with open(fname, 'rb') as inf:
+            for chunk in iter(lambda: inf.read(1 << 20), b''):
+                sha.update(chunk)
+        _content_hashes[key] = sha.hexdigest()
+    return _content_hashes[key]
+
+def _str(value):
+    if isinstance(value, bytes) and not isinstance(value, str):
+        return value.decode('utf-8')
+    return str(value)
+
+def read_newick(treefile, cache=True, cache_dir=None):
+    """
+    Read the tree from the newick file. The parsed trees are cached on disk as
+    NumPy arrays under the hash of the file content, so the repeated reads of
+    the unchanged file (also from the other processes) are memory-mapped loads
+    instead of the newick parsing.
+
+    Args:
+
+     - treefile(str): path to the newick file
+
+     - cache(bool): use the cache of the parsed trees
+
+     - cache_dir(str or None): cache directory, TREE_CACHE_DIR if None
+
+    Returns:
+
+     - tree(CompactTree): the tree
+    """
+    if not cache:
+        with open(treefile) as inf:
+            return parse_newick(inf.read())
+
+    entry = os.path.join(cache_dir or TREE_CACHE_DIR, _file_hash(treefile))
+    if os.path.exists(os.path.join(entry, "has_name.npy")):
+        try:
+            arrays = {k: np.load(os.path.join(entry, k + ".npy"), mmap_mode='r') for k in TREE_CACHE_ARRAYS}
+            names = [_str(k) if has else None for k, has in zip(arrays['names'], arrays['has_name'])]
+            return CompactTree(arrays['parent'], arrays['branch_length'], names)
+        except (IOError, OSError, ValueError):
+            # unreadable entry, parse the file instead
+            pass
+
+    with open(treefile) as inf:
+        tree = parse_newick(inf.read())
+
+    # write to the temporary directory first, so the readers never see the
+    # partial entry
+    tmp = entry + ".tmp_" + uuid.uuid4().hex
+    try:
+        os.makedirs(tmp)
+        names = [k.encode('utf-8') if not isinstance(k, bytes) else k
+                 for k in (k if k is not None else '' for k in tree.names)]
+        arrays = {'parent': tree.parent, 'branch_length': tree.branch_length,
+                  'names': np.array(names, dtype='S'),
+                  'has_name': np.array([k is not None for k in tree.names], dtype=bool)}
+        for k in TREE_CACHE_ARRAYS:
+            np.save(os.path.join(tmp, k + ".npy"), arrays[k])
+        os.rename(tmp, entry)
+    except (IOError, OSError):
+        # the entry was written by another process, or the cache is not
+        # writable: the parsed tree is returned uncached
+        shutil.rmtree(tmp, ignore_errors=True)
+    return tree
+
+if __name__ == '__main__':
+    pass